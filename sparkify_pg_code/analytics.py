@@ -0,0 +1,304 @@
+import argparse
+import collections
+import threading
+import time
+from sparkify_pg_code.sql_queries import user_activity_select, level_mix_select, load_generation_select, \
+    load_generation_bump
+from sparkify_pg_code.utils import connection_sparkifydb
+from sparkify_pg_code.instrumentation import stage
+from sparkify_pg_code import rollups
+
+# Analytics queries for the dashboards, read from the rollups (see rollups.py) through a cache of the results
+# - Analytics exposes the common queries as functions with parameters: top songs / artists / users of a period \
+# (the queries of rollups.py, cached), user activity, level mix
+# - The results are kept in a QueryCache (LRU with a time to live), tagged with the load generation they were \
+# computed at
+# - The load generation is a counter of the table load_generation, bumped by the ETL in the transaction of each \
+# commit of loaded files (bump_load_generation, see etl.process_data). The bump also sends a NOTIFY \
+# load_generation, delivered when the transaction commits.
+# - Analytics LISTENs on load_generation: the notifications are read from the socket of its connection, without \
+# a query, so the repeated calls between two loads are answered from the cache without touching the database. \
+# Without listen, the generation is read again at most every check_interval seconds.
+# Run from the sparkify_pg_code directory:
+#   python analytics.py --first-day 2018-11-01 --last-day 2018-12-01 -n 5
+
+# Channel of the notifications of the load generation
+generation_channel = 'load_generation'
+# Units of the periods of level_mix
+level_mix_units = ['hour', 'day', 'week', 'month']
+
+
+def bump_load_generation(conn):
+    """
+    Bump the load generation, in the current transaction of conn
+    Args:
+        conn (psycopg2.connection): connection of the loads
+
+    Returns:
+        int: new load generation
+    """
+    with stage('load_generation.bump'):
+        cur = conn.cursor()
+        cur.execute(load_generation_bump)
+        generation = cur.fetchone()[0]
+    return generation
+
+
+class QueryCache(object):
+    """
+    Results of queries, least recently used first, each valid for ttl seconds and for the load generation it was \
+    computed at. Thread-safe.
+    Args:
+        max_entries (int): maximum number of results kept: the least recently used ones are evicted
+        ttl (float): seconds a result stays valid, None: no expiry (only the load generation invalidates it)
+        clock (callable): time in seconds (time.monotonic)
+    """
+
+    def __init__(self, max_entries=256, ttl=300.0, clock=time.monotonic):
+        assert max_entries >= 1
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation):
+        """
+        Args:
+            key (tuple): key of the query (name and parameters)
+            generation (int): current load generation
+
+        Returns:
+            bool, object: True and the result if cached, valid and of the generation, else False and None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires, result = entry
+                if entry_generation == generation and (expires is None or self.clock() < expires):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, result
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, generation, result):
+        """
+        Args:
+            key (tuple): key of the query
+            generation (int): load generation the result was computed at
+            result (object): result
+
+        Returns:
+            None
+        """
+        with self._lock:
+            expires = self.clock() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (generation, expires, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return None
+
+    def clear(self):
+        """
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
+        return None
+
+    def stats(self):
+        """
+        Returns:
+            dict: entries, hits, misses and evictions
+        """
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class Analytics(object):
+    """
+    Analytics queries, with their results cached until the next load (or their ttl)
+    The days are str ('2018-11-01') or datetime.date: first_day is included, last_day excluded.
+    Thread-safe: the queries are run one at a time on the connection.
+    Args:
+        conn (psycopg2.connection): connection, in autocommit mode if listen. Default: a new connection.
+        cache (QueryCache): cache of the results. Default: QueryCache().
+        listen (bool): If True, learn the new load generations from the notifications of the ETL
+        check_interval (float): without listen, seconds between two reads of the load generation
+    """
+
+    def __init__(self, conn=None, cache=None, listen=True, check_interval=5.0):
+        self.conn = conn if conn is not None else connection_sparkifydb(autocommit=True)
+        self.cache = cache if cache is not None else QueryCache()
+        self.listen = listen
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked_at = None
+        if listen:
+            if not self.conn.autocommit:
+                raise ValueError('listen needs a connection in autocommit mode')
+            # listen first: a load committed between the two statements is not missed
+            self.conn.cursor().execute('LISTEN {};'.format(generation_channel))
+
+    def close(self):
+        """
+        Returns:
+            None
+        """
+        self.conn.close()
+        return None
+
+    def _read_generation(self):
+        cur = self.conn.cursor()
+        cur.execute(load_generation_select)
+        self._generation = cur.fetchone()[0]
+        self._checked_at = time.monotonic()
+
+    def generation(self):
+        """
+        Current load generation (called with the lock)
+        Returns:
+            int
+        """
+        if self._generation is None:
+            self._read_generation()
+        elif self.listen:
+            # reads the notifications already received by the socket, without a round trip
+            self.conn.poll()
+            while self.conn.notifies:
+                notify = self.conn.notifies.pop(0)
+                if notify.channel == generation_channel:
+                    self._generation = max(self._generation, int(notify.payload))
+        elif time.monotonic() - self._checked_at >= self.check_interval:
+            self._read_generation()
+        return self._generation
+
+    def cached(self, name, func, params):
+        """
+        Result of func(cursor, *params), from the cache if it was run since the last load
+        Args:
+            name (str): name of the query, part of the key of the cache
+            func (callable): function running the query, e.g. rollups.top_songs
+            params (tuple): parameters of the query
+
+        Returns:
+            list: rows
+        """
+        key = (name,) + tuple(str(p) for p in params)
+        with self._lock:
+            generation = self.generation()
+            hit, rows = self.cache.get(key, generation)
+            if hit:
+                return rows
+            with stage('analytics.query', table=name) as m:
+                rows = func(self.conn.cursor(), *params)
+                m.rows_out = len(rows)
+            self.cache.put(key, generation, rows)
+        return rows
+
+    def query(self, name, query, params):
+        """
+        Result of a query, from the cache if it was run since the last load
+        Args:
+            name (str): name of the query, part of the key of the cache
+            query (str): query
+            params (tuple): parameters of the query
+
+        Returns:
+            list: rows
+        """
+        def fetch(cur, *params):
+            cur.execute(query, params)
+            return cur.fetchall()
+        return self.cached(name, fetch, params)
+
+    def top_songs(self, first_day, last_day, n=10):
+        """
+        Most played songs of a period (see rollups.top_songs)
+        Returns:
+            list: list of (artist name, song title, number of plays)
+        """
+        return self.cached('top_songs', rollups.top_songs, (first_day, last_day, n))
+
+    def top_artists(self, first_day, last_day, n=10):
+        """
+        Most played artists of a period (see rollups.top_artists)
+        Returns:
+            list: list of (artist name, number of plays)
+        """
+        return self.cached('top_artists', rollups.top_artists, (first_day, last_day, n))
+
+    def top_users(self, first_day, last_day, n=10):
+        """
+        Users with the most plays in a period (see rollups.top_users)
+        Returns:
+            list: list of (user_id, first name, last name, number of plays)
+        """
+        return self.cached('top_users', rollups.top_users, (first_day, last_day, n))
+
+    def user_activity(self, first_day, last_day, n=10):
+        """
+        Activity of the most active users of a period
+        Returns:
+            list: list of (user_id, first name, last name, current level, number of plays, number of active days, \
+            first day, last day)
+        """
+        return self.query('user_activity', user_activity_select, (first_day, last_day, n))
+
+    def level_mix(self, first_day, last_day, unit='day'):
+        """
+        Plays per level (free / paid) in each period of a time range
+        Args:
+            first_day (str/datetime.date): first day (included)
+            last_day (str/datetime.date): last day (excluded)
+            unit (str): length of the periods: 'hour', 'day', 'week' or 'month'
+
+        Returns:
+            list: list of (start of the period, level, number of plays, share of the plays of the period)
+        """
+        if unit not in level_mix_units:
+            raise ValueError('Unknown unit {}, expected one of {}'.format(unit, level_mix_units))
+        return self.query('level_mix', level_mix_select, (unit, first_day, last_day))
+
+
+def main():
+    """
+    Print the analytics of a period
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Analytics of the songplays, from the rollups')
+    parser.add_argument('--first-day', required=True, help='first day of the period (included), e.g. 2018-11-01')
+    parser.add_argument('--last-day', required=True, help='last day of the period (excluded), e.g. 2018-12-01')
+    parser.add_argument('-n', type=int, default=10, help='number of rows of the top-N queries')
+    parser.add_argument('--unit', default='week', choices=level_mix_units, help='periods of the level mix')
+    args = parser.parse_args()
+
+    analytics = Analytics(listen=False)
+    try:
+        period = (args.first_day, args.last_day)
+        for title, rows in [('Top songs', analytics.top_songs(*period, n=args.n)),
+                            ('Top artists', analytics.top_artists(*period, n=args.n)),
+                            ('User activity', analytics.user_activity(*period, n=args.n)),
+                            ('Level mix', analytics.level_mix(*period, unit=args.unit))]:
+            print(title)
+            for row in rows:
+                print('  ', row)
+    finally:
+        analytics.close()
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+from sparkify_pg_code.utils import connection_sparkifydb, bulk_copy, DataFrameCopyStream, \
+    DataFrameBinaryCopyStream
+from sparkify_pg_code.create_tables import drop_tables, create_tables
+from sparkify_pg_code.dimensions import DimensionCache
+from sparkify_pg_code.instrumentation import recorder
+from sparkify_pg_code import etl
+
+# Benchmarks of the loading path. Run from the sparkify_pg_code directory:
+#   python benchmark.py copy --rows 200000            (needs the sparkifydb database)
+#   python benchmark.py copy --rows 200000 --offline  (serialization only, no database)
+#   python benchmark.py etl --root ../data/synthetic --modes bulk row
+# The etl benchmark drops and re-creates the tables of sparkifydb, loads a data set written by datagen.py \
+# with etl.process_data and appends the results (throughput, time and peak memory per stage) to a JSON lines \
+# file, so that the runs can be compared over time.
+
+benchmark_report = '../data/reports/benchmarks.jsonl'
+
+# Types of the columns of the tables, as created by sql_queries.py (used by the offline benchmark)
+songplays_types = ['timestamp without time zone', 'integer', 'character varying', 'character varying',
+                   'character varying', 'integer', 'character varying', 'character varying']
+time_types = ['timestamp without time zone'] + ['integer'] * 6
+
+
+def make_songplays(n_rows, seed=0):
+    """
+    Synthetic songplays rows, with the columns of the songplays table
+    Args:
+        n_rows (int): number of rows
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame
+    """
+    rng = np.random.RandomState(seed)
+    agents = np.array(['Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0',
+                       '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.77.4 Safari/537.77.4"',
+                       'Mozilla/5.0 (Windows NT 6.1; rv:31.0) Gecko/20100101 Firefox/31.0'], dtype=object)
+    locations = np.array(['San Francisco-Oakland-Hayward, CA', 'Lubbock, TX', 'New Haven-Milford, CT'], dtype=object)
+    song_ids = np.array(['SO{:016d}'.format(i) for i in range(1000)], dtype=object)
+    artist_ids = np.array(['AR{:016d}'.format(i) for i in range(500)], dtype=object)
+    ts = 1541105830796 + np.arange(n_rows, dtype=np.int64) * 1000
+    return pd.DataFrame({
+        'start_time': pd.to_datetime(ts, unit='ms'),
+        'user_id': rng.randint(1, 100, n_rows),
+        'level': np.where(rng.rand(n_rows) < 0.3, 'free', 'paid').astype(object),
+        'song_id': song_ids[rng.randint(0, len(song_ids), n_rows)],
+        'artist_id': artist_ids[rng.randint(0, len(artist_ids), n_rows)],
+        'session_id': rng.randint(1, 1000, n_rows),
+        'location': locations[rng.randint(0, len(locations), n_rows)],
+        'user_agent': agents[rng.randint(0, len(agents), n_rows)]
+    })
+
+
+def make_time(n_rows):
+    """
+    Synthetic time rows, with the columns of the time table
+    Args:
+        n_rows (int): number of rows
+
+    Returns:
+        pd.DataFrame
+    """
+    t = pd.Series(pd.to_datetime(1541105830796 + np.arange(n_rows, dtype=np.int64) * 1000, unit='ms'))
+    return pd.DataFrame({
+        'start_time': t,
+        'hour': t.dt.hour,
+        'day': t.dt.day,
+        'week': t.dt.isocalendar().week.astype('int64'),
+        'month': t.dt.month,
+        'year': t.dt.year,
+        'weekday': t.dt.weekday
+    })
+
+
+def _drain(stream):
+    """
+    Read the stream until the end, like cursor.copy_expert
+    Returns:
+        int: number of bytes read
+    """
+    while stream.read(8192):
+        pass
+    return stream.bytes_read
+
+
+def benchmark_serialization(df, types, repeat=3):
+    """
+    Time the serialization of the rows in csv and binary COPY formats, without database
+    Args:
+        df (pd.DataFrame): rows
+        types (list): types of the columns of the table
+        repeat (int): number of runs, the best one is kept
+
+    Returns:
+        list: one dict per format with keys fmt, seconds, rows_per_s, bytes
+    """
+    results = []
+    for fmt in ['csv', 'binary']:
+        best, n_bytes = None, 0
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            if fmt == 'csv':
+                n_bytes = _drain(DataFrameCopyStream(df=df))
+            else:
+                n_bytes = _drain(DataFrameBinaryCopyStream(df=df, types=types))
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({'fmt': fmt, 'seconds': best, 'rows_per_s': df.shape[0] / best, 'bytes': n_bytes})
+    return results
+
+
+def benchmark_copy_formats(conn, n_rows=100000, repeat=3):
+    """
+    Time bulk_copy into the songplays and time tables in csv and binary formats
+    The rows are copied into temporary tables with the same columns (CREATE TEMP TABLE ... LIKE), \\
+    so that the real tables are not modified.
+    Args:
+        conn (psycopg2.connection): connection (autocommit)
+        n_rows (int): number of rows copied per run
+        repeat (int): number of runs, the best one is kept
+
+    Returns:
+        list: one dict per table and format with keys table, fmt, seconds, rows_per_s
+    """
+    cur = conn.cursor()
+    results = []
+    for tablename, df in [('songplays', make_songplays(n_rows)), ('time', make_time(n_rows))]:
+        bench_table = 'bench_' + tablename
+        cur.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {bench} (LIKE {table});").format(
+            bench=sql.Identifier(bench_table), table=sql.Identifier(tablename)))
+        for fmt in ['csv', 'binary']:
+            best = None
+            for _ in range(repeat):
+                cur.execute(sql.SQL("TRUNCATE {bench};").format(bench=sql.Identifier(bench_table)))
+                t0 = time.perf_counter()
+                bulk_copy(df=df, cur=cur, tablename=bench_table, fmt=fmt)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            results.append({'table': tablename, 'fmt': fmt, 'seconds': best, 'rows_per_s': n_rows / best})
+        cur.execute(sql.SQL("DROP TABLE {bench};").format(bench=sql.Identifier(bench_table)))
+    return results
+
+
+def _git_revision():
+    """
+    Returns:
+        str: commit of the working tree, or None if git is not available
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_etl(data_root, bulk=True, batch_size=100, chunksize=None, workers=None, trace_memory=True,
+                  report_path=benchmark_report, pipelined=False):
+    """
+    Load a data set into empty tables with etl.process_data and measure it
+    - The tables of sparkifydb are dropped and re-created first
+    - Throughput (files/s, rows/s) of the song and log files
+    - Time, rows and peak memory of each stage (see instrumentation.py). The memory is traced with tracemalloc, \
+    which slows down the run: the throughputs of runs with and without trace_memory are not comparable.
+    Args:
+        data_root (str): directory containing song_data and log_data (e.g. written by datagen.py)
+        bulk (bool): bulk (COPY) or row (INSERT) mode
+        batch_size (int): number of files per batch
+        chunksize (int): If provided, stream the files by chunks of lines
+        workers (int): number of worker processes used to transform the files
+        trace_memory (bool): If True, measure the memory with tracemalloc
+        report_path (str): JSON lines file the result is appended to. If None, the result is not written.
+        pipelined (bool): If True, read and transform the files in pipeline threads \
+        (etl.process_data_pipelined, without workers nor chunksize)
+
+    Returns:
+        dict: result of the run
+    """
+    conn = connection_sparkifydb()
+    cur = conn.cursor()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    dims = DimensionCache.from_db(cur)
+    recorder.reset()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        loads = {}
+        for name, func in [('song', etl.process_song_file), ('log', etl.process_log_file)]:
+            filepath = os.path.join(data_root, name + '_data')
+            if pipelined:
+                r = etl.process_data_pipelined(cur, conn, filepath=filepath, func=func, bulk=bulk,
+                                               batch_size=batch_size, dims=dims)
+            else:
+                r = etl.process_data(cur, conn, filepath=filepath, func=func, bulk=bulk, batch_size=batch_size,
+                                     workers=workers, dims=dims, chunksize=chunksize)
+            seconds = max(r['seconds'], 1e-9)
+            loads[name] = dict(r, files_per_s=r['files'] / seconds, rows_per_s=r['rows'] / seconds)
+        peak_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        conn.close()
+    result = {
+        'run_id': recorder.run_id,
+        'date': datetime.datetime.now().isoformat(),
+        'revision': _git_revision(),
+        'data_root': os.path.abspath(data_root),
+        'mode': 'bulk' if bulk else 'row',
+        'batch_size': batch_size,
+        'chunksize': chunksize,
+        'workers': workers,
+        'pipelined': pipelined,
+        'trace_memory': trace_memory,
+        'loads': loads,
+        'peak_bytes': peak_bytes,
+        'stages': recorder.stats()
+    }
+    if report_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + '\n')
+    return result
+
+
+def main():
+    """
+    Run a benchmark from the command line and print the results
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks of the loading path')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    parser_copy = subparsers.add_parser('copy', help='csv and binary COPY formats')
+    parser_copy.add_argument('--rows', type=int, default=100000, help='number of rows per table')
+    parser_copy.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is kept')
+    parser_copy.add_argument('--offline', action='store_true', help='serialization only, without database')
+    parser_etl = subparsers.add_parser('etl', help='etl.process_data on a data set (drops the tables!)')
+    parser_etl.add_argument('--root', required=True, help='directory containing song_data and log_data')
+    parser_etl.add_argument('--modes', nargs='+', choices=['bulk', 'row'], default=['bulk', 'row'])
+    parser_etl.add_argument('--batch-size', type=int, default=100, help='number of files per batch')
+    parser_etl.add_argument('--chunksize', type=int, default=None, help='stream the files by chunks of lines')
+    parser_etl.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser_etl.add_argument('--pipelined', action='store_true', help='read and transform in pipeline threads')
+    parser_etl.add_argument('--no-memory', action='store_true', help='do not trace the memory (faster)')
+    parser_etl.add_argument('--report', default=benchmark_report, help='JSON lines file of the results')
+    args = parser.parse_args()
+
+    if args.benchmark == 'etl':
+        for mode in args.modes:
+            result = benchmark_etl(data_root=args.root, bulk=mode == 'bulk', batch_size=args.batch_size,
+                                   chunksize=args.chunksize, workers=args.workers,
+                                   trace_memory=not args.no_memory, report_path=args.report,
+                                   pipelined=args.pipelined)
+            for name, r in result['loads'].items():
+                print('{:<5} {:<5} {:8d} files {:10d} rows {:9.1f}s {:10.1f} files/s {:10.1f} rows/s'.format(
+                    mode, name, r['files'], r['rows'], r['seconds'], r['files_per_s'], r['rows_per_s']))
+            print(recorder.summary())
+        return None
+
+    for tablename, df, types in [('songplays', make_songplays(args.rows), songplays_types),
+                                 ('time', make_time(args.rows), time_types)]:
+        for r in benchmark_serialization(df=df, types=types, repeat=args.repeat):
+            print('serialize {:<10} {:<7} {:8.3f}s {:12.0f} rows/s {:12d} bytes'.format(
+                tablename, r['fmt'], r['seconds'], r['rows_per_s'], r['bytes']))
+    if not args.offline:
+        conn = connection_sparkifydb()
+        for r in benchmark_copy_formats(conn=conn, n_rows=args.rows, repeat=args.repeat):
+            print('copy      {:<10} {:<7} {:8.3f}s {:12.0f} rows/s'.format(
+                r['table'], r['fmt'], r['seconds'], r['rows_per_s']))
+        conn.close()
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import psycopg2
 from sparkify_pg_code.sql_queries import create_table_queries, drop_table_queries
+from sparkify_pg_code.indexes import create_indexes
+from sparkify_pg_code.pgbinary import clear_table_types
 
 drop_create_database = False
 
@@ -38,10 +40,16 @@ def create_database(drop_create_database=False):
 def drop_tables(cur, conn):
     """
     Drops each table using the queries in `drop_table_queries` list.
+    The session staging tables (utils.staging_table, created once per session from the columns of their table) \
+    are dropped, and the column types cached for the binary COPY are forgotten: the tables may be created with \
+    other columns.
     """
     for query in drop_table_queries:
         cur.execute(query)
         conn.commit()
+    cur.execute("DISCARD TEMP;")
+    conn.commit()
+    clear_table_types()
 
 
 def create_tables(cur, conn):
@@ -64,12 +72,16 @@ def main():
     
     - Creates all tables needed. 
     
+    - Creates the secondary indexes (see indexes.py). 
+    
     - Finally, closes the connection. 
     """
     cur, conn = create_database(drop_create_database=drop_create_database)
     
     drop_tables(cur, conn)
     create_tables(cur, conn)
+    create_indexes(cur)
+    conn.commit()
 
     conn.close()
 
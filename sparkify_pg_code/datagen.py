@@ -0,0 +1,337 @@
+import argparse
+import datetime
+import os
+import string
+import numpy as np
+import pandas as pd
+
+# Generator of synthetic song_data and log_data trees, with the layout and the attributes of the sample files:
+# - song_data/A/B/C/TRABC....json: one song per line (songs_per_file songs per file)
+# - log_data/YYYY/MM/YYYY-MM-DD-events.json: the events of a day, one per line, sorted by ts
+# The songs played follow a Zipf-like popularity (a few songs get most of the plays), the users come back in \
+# several sessions with a few user agents and locations, and change level (free / paid) from time to time.
+# Examples (from the sparkify_pg_code directory):
+#   python datagen.py --root ../data/synthetic --songs 1000000 --events 50000000 --days 30
+#   python datagen.py --root ../data/synthetic_small --songs 10000 --events 200000
+
+_user_agents = [
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.77.4 (KHTML, like Gecko) Version/7.0.5 '
+    'Safari/537.77.4"',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 '
+    'Mobile/11D257 Safari/9537.53"',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (Windows NT 6.3; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; WOW64; Trident/6.0)'
+]
+_locations = [
+    'San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'Lubbock, TX', 'New Haven-Milford, CT',
+    'Waterloo-Cedar Falls, IA', 'Chicago-Naperville-Elgin, IL-IN-WI', 'Atlanta-Sandy Springs-Roswell, GA',
+    'New York-Newark-Jersey City, NY-NJ-PA', 'Houston-The Woodlands-Sugar Land, TX', 'Portland-South Portland, ME',
+    'Los Angeles-Long Beach-Anaheim, CA', 'Marinette, WI-MI', 'Detroit-Warren-Dearborn, MI',
+    'Tampa-St. Petersburg-Clearwater, FL', 'Janesville-Beloit, WI', 'Klamath Falls, OR'
+]
+_first_names = ['Walter', 'Kaylee', 'Lily', 'Jacob', 'Layla', 'Tegan', 'Mohammad', 'Aiden', 'Chloe', 'Jayden',
+                'Ryan', 'Sara', 'Matthew', 'Jordan', 'Rylan', 'Kate', 'Avery', 'Ava', 'Emily', 'Noah']
+_last_names = ['Frye', 'Summers', 'Koch', 'Klein', 'Griffin', 'Levine', 'Rodriguez', 'Ramsey', 'Cuevas', 'Bell',
+               'Smith', 'Johnson', 'Hogan', 'Cruz', 'George', 'Harrell', 'Watkins', 'Martinez', 'Kim', 'Long']
+# pages of the events which are not song plays, with their relative frequency
+_other_pages = ['Home', 'Logout', 'Login', 'Settings', 'Help', 'About', 'Upgrade', 'Downgrade', 'Add to Playlist',
+                'Thumbs Up', 'Thumbs Down', 'Roll Advert', 'Save Settings']
+_other_pages_p = np.array([30, 8, 8, 3, 3, 1, 2, 1, 8, 15, 4, 15, 2], dtype=float)
+_other_pages_p /= _other_pages_p.sum()
+_alphabet = np.array(list(string.ascii_uppercase + string.digits))
+
+
+def _random_ids(rng, prefix, n, length=16):
+    """
+    Unique random ids like the ones of the sample data, e.g. SOOJPRH12A8C141995
+    Args:
+        rng (np.random.RandomState): random generator
+        prefix (str): e.g. 'SO', 'AR', 'TR'
+        n (int): number of ids
+        length (int): number of random characters after the prefix
+
+    Returns:
+        np.ndarray: array of str
+    """
+    # the counter in base 36 makes the ids unique, the random characters make them look like the real ones
+    counter = np.array([np.base_repr(i, 36).rjust(6, '0') for i in range(n)])
+    chars = _alphabet[rng.randint(0, len(_alphabet), size=(n, length - 6))]
+    random_part = np.array([''.join(r) for r in chars])
+    return np.char.add(np.char.add(prefix, random_part), counter)
+
+
+def _random_words(rng, n, vocabulary, min_words=1, max_words=4):
+    """
+    Titles or names made of random words of the vocabulary
+    """
+    n_words = rng.randint(min_words, max_words + 1, size=n)
+    words = vocabulary[rng.randint(0, len(vocabulary), size=(n, max_words))]
+    return np.array([' '.join(w[:k]) for w, k in zip(words, n_words)], dtype=object)
+
+
+def generate_songs(n_songs, n_artists=None, seed=0):
+    """
+    Generate the songs, with the attributes of the song files
+    Args:
+        n_songs (int): number of songs
+        n_artists (int): number of artists (default: one artist for 4 songs)
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: columns num_songs, artist_id, artist_latitude, artist_longitude, artist_location, \
+        artist_name, song_id, title, duration, year
+    """
+    rng = np.random.RandomState(seed)
+    n_artists = n_artists if n_artists is not None else max(1, n_songs // 4)
+    vocabulary = np.array(['Love', 'Night', 'Gun', 'Rain', 'Heart', 'Fire', 'Dream', 'Blue', 'Road', 'Home',
+                           'Dance', 'Steel', 'Girl', 'Time', 'Light', 'Street', 'Soul', 'Baby', 'Moon', 'Loaded',
+                           'Like', 'A', 'The', 'My', 'Of', 'In', 'Golden', 'Wild', 'Lonely', 'Summer'])
+    artist_ids = _random_ids(rng, 'AR', n_artists)
+    artist_names = _random_words(rng, n_artists, vocabulary, 1, 3)
+    # about half of the artists have no known location
+    has_location = rng.rand(n_artists) < 0.5
+    locations = np.array(_locations, dtype=object)[rng.randint(0, len(_locations), n_artists)]
+    latitude = np.where(has_location, rng.uniform(25, 49, n_artists), np.nan)
+    longitude = np.where(has_location, rng.uniform(-124, -67, n_artists), np.nan)
+    artist_of_song = rng.randint(0, n_artists, n_songs)
+    year = np.where(rng.rand(n_songs) < 0.5, 0, rng.randint(1960, 2019, n_songs))
+    return pd.DataFrame({
+        'num_songs': 1,
+        'artist_id': artist_ids[artist_of_song],
+        'artist_latitude': latitude[artist_of_song],
+        'artist_longitude': longitude[artist_of_song],
+        'artist_location': np.where(has_location, locations, '')[artist_of_song],
+        'artist_name': artist_names[artist_of_song],
+        'song_id': _random_ids(rng, 'SO', n_songs),
+        'title': _random_words(rng, n_songs, vocabulary, 1, 5),
+        'duration': np.round(rng.gamma(9, 27, n_songs) + 30, 5),
+        'year': year
+    })
+
+
+def write_song_data(songs, root, songs_per_file=1, seed=0):
+    """
+    Write the songs as song_data/A/B/C/TR....json files
+    Args:
+        songs (pd.DataFrame): as returned by generate_songs
+        root (str): directory in which song_data is created
+        songs_per_file (int): number of songs (lines) per file
+        seed (int): random seed of the track ids (file names)
+
+    Returns:
+        int: number of files written
+    """
+    rng = np.random.RandomState(seed)
+    n_files = (songs.shape[0] + songs_per_file - 1) // songs_per_file
+    track_ids = _random_ids(rng, 'TR', n_files)
+    for i, track_id in enumerate(track_ids):
+        # the directories are the 3rd to 5th characters of the track id, like the sample data
+        dirpath = os.path.join(root, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(dirpath, exist_ok=True)
+        chunk = songs.iloc[i * songs_per_file:(i + 1) * songs_per_file]
+        chunk.to_json(os.path.join(dirpath, track_id + '.json'), orient='records', lines=True)
+    return n_files
+
+
+def generate_users(n_users, seed=0):
+    """
+    Generate the users: name, gender, preferred location and user agent, initial level, registration
+    Args:
+        n_users (int): number of users
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: indexed by userId (1 to n_users)
+    """
+    rng = np.random.RandomState(seed)
+    first_names = np.array(_first_names, dtype=object)
+    return pd.DataFrame({
+        'firstName': first_names[rng.randint(0, len(first_names), n_users)],
+        'lastName': np.array(_last_names, dtype=object)[rng.randint(0, len(_last_names), n_users)],
+        'gender': np.where(rng.rand(n_users) < 0.5, 'F', 'M').astype(object),
+        'level': np.where(rng.rand(n_users) < 0.2, 'paid', 'free').astype(object),
+        'location': np.array(_locations, dtype=object)[rng.randint(0, len(_locations), n_users)],
+        'userAgent': np.array(_user_agents, dtype=object)[rng.randint(0, len(_user_agents), n_users)],
+        'registration': 1540000000000.0 + rng.randint(0, 10 ** 9, n_users) * 1.0,
+        # a few users play much more than the others
+        'activity': rng.pareto(1.5, n_users) + 1
+    }, index=pd.RangeIndex(1, n_users + 1, name='userId'))
+
+
+def _popularity(n, skew, rng):
+    """
+    Zipf-like probabilities over n items, in a random order
+    Args:
+        n (int): number of items
+        skew (float): exponent: the k-th most popular item has a probability proportional to 1 / k^skew
+        rng (np.random.RandomState): random generator
+
+    Returns:
+        np.ndarray: probabilities, sum to 1
+    """
+    p = 1.0 / np.arange(1, n + 1) ** skew
+    p /= p.sum()
+    return p[rng.permutation(n)]
+
+
+def generate_day_events(day, n_events, songs, users, song_p, user_p, nextsong_ratio=0.8, session_offset=0,
+                        seed=0):
+    """
+    Generate the events of one day, sorted by ts
+    - NextSong events play a song drawn with the song popularity, the other events have no song
+    - Each user has about one session per 20 events, with its usual user agent and location
+    - About 1% of the events are anonymous (empty userId), and a few users change level during the day \
+    (users is updated with their new level)
+    Args:
+        day (datetime.date): day of the events
+        n_events (int): number of events
+        songs (pd.DataFrame): as returned by generate_songs
+        users (pd.DataFrame): as returned by generate_users
+        song_p (np.ndarray): probability of each song to be played
+        user_p (np.ndarray): probability of each user to be active
+        nextsong_ratio (float): share of the NextSong events
+        session_offset (int): first session id of the day
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: columns of the log files
+    """
+    rng = np.random.RandomState(seed)
+    day_start = int(pd.Timestamp(day).value // 10 ** 6)
+    ts = np.sort(day_start + rng.randint(0, 24 * 3600 * 1000, n_events)).astype(np.int64)
+    user_idx = rng.choice(users.shape[0], size=n_events, p=user_p)
+    is_song = rng.rand(n_events) < nextsong_ratio
+    song_idx = rng.choice(songs.shape[0], size=n_events, p=song_p)
+    pages = np.array(_other_pages, dtype=object)[rng.choice(len(_other_pages), size=n_events, p=_other_pages_p)]
+    pages[is_song] = 'NextSong'
+
+    u = users.iloc[user_idx]
+    s = songs.iloc[song_idx]
+    level = u['level'].values.copy()
+    # some users upgrade or downgrade during the day: their events after a random time have the other level
+    changed = rng.rand(users.shape[0]) < 0.01
+    change_ts = day_start + rng.randint(0, 24 * 3600 * 1000, users.shape[0])
+    flip = changed[user_idx] & (ts >= change_ts[user_idx])
+    level[flip] = np.where(level[flip] == 'free', 'paid', 'free')
+    # a session is a user and a slot of the day
+    n_slots = max(1, int(n_events / max(users.shape[0], 1) / 20))
+    session_id = session_offset + user_idx * n_slots + (ts - day_start) * n_slots // (24 * 3600 * 1000)
+    user_id = u.index.astype(str).values.astype(object)
+    anonymous = (rng.rand(n_events) < 0.01) & ~is_song
+    user_id[anonymous] = ''
+
+    df = pd.DataFrame({
+        'artist': np.where(is_song, s['artist_name'].values, None),
+        'auth': np.where(anonymous, 'Logged Out', 'Logged In'),
+        'firstName': np.where(anonymous, None, u['firstName'].values),
+        'gender': np.where(anonymous, None, u['gender'].values),
+        'itemInSession': 0,
+        'lastName': np.where(anonymous, None, u['lastName'].values),
+        'length': np.where(is_song, s['duration'].values, np.nan),
+        'level': level,
+        'location': np.where(anonymous, None, u['location'].values),
+        'method': np.where(is_song, 'PUT', 'GET'),
+        'page': pages,
+        'registration': np.where(anonymous, np.nan, u['registration'].values),
+        'sessionId': session_id,
+        'song': np.where(is_song, s['title'].values, None),
+        'status': 200,
+        'ts': ts,
+        'userAgent': np.where(anonymous, None, u['userAgent'].values),
+        'userId': user_id
+    })
+    df['itemInSession'] = df.groupby('sessionId').cumcount()
+    # the users who changed level keep their new level the next days
+    users.loc[users.index[changed], 'level'] = np.where(users['level'].values[changed] == 'free', 'paid', 'free')
+    return df
+
+
+def write_log_data(songs, root, n_events, n_users, start=datetime.date(2018, 11, 1), days=30, song_skew=1.1,
+                   seed=0):
+    """
+    Write the events as log_data/YYYY/MM/YYYY-MM-DD-events.json files, one file per day
+    The events are generated day by day: the memory used depends on the number of events per day.
+    Args:
+        songs (pd.DataFrame): as returned by generate_songs
+        root (str): directory in which log_data is created
+        n_events (int): total number of events
+        n_users (int): number of users
+        start (datetime.date): first day
+        days (int): number of days
+        song_skew (float): skew of the song popularity (see _popularity)
+        seed (int): random seed
+
+    Returns:
+        int: number of files written
+    """
+    rng = np.random.RandomState(seed)
+    users = generate_users(n_users, seed=seed)
+    song_p = _popularity(songs.shape[0], song_skew, rng)
+    user_p = (users['activity'] / users['activity'].sum()).values
+    session_offset = 0
+    for d in range(days):
+        day = start + datetime.timedelta(days=d)
+        n_day = n_events // days + (1 if d < n_events % days else 0)
+        df = generate_day_events(day=day, n_events=n_day, songs=songs, users=users, song_p=song_p,
+                                 user_p=user_p, session_offset=session_offset, seed=seed + d + 1)
+        session_offset = int(df['sessionId'].max()) + 1 if df.shape[0] > 0 else session_offset
+        dirpath = os.path.join(root, 'log_data', '{:04d}'.format(day.year), '{:02d}'.format(day.month))
+        os.makedirs(dirpath, exist_ok=True)
+        df.to_json(os.path.join(dirpath, '{}-events.json'.format(day.isoformat())), orient='records', lines=True)
+    return days
+
+
+def generate(root, n_songs, n_events, n_users=None, days=30, songs_per_file=1, start=datetime.date(2018, 11, 1),
+             seed=0):
+    """
+    Write a song_data and a log_data tree into root
+    Args:
+        root (str): output directory
+        n_songs (int): number of songs
+        n_events (int): number of events
+        n_users (int): number of users (default: one user per 500 events, at least 100)
+        days (int): number of days of events
+        songs_per_file (int): number of songs per song file
+        start (datetime.date): first day of events
+        seed (int): random seed
+
+    Returns:
+        dict: number of song files and log files written
+    """
+    n_users = n_users if n_users is not None else max(100, n_events // 500)
+    songs = generate_songs(n_songs, seed=seed)
+    n_song_files = write_song_data(songs, root=root, songs_per_file=songs_per_file, seed=seed)
+    n_log_files = write_log_data(songs, root=root, n_events=n_events, n_users=n_users, start=start, days=days,
+                                 seed=seed)
+    return {'song_files': n_song_files, 'log_files': n_log_files}
+
+
+def main():
+    """
+    Generate a synthetic data set from the command line
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Generate synthetic song_data and log_data trees')
+    parser.add_argument('--root', required=True, help='output directory')
+    parser.add_argument('--songs', type=int, default=10000, help='number of songs')
+    parser.add_argument('--events', type=int, default=100000, help='number of events')
+    parser.add_argument('--users', type=int, default=None, help='number of users')
+    parser.add_argument('--days', type=int, default=30, help='number of days of events')
+    parser.add_argument('--songs-per-file', type=int, default=1, help='number of songs per song file')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    written = generate(root=args.root, n_songs=args.songs, n_events=args.events, n_users=args.users,
+                       days=args.days, songs_per_file=args.songs_per_file, seed=args.seed)
+    print('{} song files and {} log files written in {}'.format(written['song_files'], written['log_files'],
+                                                               args.root))
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,687 @@
+import math
+import threading
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+from sparkify_pg_code.sql_queries import user_snapshot_select
+from sparkify_pg_code.instrumentation import stage
+
+# In-process state of the dimension tables, kept up to date by the ETL during a run so that the lookups on
+# the dimensions do not need a database round trip.
+
+
+def _concat(frames, columns):
+    """
+    Concatenate a list of DataFrames, which may be empty
+    Args:
+        frames (list): list of pd.DataFrame with the columns
+        columns (list): columns of the result
+
+    Returns:
+        pd.DataFrame
+    """
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+class SongLookup(object):
+    """
+    In-memory index (title, duration, artist name) -> (song_id, artist_id), used to resolve the songplays
+    - Loaded once per run from the songs and artists tables (from_db)
+    - Kept up to date with add_songs / add_artists as the songs and artists are loaded
+    - resolve does a vectorized join, with the semantics of sql_queries.song_select: \
+    songs JOIN artists USING (artist_id) on title, duration and artist name
+    The first row loaded for a song_id (or artist_id) wins, like the ON CONFLICT DO NOTHING of the tables.
+    Thread-safe, so that it can be shared by the writers of writers.TableWriters.
+    """
+    key_cols = ['title', 'duration', 'name']
+
+    def __init__(self):
+        self._songs = []
+        self._artists = []
+        self._index = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, cur):
+        """
+        Load the index from the songs and artists tables
+        Args:
+            cur (psycopg2.cursor): cursor
+
+        Returns:
+            SongLookup
+        """
+        lookup = cls()
+        cur.execute("SELECT song_id, title, artist_id, duration FROM songs;")
+        lookup.add_songs(pd.DataFrame(data=cur.fetchall(), columns=['song_id', 'title', 'artist_id', 'duration']))
+        cur.execute("SELECT artist_id, name FROM artists;")
+        lookup.add_artists(pd.DataFrame(data=cur.fetchall(), columns=['artist_id', 'name']))
+        return lookup
+
+    def add_songs(self, song_data):
+        """
+        Args:
+            song_data (pd.DataFrame): with at least the columns song_id, title, artist_id, duration
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._songs.append(song_data[['song_id', 'title', 'artist_id', 'duration']])
+            self._index = None
+        return None
+
+    def add_artists(self, artist_data):
+        """
+        Args:
+            artist_data (pd.DataFrame): with at least the columns artist_id, name
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._artists.append(artist_data[['artist_id', 'name']])
+            self._index = None
+        return None
+
+    def _build_index(self):
+        """
+        Consolidate the songs and artists added so far and join them
+        Returns:
+            pd.DataFrame: columns title, duration, name, song_id, artist_id, unique on (title, duration, name)
+        """
+        songs = _concat(self._songs, columns=['song_id', 'title', 'artist_id', 'duration'])
+        songs = songs.drop_duplicates(subset=['song_id'])
+        artists = _concat(self._artists, columns=['artist_id', 'name']).drop_duplicates(subset=['artist_id'])
+        self._songs, self._artists = [songs], [artists]
+        songs = songs.astype({'duration': 'float64'})
+        index = songs.merge(artists, on='artist_id', how='inner')
+        index = index.dropna(subset=self.key_cols).drop_duplicates(subset=self.key_cols)
+        return index[self.key_cols + ['song_id', 'artist_id']]
+
+    def resolve(self, song_info):
+        """
+        Find the song_id and artist_id of each row
+        Args:
+            song_info (pd.DataFrame): contains the columns ['song', 'length', 'artist'] (title, duration, name)
+
+        Returns:
+            pd.DataFrame: columns ['song_id', 'artist_id'] (None when not found), same index as song_info
+        """
+        with self._lock:
+            if self._index is None:
+                self._index = self._build_index()
+            index = self._index
+        keys = pd.DataFrame({
+            'title': song_info.iloc[:, 0].values,
+            'duration': song_info.iloc[:, 1].astype('float64').values,
+            'name': song_info.iloc[:, 2].values
+        })
+        # the index is unique on the keys: the left join keeps the number and the order of the rows
+        df = keys.merge(index, on=self.key_cols, how='left')[['song_id', 'artist_id']]
+        df = df.astype(object).where(df.notnull(), None)
+        df.index = song_info.index
+        return df
+
+    def __len__(self):
+        with self._lock:
+            if self._index is None:
+                self._index = self._build_index()
+            return self._index.shape[0]
+
+
+class TimeKeySet(object):
+    """
+    Compact set of the start_time already loaded in the time table, stored as int64 milliseconds since epoch
+    - A large sorted array plus a smaller sorted array of the recent keys, merged into the large one when it \
+    grows above 1/8 of its size: adding a batch does not copy the whole set each time
+    - Membership is tested with a vectorized binary search (np.searchsorted)
+    Memory: 8 bytes per distinct start_time (plus a transient copy while merging), see estimate_nbytes. \
+    A year with 50M distinct event timestamps takes ~400 MB. The theoretical worst case of one event every \
+    millisecond of the year (31.5e9 keys) would take ~252 GB: at that density a bitmap (~3.9 GB) would be needed.
+    Thread-safe, so that it can be shared by the writers of writers.TableWriters.
+    Args:
+        keys (np.ndarray): initial keys (int64 ms), optional
+        min_recent (int): number of recent keys kept apart before merging, whatever the size of the set
+    """
+    key_bytes = np.dtype(np.int64).itemsize
+
+    def __init__(self, keys=None, min_recent=65536):
+        self.min_recent = min_recent
+        self._main = np.unique(np.asarray(keys, dtype=np.int64)) if keys is not None \
+            else np.empty(0, dtype=np.int64)
+        self._recent = np.empty(0, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, cur):
+        """
+        Load the start_time of the time table
+        Args:
+            cur (psycopg2.cursor): cursor
+
+        Returns:
+            TimeKeySet
+        """
+        cur.execute("SELECT ROUND(EXTRACT(EPOCH FROM start_time) * 1000)::BIGINT FROM time;")
+        return cls(keys=np.array([r[0] for r in cur.fetchall()], dtype=np.int64))
+
+    @staticmethod
+    def to_keys(values):
+        """
+        Convert timestamps to keys
+        Args:
+            values (pd.Series/np.ndarray): datetime64 values, or int64 milliseconds since epoch (log ts)
+
+        Returns:
+            np.ndarray: int64 milliseconds since epoch
+        """
+        values = np.asarray(values)
+        if np.issubdtype(values.dtype, np.datetime64):
+            return values.astype('datetime64[ms]').astype(np.int64)
+        return values.astype(np.int64)
+
+    @classmethod
+    def estimate_nbytes(cls, n_keys):
+        """
+        Args:
+            n_keys (int): number of distinct start_time
+
+        Returns:
+            int: memory used by the set, in bytes
+        """
+        return n_keys * cls.key_bytes
+
+    @property
+    def nbytes(self):
+        return self._main.nbytes + self._recent.nbytes
+
+    def __len__(self):
+        return self._main.shape[0] + self._recent.shape[0]
+
+    @staticmethod
+    def _isin(sorted_keys, keys):
+        if sorted_keys.shape[0] == 0:
+            return np.zeros(keys.shape[0], dtype=bool)
+        idx = np.searchsorted(sorted_keys, keys)
+        idx[idx == sorted_keys.shape[0]] = 0
+        return sorted_keys[idx] == keys
+
+    def contains(self, keys):
+        """
+        Args:
+            keys (np.ndarray): int64 keys
+
+        Returns:
+            np.ndarray: boolean mask, True for the keys already in the set
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        with self._lock:
+            return self._isin(self._main, keys) | self._isin(self._recent, keys)
+
+    def add(self, keys):
+        """
+        Args:
+            keys (np.ndarray): int64 keys
+
+        Returns:
+            None
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        with self._lock:
+            self._recent = np.union1d(self._recent, keys)
+            if self._recent.shape[0] > max(self.min_recent, self._main.shape[0] // 8):
+                self._main = np.union1d(self._main, self._recent)
+                self._recent = np.empty(0, dtype=np.int64)
+        return None
+
+    def values(self):
+        """
+        Returns:
+            np.ndarray: all the keys, sorted
+        """
+        with self._lock:
+            return np.union1d(self._main, self._recent)
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of int64 keys (e.g. 64-bit hashes of rows), in a numpy bit array
+    contains never misses a key which was added, but answers True for a key which was not added with a \
+    probability of about fp_rate (as long as at most capacity keys are added).
+    The positions of a key are derived from its two 32-bit halves (double hashing).
+    Not thread-safe: see SeenKeys.
+    Args:
+        capacity (int): number of keys the filter is sized for
+        fp_rate (float): false positive rate at capacity
+        max_bytes (int): memory budget of the bit array, optional. If fp_rate needs more, the filter takes \
+        max_bytes and fp_rate is the rate achievable at capacity (attribute fp_rate).
+    """
+
+    def __init__(self, capacity, fp_rate=1e-6, max_bytes=None):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.n_bits = int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        if max_bytes is not None and self.n_bits > 8 * max_bytes:
+            self.n_bits = max(8 * int(max_bytes), 8)
+            fp_rate = math.exp(-self.n_bits / capacity * math.log(2) ** 2)
+        self.fp_rate = fp_rate
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * math.log(2))))
+        self.n_added = 0
+        self._bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+
+    @property
+    def nbytes(self):
+        return self._bits.nbytes
+
+    def _positions(self, keys):
+        keys = np.asarray(keys, dtype=np.int64).view(np.uint64)
+        h1 = keys & np.uint64(0xffffffff)
+        h2 = (keys >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.n_hashes, dtype=np.uint64)
+        return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(self.n_bits)
+
+    def contains(self, keys):
+        """
+        Args:
+            keys (np.ndarray): int64 keys
+
+        Returns:
+            np.ndarray: boolean mask, True for the keys probably added
+        """
+        positions = self._positions(keys)
+        bits = (self._bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def add(self, keys):
+        """
+        Args:
+            keys (np.ndarray): int64 keys
+
+        Returns:
+            None
+        """
+        positions = self._positions(keys).ravel()
+        masks = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        np.bitwise_or.at(self._bits, positions >> np.uint64(3), masks)
+        self.n_added += len(keys)
+        return None
+
+
+class SeenKeys(object):
+    """
+    Keys of the rows of a dimension table already loaded, to drop the rows already in the table before they are \
+    serialized and sent (the ON CONFLICT DO NOTHING of the table would discard them anyway)
+    - The rows are identified by a 64-bit hash of their key columns
+    - Exact mode: sorted array of the hashes (TimeKeySet, 8 bytes per key), as long as it takes at most max_bytes. \
+    Exact on the hashes only: two keys with the same hash collide (a probability of about n / 2**64 per new key).
+    - Above max_bytes, the keys move to a BloomFilter sized for bloom_capacity keys (default: 4 times the keys \
+    seen so far) within max_bytes: the memory stops growing with the number of keys, but a new row is flagged as \
+    loaded with a probability of about fp_rate, raised to what max_bytes allows. The switch and the rate are \
+    recorded as the instrumentation stage seen_filter.bloom_switch.
+    - In both modes, the rows flagged are checked against the table (confirm, see etl.drop_seen_rows) before they \
+    are dropped: a collision or a false positive is sent, not lost (nor are the songplays resolved from it). \
+    Without the table, they are dropped.
+    Thread-safe, so that it can be shared by the writers of writers.TableWriters.
+    Args:
+        key_cols (list): primary key columns
+        max_bytes (int): memory of the exact mode, and of the Bloom filter
+        fp_rate (float): false positive rate of the Bloom filter, if max_bytes allows it
+        bloom_capacity (int): number of keys the Bloom filter is sized for
+        table (str): table of the keys, checked by confirm. Optional.
+    """
+
+    def __init__(self, key_cols, max_bytes=64 * 1024 ** 2, fp_rate=1e-6, bloom_capacity=None, table=None):
+        self.key_cols = key_cols
+        self.table = table
+        self.max_bytes = max_bytes
+        self.fp_rate = fp_rate
+        self.bloom_capacity = bloom_capacity
+        self._exact = TimeKeySet()
+        self._bloom = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, cur, table, key_cols, **kwargs):
+        """
+        Seed the keys from a table
+        Args:
+            cur (psycopg2.cursor): cursor
+            table (str): table
+            key_cols (list): primary key columns
+            **kwargs: max_bytes, fp_rate, bloom_capacity
+
+        Returns:
+            SeenKeys
+        """
+        cur.execute(sql.SQL("SELECT {columns} FROM {table};").format(
+            columns=sql.SQL(', ').join([sql.Identifier(c) for c in key_cols]), table=sql.Identifier(table)))
+        seen = cls(key_cols=key_cols, table=table, **kwargs)
+        seen.add(seen.keys(pd.DataFrame(data=cur.fetchall(), columns=key_cols)))
+        return seen
+
+    @property
+    def mode(self):
+        return 'exact' if self._bloom is None else 'bloom'
+
+    @property
+    def nbytes(self):
+        return self._exact.nbytes if self._bloom is None else self._bloom.nbytes
+
+    def keys(self, df):
+        """
+        Args:
+            df (pd.DataFrame): rows of the table
+
+        Returns:
+            np.ndarray: int64 hash of the key of each row
+        """
+        if df.shape[0] == 0:
+            return np.empty(0, dtype=np.int64)
+        # the keys are hashed as strings, so that the rows of the database and of the files hash the same
+        keys = df[self.key_cols].astype(str)
+        return pd.util.hash_pandas_object(keys, index=False).values.view(np.int64)
+
+    def contains(self, keys):
+        """
+        Args:
+            keys (np.ndarray): output of keys
+
+        Returns:
+            np.ndarray: boolean mask, True for the keys already loaded
+        """
+        with self._lock:
+            if self._bloom is None:
+                return self._exact.contains(keys)
+            return self._bloom.contains(keys)
+
+    def confirm(self, cur, df):
+        """
+        Check rows flagged by the Bloom filter against the table
+        Args:
+            cur (psycopg2.cursor): cursor
+            df (pd.DataFrame): rows flagged as loaded
+
+        Returns:
+            np.ndarray: boolean mask, True for the rows whose key is in the table
+        """
+        if df.shape[0] == 0:
+            return np.zeros(0, dtype=bool)
+        # selected on the first key column, matched on the hash of all of them
+        first = self.key_cols[0]
+        cur.execute(sql.SQL("SELECT {columns} FROM {table} WHERE {first} = ANY(%s);").format(
+            columns=sql.SQL(', ').join([sql.Identifier(c) for c in self.key_cols]),
+            table=sql.Identifier(self.table), first=sql.Identifier(first)),
+            (pd.unique(df[first]).tolist(),))
+        loaded = self.keys(pd.DataFrame(data=cur.fetchall(), columns=self.key_cols))
+        return np.isin(self.keys(df), loaded)
+
+    def add(self, keys):
+        """
+        Args:
+            keys (np.ndarray): output of keys, for rows loaded
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(keys)
+                return None
+            self._exact.add(keys)
+            if self._exact.nbytes > self.max_bytes:
+                exact = self._exact.values()
+                with stage('seen_filter.bloom_switch', table=self.table, rows_in=exact.shape[0]) as m:
+                    capacity = self.bloom_capacity if self.bloom_capacity is not None else 4 * exact.shape[0]
+                    self._bloom = BloomFilter(capacity=capacity, fp_rate=self.fp_rate, max_bytes=self.max_bytes)
+                    self._bloom.add(exact)
+                    self._exact = TimeKeySet()
+                    m.bytes = self._bloom.nbytes
+                    m.details = {'capacity': capacity, 'fp_rate': self._bloom.fp_rate}
+        return None
+
+
+class LatestValues(object):
+    """
+    Snapshot of the last values loaded for each key, e.g. the attributes of each user: the rows whose values are the \
+    last ones loaded for their key are dropped, the others (new key, or changed values) are kept
+    - A set of (key, values) would not do: a value which changes back (free -> paid -> free) must be sent again.
+    - With order_col (e.g. the ts of the events), the snapshot also keeps the order of the last row loaded for each \
+    key: a row older than it is dropped too (a file loaded out of order does not bring back a stale state), \
+    and add only replaces the snapshot of a key with a newer row.
+    - The snapshot is a DataFrame indexed by key: the rows of a batch are matched to it with reindex, \
+    without a python loop over the rows.
+    Exact, up to max_keys keys: the rows of the keys above are always kept (never dropped by mistake).
+    Thread-safe.
+    Args:
+        key_col (str): key column
+        value_cols (list): value columns
+        order_col (str): column ordering the rows of a key, optional. A missing order (null) is older than any row.
+        max_keys (int): maximum number of keys remembered
+    """
+
+    def __init__(self, key_col, value_cols, order_col=None, max_keys=1000000):
+        self.key_col = key_col
+        self.value_cols = value_cols
+        self.order_col = order_col
+        self.max_keys = max_keys
+        # values and order of each key, indexed by key (None: no key yet)
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, cur, query, key_col, value_cols, order_col=None, **kwargs):
+        """
+        Seed the snapshot from the database
+        Args:
+            cur (psycopg2.cursor): cursor
+            query (str): SELECT of the key, the values and the order (if order_col), in this order
+            key_col (str): key column
+            value_cols (list): value columns
+            order_col (str): order column, optional
+            **kwargs: max_keys
+
+        Returns:
+            LatestValues
+        """
+        cur.execute(query)
+        latest = cls(key_col=key_col, value_cols=value_cols, order_col=order_col, **kwargs)
+        latest.add(pd.DataFrame(data=cur.fetchall(), columns=latest._columns()))
+        return latest
+
+    def _columns(self):
+        return [self.key_col] + self.value_cols + ([self.order_col] if self.order_col is not None else [])
+
+    def __len__(self):
+        return self._snapshot.shape[0] if self._snapshot is not None else 0
+
+    def _is_older(self, orders, last_orders):
+        """
+        Args:
+            orders (pd.Series): orders of rows
+            last_orders (pd.Series): orders of the snapshot of their keys
+
+        Returns:
+            np.ndarray: boolean mask, True where both orders are known and the first one is older
+        """
+        is_older = np.zeros(len(orders), dtype=bool)
+        if self.order_col is None:
+            return is_older
+        orders, last_orders = orders.values, last_orders.values
+        known = ~(pd.isnull(orders) | pd.isnull(last_orders))
+        is_older[known] = orders[known] < last_orders[known]
+        return is_older
+
+    def keys(self, df):
+        """
+        Args:
+            df (pd.DataFrame): rows of the table, with the order column if any
+
+        Returns:
+            pd.DataFrame: key, values and order of each row
+        """
+        return df[self._columns()]
+
+    def lookup(self, key_values):
+        """
+        Args:
+            key_values (pd.Series): keys
+
+        Returns:
+            np.ndarray, pd.DataFrame: mask of the known keys, and the last values and order loaded for each key \
+            (null for the unknown keys), in the order of key_values
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                snapshot = pd.DataFrame(columns=self._columns()[1:], dtype=object)
+            return key_values.isin(snapshot.index).values, snapshot.reindex(key_values.values)
+
+    def last(self, key):
+        """
+        Args:
+            key: key
+
+        Returns:
+            tuple: (values, order) of the last row loaded for the key, None if unknown
+        """
+        with self._lock:
+            if self._snapshot is None or key not in self._snapshot.index:
+                return None
+            row = self._snapshot.loc[key]
+        order = row[self.order_col] if self.order_col is not None else None
+        return tuple(row[c] for c in self.value_cols), None if pd.isnull(order) else order
+
+    def contains(self, keys):
+        """
+        Args:
+            keys (pd.DataFrame): output of keys
+
+        Returns:
+            np.ndarray: boolean mask, True for the rows with the last values loaded for their key, or older
+        """
+        is_known, last = self.lookup(keys[self.key_col])
+        # values compared as python objects (None == None)
+        is_same = np.ones(keys.shape[0], dtype=bool)
+        for c in self.value_cols:
+            is_same &= keys[c].to_numpy(dtype=object) == last[c].to_numpy(dtype=object)
+        if self.order_col is not None:
+            is_same |= self._is_older(keys[self.order_col], last[self.order_col])
+        return is_known & is_same
+
+    def add(self, keys):
+        """
+        Args:
+            keys (pd.DataFrame): output of keys, for rows loaded (without order, the last row of a key wins)
+
+        Returns:
+            None
+        """
+        if keys.shape[0] == 0:
+            return None
+        # last row of each key: the newest one, a missing order being older than any other
+        batch = keys
+        if self.order_col is not None:
+            known = keys[self.order_col].notnull().values
+            batch = pd.concat([keys.loc[~known], keys.loc[known].sort_values(self.order_col, kind='stable')])
+        batch = batch.loc[~batch[self.key_col].duplicated(keep='last').values].set_index(self.key_col)
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = batch.iloc[:0]
+            snapshot = self._snapshot
+            is_new = ~batch.index.isin(snapshot.index)
+            if self.order_col is not None:
+                # a row older than the snapshot of its key, or without order when the snapshot has one, is ignored
+                last_orders = snapshot[self.order_col].reindex(batch.index)
+                is_stale = ~is_new & last_orders.notnull().values & (
+                    batch[self.order_col].isnull().values | self._is_older(batch[self.order_col], last_orders))
+                batch, is_new = batch.loc[~is_stale], is_new[~is_stale]
+            room = max(self.max_keys - snapshot.shape[0], 0)
+            if is_new.sum() > room:
+                # the keys above max_keys are not remembered: the first new keys of the rows are
+                key_values = keys[self.key_col]
+                first_new = pd.unique(key_values[~key_values.isin(snapshot.index)])[:room]
+                is_kept = ~is_new | batch.index.isin(first_new)
+                batch, is_new = batch.loc[is_kept], is_new[is_kept]
+            if batch.shape[0] > 0:
+                # the rows of the keys updated are replaced rather than set in place: concat finds the dtypes \
+                # of both (e.g. an order with and without nulls, categories), where .loc would cast the batch
+                if (~is_new).any():
+                    snapshot = snapshot.loc[~snapshot.index.isin(batch.index[~is_new])]
+                self._snapshot = pd.concat([snapshot, batch]) if snapshot.shape[0] > 0 else batch
+        return None
+
+
+class DimensionCache(object):
+    """
+    In-process state of the dimension tables for one ETL run, passed to the load functions of etl.py (dims)
+    Args:
+        song_lookup (SongLookup): index used to resolve the song_id and artist_id of the songplays
+        time_keys (TimeKeySet): start_time already loaded in the time table
+        seen_keys (dict): {tablename: SeenKeys or LatestValues} rows already loaded in the songs, artists and \
+        users tables, dropped before they are sent
+    """
+
+    def __init__(self, song_lookup=None, time_keys=None, seen_keys=None):
+        self.song_lookup = song_lookup
+        self.time_keys = time_keys
+        self.seen_keys = seen_keys if seen_keys is not None else {}
+        # number of reloads: the data prepared with the caches of an older generation is stale
+        self.generation = 0
+
+    @staticmethod
+    def seen_keys_from_db(cur, max_bytes=64 * 1024 ** 2):
+        """
+        Seed the seen-key filters of the songs, artists and users tables
+        Args:
+            cur (psycopg2.cursor): cursor
+            max_bytes (int): memory of the exact mode of each filter (see SeenKeys)
+
+        Returns:
+            dict: {tablename: SeenKeys or LatestValues}
+        """
+        return {
+            'songs': SeenKeys.from_db(cur, table='songs', key_cols=['song_id'], max_bytes=max_bytes),
+            'artists': SeenKeys.from_db(cur, table='artists', key_cols=['artist_id'], max_bytes=max_bytes),
+            # the level of the users is updated: a row is only dropped if the level of the user did not change
+            'users': LatestValues.from_db(cur, query=user_snapshot_select, key_col='user_id',
+                                          value_cols=['level'], order_col='ts')
+        }
+
+    @classmethod
+    def from_db(cls, cur, seen_keys=True):
+        """
+        Load the dimension state from the database
+        Args:
+            cur (psycopg2.cursor): cursor
+            seen_keys (bool): If True, also load the seen-key filters of the songs, artists and users tables
+
+        Returns:
+            DimensionCache
+        """
+        return cls(song_lookup=SongLookup.from_db(cur), time_keys=TimeKeySet.from_db(cur),
+                   seen_keys=cls.seen_keys_from_db(cur) if seen_keys else None)
+
+    def reload(self, cur):
+        """
+        Reload the state from the database, e.g. after a rollback: the rows added to the caches by the loads \
+        which were rolled back are not in the tables any more.
+        Only the caches in use (not None) are reloaded. The caches are replaced before the generation is bumped: \
+        a thread which reads the generation, then a cache, never sees a new generation with an old cache.
+        Args:
+            cur (psycopg2.cursor): cursor, in the transaction of the loads (it sees their uncommitted rows)
+
+        Returns:
+            None
+        """
+        if self.song_lookup is not None:
+            self.song_lookup = SongLookup.from_db(cur)
+        if self.time_keys is not None:
+            self.time_keys = TimeKeySet.from_db(cur)
+        if len(self.seen_keys) > 0:
+            max_bytes = min(seen.max_bytes for seen in self.seen_keys.values() if isinstance(seen, SeenKeys))
+            self.seen_keys = self.seen_keys_from_db(cur, max_bytes=max_bytes)
+        self.generation += 1
+        return None
@@ -1,39 +1,145 @@
 from sparkify_pg_code.sql_queries import *
 import pandas as pd
-from sparkify_pg_code.utils import prepare_data, connection_sparkifydb, get_all_files, sanitize_inputs, bulk_copy
+import numpy as np
+from sparkify_pg_code.utils import prepare_data, connection_sparkifydb, get_all_files, sanitize_inputs, bulk_copy, \
+    read_json_files, connection_pool_sparkifydb, iter_json_chunks, MergePolicy, insert_values, iter_files, \
+    estimate_csv_bytes
+from sparkify_pg_code.writers import TableWriters
+from sparkify_pg_code.dimensions import DimensionCache, SeenKeys
+from sparkify_pg_code.schemas import song_schema, log_schema
+from sparkify_pg_code.manifest import select_files_to_load, record_files
+from sparkify_pg_code.instrumentation import instrumented, recorder, JsonLinesSink, write_prometheus, stage
+from sparkify_pg_code.transactions import TransactionPolicy, Committer
+from sparkify_pg_code import indexes
+from sparkify_pg_code.partitions import songplays_partitions
+from sparkify_pg_code.rollups import songplays_rollups
+from sparkify_pg_code.pipeline import Pipeline
+from sparkify_pg_code.parsed_cache import ParsedCache, set_parsed_cache
+from sparkify_pg_code.analytics import bump_load_generation
 import psycopg2
+import contextlib
+import functools
+import itertools
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
+# What the bulk loads do with the rows already in the tables (see utils.MergePolicy):
+# the same semantics as the INSERT ... ON CONFLICT queries of sql_queries.py used in row mode
+merge_policies = {
+    'songs': MergePolicy.do_nothing(),
+    'artists': MergePolicy.do_nothing(),
+    'time': MergePolicy.do_nothing(),
+    'users': MergePolicy.update(columns=['level']),
+    'users_history': MergePolicy.do_nothing(),
+    'songplays': MergePolicy.do_nothing()
+}
 
-def process_song_file(cur, filepath, bulk=False):
+
+def drop_seen_rows(df, tablename, dims=None, cur=None):
+    """
+    Drop the rows already loaded in a dimension table, before they are serialized and sent (see \
+    dimensions.SeenKeys). The rows dropped and the bytes not sent are measured in the stage seen_filter.
+    The rows flagged by a SeenKeys filter (hash collisions, false positives of its Bloom filter) are checked \
+    against the table with cur: the stage seen_filter.confirm counts the rows flagged (rows_in), dropped \
+    (rows_dropped) and kept (rows_out). Without cur, all the rows flagged are dropped.
+    Args:
+        df (pd.DataFrame): rows to load
+        tablename (str): table
+        dims (DimensionCache): in-process state of the dimensions. Optional.
+        cur (psycopg2.cursor): cursor, to check the rows flagged by a SeenKeys filter. Optional.
+
+    Returns:
+        pd.DataFrame, object: rows to send, and their keys to add to the filter once loaded \
+        (None if the table has no filter)
+    """
+    seen = dims.seen_keys.get(tablename) if dims is not None else None
+    if seen is None:
+        return df, None
+    with stage('seen_filter', table=tablename, rows_in=df.shape[0]) as m:
+        keys = seen.keys(df)
+        is_seen = seen.contains(keys)
+        if isinstance(seen, SeenKeys) and is_seen.any():
+            with stage('seen_filter.confirm', table=tablename, rows_in=int(is_seen.sum())) as check:
+                if cur is not None and seen.table is not None:
+                    is_seen[is_seen] = seen.confirm(cur, df.loc[is_seen])
+                check.rows_dropped = int(is_seen.sum())
+                check.rows_out = check.rows_in - check.rows_dropped
+        if is_seen.any():
+            m.bytes = estimate_csv_bytes(df.loc[is_seen])
+            df, keys = df.loc[~is_seen], keys[~is_seen]
+        m.rows_dropped = int(is_seen.sum())
+        m.rows_out = df.shape[0]
+    return df, keys
+
+
+def transform_song_file(filepath):
+    """
+    Read the song file (or a batch of song files) and prepare the data of the songs and artists tables.
+    Does not need any database connection, so that it can run in a worker process.
+    Args:
+        filepath (str/list): path of file to process, or list of paths processed together as one batch
+
+    Returns:
+        int, dict: number of rows read, and {tablename: pd.DataFrame ready to be loaded} (empty if no rows)
+    """
+    # open song file(s)
+    df = read_json_files(filepath, schema=song_schema)
+    return df.shape[0], transform_song_rows(df)
+
+
+def transform_song_rows(df):
+    """
+    Prepare the data of the songs and artists tables from the rows of song files
+    Args:
+        df (pd.DataFrame): rows of song files
+
+    Returns:
+        dict: {tablename: pd.DataFrame ready to be loaded} (empty if no rows)
+    """
+    if df.shape[0] == 0:
+        return {}
+    tables = {
+        'songs': transform_song_data(df=df),
+        'artists': transform_artist_data(df=df)
+    }
+    return tables
+
+
+def process_song_file(cur, filepath, bulk=False, dims=None, chunksize=None):
     """
-    Update the song and artist table from the song file
+    Update the song and artist table from the song file (or from a batch of song files)
     Read the json, extract the relevant info, rename and sanitize it.
     Insert it into the artists and songs tables.
     Args:
         cur (psycopg2.cursor): cursor
-        filepath (str): path of file to process
+        filepath (str/list): path of file to process, or list of paths processed together as one batch
         bulk (bool): If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
+        chunksize (int): If provided, read and load the files by chunks of chunksize lines (bounded memory)
 
     Returns:
-        None
+        int: number of rows read
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True)
-
-    process_song_data(df=df, cur=cur, bulk=bulk)
-    process_artist_data(df=df, cur=cur, bulk=bulk)
-    return None
+    if chunksize is None:
+        n_rows, tables = transform_song_file(filepath)
+        load_tables(tables=tables, cur=cur, bulk=bulk, dims=dims)
+        return n_rows
+    n_rows = 0
+    for n_read, df in iter_json_chunks(filepath, chunksize=chunksize, schema=song_schema):
+        n_rows += n_read
+        load_tables(tables=transform_song_rows(df), cur=cur, bulk=bulk, dims=dims)
+    return n_rows
 
 
 def bulk_select_song_info(song_info, cur):
     """
     From the songs.title, songs.duration, artists.name information, return the song_id and artist_id information
-    - Create a temp table called temp_song_select
+    - Create a temp table called temp_song_select (session TEMP table, created once per connection)
     - Delete all rows from temp_song_select
     - Do a left join on the songs table on (title, duration) \
         and another left join on the artists table on (artist_id, name)
     - Select from the results the song_id and artist_id
-    - Drop the table
     - Return the information as a DataFrame
     Args:
         song_info (pd.DataFrame): contains the columns ['title', 'duration', 'name']
@@ -44,17 +150,15 @@ def bulk_select_song_info(song_info, cur):
     """
 
     try:
-        # CREATE temp TABLE
+        # CREATE the temp TABLE once per session, and empty it
         cur.execute("""
-        CREATE TABLE IF NOT exists temp_song_select
+        CREATE TEMP TABLE IF NOT exists temp_song_select
         (title VARCHAR(256),
         duration DOUBLE PRECISION,
         NAME VARCHAR(256));
+        TRUNCATE TABLE temp_song_select;
         """)
 
-        # REMOVE rows from temp table
-        cur.execute("DELETE FROM temp_song_select;")
-
         # COPY rows from data into the temp table
         bulk_copy(df=song_info, cur=cur, tablename='temp_song_select', pkey=None)
 
@@ -72,31 +176,23 @@ def bulk_select_song_info(song_info, cur):
         # Get the results in a DataFrame
         r = cur.fetchall()
         df = pd.DataFrame(data=r, columns=['song_id', 'artist_id'], index=song_info.index)
-
-        # Drop the table
-        query_drop = """
-        DROP TABLE temp_song_select;
-        """
-        cur.execute(query_drop)
         return df
     except psycopg2.Error as e:
         print(e)
         return None
 
 
-def process_song_data(df, cur, bulk=False):
+@instrumented('transform', table='songs')
+def transform_song_data(df):
     """
-    Update the songs table from the song file
+    Prepare the songs table data from the song file
     - Select the columns
     - Sanitize the inputs
-    - Update the table
     Args:
         df (pd.DataFrame): Song data file
-        cur (psycopg2.cursor): Cursor
-        bulk (bool):  If true, will use copy from instead of insert
 
     Returns:
-        None
+        pd.DataFrame
     """
     # Select the columns
     songs_cols = pd.Series(
@@ -104,20 +200,38 @@ def process_song_data(df, cur, bulk=False):
         data=['song_id', 'title', 'artist_id', 'year', 'duration'])
 
     # Sanitize the inputs
-    song_data = prepare_data(df=df, usecols=songs_cols, pkey='song_id')
+    song_data = prepare_data(df=df, usecols=songs_cols, pkey='song_id', table='songs')
+    return song_data
+
+
+@instrumented('load', table='songs')
+def load_song_data(song_data, cur, bulk=False, dims=None):
+    """
+    Update the songs table with the data prepared by transform_song_data
+    Args:
+        song_data (pd.DataFrame): output of transform_song_data
+        cur (psycopg2.cursor): Cursor
+        bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
 
-    # Update the table
+    Returns:
+        None
+    """
+    song_data, seen_keys = drop_seen_rows(song_data, tablename='songs', dims=dims, cur=cur)
     if bulk:
-        bulk_copy(df=song_data, cur=cur, tablename='songs', pkey='song_id', upsert=True)
+        bulk_copy(df=song_data, cur=cur, tablename='songs', pkey='song_id', upsert=merge_policies['songs'])
     else:
-        for (i, r) in song_data.iterrows():
-            cur.execute(song_table_insert, r)
+        insert_values(df=song_data, cur=cur, query=song_table_insert_values, table='songs')
+    if dims is not None and dims.song_lookup is not None:
+        dims.song_lookup.add_songs(song_data)
+    if seen_keys is not None:
+        dims.seen_keys['songs'].add(seen_keys)
     return None
 
 
-def process_artist_data(df, cur, bulk=False):
+def process_song_data(df, cur, bulk=False, dims=None):
     """
-    Update the artists table from the song file
+    Update the songs table from the song file
     - Select the columns
     - Sanitize the inputs
     - Update the table
@@ -125,212 +239,954 @@ def process_artist_data(df, cur, bulk=False):
         df (pd.DataFrame): Song data file
         cur (psycopg2.cursor): Cursor
         bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
 
     Returns:
         None
     """
+    load_song_data(song_data=transform_song_data(df=df), cur=cur, bulk=bulk, dims=dims)
+    return None
+
+
+@instrumented('transform', table='artists')
+def transform_artist_data(df):
+    """
+    Prepare the artists table data from the song file
+    - Select the columns
+    - Sanitize the inputs
+    Args:
+        df (pd.DataFrame): Song data file
+
+    Returns:
+        pd.DataFrame
+    """
     # Select the columns
     artist_cols = pd.Series(
         index=['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude'],
         data=['artist_id', 'name', 'location', 'latitude', 'longitude'])
 
     # Sanitize the inputs
-    artist_data = prepare_data(df=df, usecols=artist_cols, pkey='artist_id')
+    artist_data = prepare_data(df=df, usecols=artist_cols, pkey='artist_id', table='artists')
+    return artist_data
+
+
+@instrumented('load', table='artists')
+def load_artist_data(artist_data, cur, bulk=False, dims=None):
+    """
+    Update the artists table with the data prepared by transform_artist_data
+    Args:
+        artist_data (pd.DataFrame): output of transform_artist_data
+        cur (psycopg2.cursor): Cursor
+        bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
 
-    # Update the table
+    Returns:
+        None
+    """
+    artist_data, seen_keys = drop_seen_rows(artist_data, tablename='artists', dims=dims, cur=cur)
     if bulk:
-        bulk_copy(df=artist_data, cur=cur, tablename='artists', pkey='artist_id', upsert=True)
+        bulk_copy(df=artist_data, cur=cur, tablename='artists', pkey='artist_id', upsert=merge_policies['artists'])
     else:
-        for (i, r) in artist_data.iterrows():
-            cur.execute(artist_table_insert, r)
+        insert_values(df=artist_data, cur=cur, query=artist_table_insert_values, table='artists')
+    if dims is not None and dims.song_lookup is not None:
+        dims.song_lookup.add_artists(artist_data)
+    if seen_keys is not None:
+        dims.seen_keys['artists'].add(seen_keys)
     return None
 
 
-def process_time_data(df, cur, bulk=False):
+def process_artist_data(df, cur, bulk=False, dims=None):
     """
-    Update the time table from the log file
-    - convert timestamp column to datetime
-    - Prepare the time dimensions
+    Update the artists table from the song file
+    - Select the columns
+    - Sanitize the inputs
     - Update the table
     Args:
-        df (pd.DataFrame): Log file
+        df (pd.DataFrame): Song data file
         cur (psycopg2.cursor): Cursor
         bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
 
     Returns:
         None
     """
+    load_artist_data(artist_data=transform_artist_data(df=df), cur=cur, bulk=bulk, dims=dims)
+    return None
+
+
+@instrumented('transform', table='time')
+def transform_time_data(df, time_keys=None):
+    """
+    Prepare the time table data from the log file
+    - Keep the distinct timestamps, and drop the ones already loaded if time_keys is provided
+    - convert timestamp column to datetime
+    - Prepare the time dimensions
+    Args:
+        df (pd.DataFrame): Log file
+        time_keys (TimeKeySet): start_time already loaded. Optional.
+
+    Returns:
+        pd.DataFrame
+    """
+    # distinct timestamps (ms since epoch), in the order of the file, without the ones already loaded
+    keys = pd.unique(df['ts'].dropna().astype('int64'))
+    if time_keys is not None:
+        # the rows are not built yet: the bytes avoided are not measured here
+        with stage('seen_filter', table='time', rows_in=keys.shape[0]) as m:
+            keys = keys[~time_keys.contains(keys)]
+            m.rows_dropped = m.rows_in - keys.shape[0]
+            m.rows_out = keys.shape[0]
+
     # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit='ms')
-    assert isinstance(t, pd.Series)
-    t.drop_duplicates(inplace=True)
-    t.dropna(inplace=True)
+    t = pd.Series(pd.to_datetime(keys, unit='ms'))
 
     # Prepare the time dimensions
     time_df = pd.DataFrame(index=t.index)
     time_df['start_time'] = t
     time_df['hour'] = t.dt.hour
     time_df['day'] = t.dt.day
-    time_df['week'] = t.dt.weekofyear
+    time_df['week'] = t.dt.isocalendar().week.astype('int64')
     time_df['month'] = t.dt.month
     time_df['year'] = t.dt.year
     time_df['weekday'] = t.dt.weekday
     usecols = pd.Series(data=['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'])
     usecols.index = usecols.values
-    time_df = prepare_data(df=time_df, usecols=usecols, pkey=['start_time'])
+    time_df = prepare_data(df=time_df, usecols=usecols, pkey=['start_time'], table='time')
+    return time_df
+
 
-    # Update the table
+@instrumented('load', table='time')
+def load_time_data(time_df, cur, bulk=False, dims=None):
+    """
+    Update the time table with the data prepared by transform_time_data
+    The start_time already loaded are filtered by transform_time_data (with time_keys): here the start_time \
+    loaded are only added to dims.time_keys, if provided.
+    Args:
+        time_df (pd.DataFrame): output of transform_time_data
+        cur (psycopg2.cursor): Cursor
+        bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
+
+    Returns:
+        None
+    """
     if bulk:
-        bulk_copy(df=time_df, tablename='time', cur=cur, pkey='start_time', upsert=True)
+        bulk_copy(df=time_df, tablename='time', cur=cur, pkey='start_time', upsert=merge_policies['time'])
     else:
-        for i, row in time_df.iterrows():
-            cur.execute(time_table_insert, list(row))
+        insert_values(df=time_df, cur=cur, query=time_table_insert_values, table='time')
+    if dims is not None and dims.time_keys is not None:
+        dims.time_keys.add(dims.time_keys.to_keys(time_df['start_time']))
     return None
 
 
-def process_user_data(df, cur, bulk=False):
+def process_time_data(df, cur, bulk=False, dims=None):
     """
-    Update the user table from the log file
-    - Select the columns
-    - Remove incorrect UserId rows and clean the data
+    Update the time table from the log file
+    - drop the timestamps already loaded (if dims.time_keys is provided)
+    - convert timestamp column to datetime
+    - Prepare the time dimensions
     - Update the table
     Args:
         df (pd.DataFrame): Log file
         cur (psycopg2.cursor): Cursor
         bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
 
     Returns:
         None
     """
+    time_keys = dims.time_keys if dims is not None else None
+    load_time_data(time_df=transform_time_data(df=df, time_keys=time_keys), cur=cur, bulk=bulk, dims=dims)
+    return None
+
+
+@instrumented('transform', table='users')
+def transform_user_data(df):
+    """
+    Prepare the users table data from the log file
+    - Select the columns
+    - Remove incorrect UserId rows and clean the data
+    - Order the rows of each user by ts, and keep the rows where the level of the user changes, \
+    and the last row of each user (its latest state)
+    Args:
+        df (pd.DataFrame): Log file
+
+    Returns:
+        pd.DataFrame: columns user_id, first_name, last_name, gender, level, ts (datetime), \
+        ordered by user_id and ts (see user_latest_state and user_level_changes)
+    """
     # Select cols
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level', 'ts']]
     # Remove incorrect UserId rows and clean the data
     user_df = user_df.loc[~user_df['userId'].isnull()]
     user_df = user_df.loc[~(user_df['userId'] == 0)]
-    user_df = user_df.loc[user_df['userId'].astype(str).str.len() > 0]
+    if user_df['userId'].dtype == object:
+        # without schema, empty userId are read as empty strings
+        user_df = user_df.loc[user_df['userId'].astype(str).str.len() > 0]
+    # rows of each user by ts: only the level changes and the latest state are kept
+    user_df = user_df.sort_values(['userId', 'ts'], kind='stable')
+    user_id, level = user_df['userId'].astype(object), user_df['level'].astype(object)
+    is_change = (user_id != user_id.shift()) | (level != level.shift())
+    is_last = user_id != user_id.shift(-1)
+    user_df = user_df.loc[is_change | is_last].copy()
+    user_df['ts'] = pd.to_datetime(user_df['ts'], unit='ms')
     user_cols = pd.Series(
-        index=['userId', 'firstName', 'lastName', 'gender', 'level'],
-        data=['user_id', 'first_name', 'last_name', 'gender', 'level'])
-    user_df = prepare_data(df=user_df, usecols=user_cols, pkey=['user_id'])
+        index=['userId', 'firstName', 'lastName', 'gender', 'level', 'ts'],
+        data=['user_id', 'first_name', 'last_name', 'gender', 'level', 'ts'])
+    user_df = prepare_data(df=user_df, usecols=user_cols, pkey=['user_id', 'ts'], table='users')
+    return user_df
+
+
+def user_latest_state(user_df):
+    """
+    Args:
+        user_df (pd.DataFrame): output of transform_user_data
+
+    Returns:
+        pd.DataFrame: last row of each user (columns of the users table, and ts)
+    """
+    return user_df.drop_duplicates(subset=['user_id'], keep='last')
+
+
+def user_level_changes(user_df, dims=None):
+    """
+    Level changes of the users, to record in the users_history table
+    The first row of a user is a change unless the level is the one of the snapshot of the user \
+    (dims.seen_keys['users']) and the row is not older than the snapshot.
+    Args:
+        user_df (pd.DataFrame): output of transform_user_data
+        dims (DimensionCache): in-process state of the dimensions. Optional.
+
+    Returns:
+        pd.DataFrame: columns user_id, level, valid_from, valid_to (null)
+    """
+    user_id, level = user_df['user_id'].astype(object), user_df['level'].astype(object)
+    is_first = (user_id != user_id.shift()).values
+    is_change = is_first | (level != level.shift()).values
+    snapshot = dims.seen_keys.get('users') if dims is not None else None
+    if snapshot is not None:
+        first = user_df.loc[is_first]
+        is_known, last = snapshot.lookup(first['user_id'])
+        last_ts = last[snapshot.order_col]
+        has_ts = is_known & last_ts.notnull().values
+        is_same = np.zeros(first.shape[0], dtype=bool)
+        is_same[has_ts] = (first['ts'].values[has_ts] >= last_ts.values[has_ts]) & \
+            (first['level'].to_numpy(dtype=object)[has_ts] == last['level'].to_numpy(dtype=object)[has_ts])
+        is_change[np.flatnonzero(is_first)[is_same]] = False
+    changes = user_df.loc[is_change, ['user_id', 'level', 'ts']].rename(columns={'ts': 'valid_from'})
+    changes['valid_to'] = pd.NaT
+    return changes
+
 
-    # Update the table
+@instrumented('load', table='users')
+def load_user_data(user_df, cur, bulk=False, dims=None):
+    """
+    Update the users table and the users_history table with the data prepared by transform_user_data
+    - users: the latest state of each user, only for the users whose level changed since the snapshot \
+    dims.seen_keys['users'] (all of them without dims). As in row mode (user_table_insert), the merge only \
+    updates the level of the users already in the table: their first row sets the other attributes.
+    - users_history: the level changes, then the history of the users concerned is merged (user_history_merge)
+    Args:
+        user_df (pd.DataFrame): output of transform_user_data
+        cur (psycopg2.cursor): Cursor
+        bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
+
+    Returns:
+        None
+    """
+    changes = user_level_changes(user_df, dims=dims)
+    latest, seen_keys = drop_seen_rows(user_latest_state(user_df), tablename='users', dims=dims, cur=cur)
+    latest = latest.drop(columns=['ts'])
     if bulk:
-        bulk_copy(df=user_df, tablename='users', cur=cur, pkey='user_id')
+        bulk_copy(df=latest, tablename='users', cur=cur, pkey='user_id', upsert=merge_policies['users'])
+        bulk_copy(df=changes, tablename='users_history', cur=cur, pkey=['user_id', 'valid_from'],
+                  upsert=merge_policies['users_history'])
     else:
-        for (i, r) in user_df.iterrows():
-            cur.execute(user_table_insert, r)
+        insert_values(df=latest, cur=cur, query=user_table_insert_values, table='users')
+        insert_values(df=changes[['user_id', 'level', 'valid_from']], cur=cur, query=user_history_insert_values,
+                      table='users_history')
+    if changes.shape[0] > 0:
+        with stage('users_history.merge', table='users_history', rows_in=changes.shape[0]):
+            cur.execute(user_history_merge, {'user_ids': [int(u) for u in pd.unique(changes['user_id'])]})
+    if seen_keys is not None:
+        dims.seen_keys['users'].add(seen_keys)
     return None
 
 
-def process_songplays_data(df, cur, bulk=False):
+def process_user_data(df, cur, bulk=False, dims=None):
     """
-    Update the songplays table from the log file
+    Update the user table from the log file
     - Select the columns
-    - Convert ts to datetime
-    - Do a join with song and artist table to return the song_id and artist_id
+    - Remove incorrect UserId rows and clean the data
     - Update the table
     Args:
         df (pd.DataFrame): Log file
         cur (psycopg2.cursor): Cursor
         bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
 
     Returns:
         None
     """
-    if bulk:
-        # Select the columns
-        songplay_df = df[
-            ['ts', 'userId', 'level', 'sessionId', 'location', 'userAgent', 'song', 'artist', 'length']].copy()
-        # Convert to datetime
-        songplay_df['start_time'] = pd.to_datetime(songplay_df['ts'], unit='ms')
+    load_user_data(user_df=transform_user_data(df=df), cur=cur, bulk=bulk, dims=dims)
+    return None
+
 
+@instrumented('transform', table='songplays')
+def transform_songplays_data(df):
+    """
+    Prepare the songplays table data from the log file, except song_id and artist_id which need the database
+    - Select the columns
+    - Convert ts to datetime
+    - Sanitize the inputs
+    Args:
+        df (pd.DataFrame): Log file
+
+    Returns:
+        pd.DataFrame: songplays columns without song_id and artist_id, \
+        followed by the lookup columns ['song', 'length', 'artist']
+    """
+    # Select the columns
+    songplay_df = df[
+        ['ts', 'userId', 'level', 'sessionId', 'location', 'userAgent', 'song', 'length', 'artist']].copy()
+    # Convert to datetime
+    songplay_df['start_time'] = pd.to_datetime(songplay_df['ts'], unit='ms')
+
+    # Prepare data
+    usecols = pd.Series(
+        index=['start_time', 'userId', 'level', 'sessionId', 'location', 'userAgent', 'song', 'length', 'artist'],
+        data=['start_time', 'user_id', 'level', 'session_id', 'location', 'user_agent', 'song', 'length', 'artist'])
+    songplay_df = prepare_data(df=songplay_df, usecols=usecols, pkey=['start_time', 'user_id'], table='songplays')
+    return songplay_df
+
+
+@instrumented('load', table='songplays')
+def load_songplays_data(songplay_df, cur, bulk=False, dims=None):
+    """
+    Update the songplays table with the data prepared by transform_songplays_data
+    - Do a join with song and artist table to return the song_id and artist_id \
+    (in memory with dims.song_lookup if provided, else in the database)
+    - Create the monthly partitions of the rows which do not exist yet (see partitions.py)
+    - Update the table (in bulk, the rows are copied directly into their partition)
+    - Add the rows inserted to the rollups, in the same statement (see rollups.py)
+    Args:
+        songplay_df (pd.DataFrame): output of transform_songplays_data
+        cur (psycopg2.cursor): Cursor
+        bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
+
+    Returns:
+        None
+    """
+    songplay_cols = ['start_time', 'user_id', 'level', 'song_id', 'artist_id', 'session_id', 'location', 'user_agent']
+    if dims is not None and dims.song_lookup is not None:
+        # Resolve the song_id and artist_id in memory, without database round trip
+        add_info = dims.song_lookup.resolve(song_info=songplay_df[['song', 'length', 'artist']])
+        songplay_df = songplay_df.copy()
+        songplay_df['song_id'] = add_info['song_id']
+        songplay_df['artist_id'] = add_info['artist_id']
+        if bulk:
+            bulk_copy(df=songplay_df[songplay_cols], cur=cur, tablename='songplays', pkey=['start_time', 'user_id'],
+                      upsert=merge_policies['songplays'], partitions=songplays_partitions,
+                      rollups=songplays_rollups)
+        else:
+            songplays_partitions.ensure(cur=cur, values=songplay_df['start_time'])
+            insert_values(df=songplay_df[songplay_cols], cur=cur,
+                          query=songplays_rollups.wrap(songplay_table_insert_values), table='songplays')
+
+    elif bulk:
         # Do a join with song and artist table to return the song_id and artist_id
         add_info = bulk_select_song_info(song_info=songplay_df[['song', 'length', 'artist']], cur=cur)
+        songplay_df = songplay_df.copy()
         songplay_df['song_id'] = add_info['song_id']
         songplay_df['artist_id'] = add_info['artist_id']
 
-        # Prepare data
-        usecols = pd.Series(
-            index=['start_time', 'userId', 'level', 'song_id', 'artist_id', 'sessionId', 'location', 'userAgent'],
-            data=['start_time', 'user_id', 'level', 'song_id', 'artist_id', 'session_id', 'location', 'userAgent'])
-        songplay_df = prepare_data(df=songplay_df, usecols=usecols, pkey=['start_time', 'user_id'])
-
         # Update the table
-        bulk_copy(df=songplay_df, cur=cur, tablename='songplays', pkey=['start_time', 'user_id'])
+        bulk_copy(df=songplay_df[songplay_cols], cur=cur, tablename='songplays', pkey=['start_time', 'user_id'],
+                      upsert=merge_policies['songplays'], partitions=songplays_partitions,
+                      rollups=songplays_rollups)
 
     else:
-        # insert songplay records
-        for index, row in df.iterrows():
+        # insert songplay records by pages: the song_id and artist_id of the rows of a page are found by the \
+        # same statement (one round trip per page instead of two per row)
+        songplays_partitions.ensure(cur=cur, values=songplay_df['start_time'])
+        insert_values(df=songplay_df, cur=cur, query=songplays_rollups.wrap(songplay_table_insert_select),
+                      template=songplay_select_template, table='songplays')
+    return None
 
-            # get songid and artistid from song and artist tables
-            cur.execute(song_select, (row.song,  row.length, row.artist))
-            results = cur.fetchone()
 
-            if results:
-                songid, artistid = results
-            else:
-                songid, artistid = None, None
+def process_songplays_data(df, cur, bulk=False, dims=None):
+    """
+    Update the songplays table from the log file
+    - Select the columns
+    - Convert ts to datetime
+    - Do a join with song and artist table to return the song_id and artist_id
+    - Update the table
+    Args:
+        df (pd.DataFrame): Log file
+        cur (psycopg2.cursor): Cursor
+        bulk (bool):  If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
+
+    Returns:
+        None
+    """
+    load_songplays_data(songplay_df=transform_songplays_data(df=df), cur=cur, bulk=bulk, dims=dims)
+    return None
+
+
+def transform_log_file(filepath, time_keys=None):
+    """
+    Read the log file (or a batch of log files) and prepare the data of the time, users and songplays tables.
+    Does not need any database connection, so that it can run in a worker process.
+    Args:
+        filepath (str/list): path of file to process, or list of paths processed together as one batch
+        time_keys (TimeKeySet): start_time already loaded, not derived again. Optional.
+
+    Returns:
+        int, dict: number of rows read, and {tablename: pd.DataFrame ready to be loaded} (empty if no rows)
+    """
+    # open log file(s)
+    df = read_json_files(filepath, schema=log_schema)
+    return df.shape[0], transform_log_rows(df, time_keys=time_keys)
 
-            # Prepare the data
-            start_time = pd.Timestamp(row['ts'], unit='ms')
-            songplay_data = (
-                start_time, row['userId'], row['level'], songid, artistid, row['sessionId'], row['location'],
-                row['userAgent'])
-            songplay_data = [sanitize_inputs(c) for c in songplay_data]
-            # insert songplay record
-            cur.execute(songplay_table_insert, songplay_data)
 
+def transform_log_rows(df, time_keys=None):
+    """
+    Prepare the data of the time, users and songplays tables from the rows of log files
+    Args:
+        df (pd.DataFrame): rows of log files
+        time_keys (TimeKeySet): start_time already loaded, not derived again. Optional.
 
-def process_log_file(cur, filepath, bulk=False):
+    Returns:
+        dict: {tablename: pd.DataFrame ready to be loaded} (empty if no rows)
     """
-    Update the time, user and songplays table from the log file
+    if df.shape[0] == 0:
+        return {}
+
+    # filter by NextSong action
+    df = df.loc[df['page'] == 'NextSong']
+
+    tables = {
+        'time': transform_time_data(df=df, time_keys=time_keys),
+        'users': transform_user_data(df=df),
+        'songplays': transform_songplays_data(df=df)
+    }
+    return tables
+
+
+def process_log_file(cur, filepath, bulk=False, dims=None, chunksize=None):
+    """
+    Update the time, user and songplays table from the log file (or from a batch of log files)
     Read the json, extract the relevant info, rename and sanitize it.
     Insert it into the time, user, and songplays tables.
+    With chunksize, the files are streamed by chunks of lines: the peak memory depends on the chunk size and \
+    not on the size of the files.
     Args:
         cur (psycopg2.cursor): cursor
-        filepath (str): path of file to process
+        filepath (str/list): path of file to process, or list of paths processed together as one batch
         bulk (bool): If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
+        chunksize (int): If provided, read and load the files by chunks of chunksize lines
 
     Returns:
-        None
+        int: number of rows read
     """
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    time_keys = dims.time_keys if dims is not None else None
+    if chunksize is None:
+        n_rows, tables = transform_log_file(filepath, time_keys=time_keys)
+        load_tables(tables=tables, cur=cur, bulk=bulk, dims=dims)
+        return n_rows
+    # streaming: only the lines of NextSong events are parsed, and each chunk goes through all the tables
+    n_rows = 0
+    for n_read, df in iter_json_chunks(filepath, chunksize=chunksize, contains='NextSong', schema=log_schema):
+        n_rows += n_read
+        load_tables(tables=transform_log_rows(df, time_keys=time_keys), cur=cur, bulk=bulk, dims=dims)
+    return n_rows
 
-    # filter by NextSong action
-    df = df.loc[df['page'] == 'NextSong']
 
-    # Process time data
-    process_time_data(df=df, cur=cur, bulk=bulk)
-    process_user_data(df=df, cur=cur, bulk=bulk)
-    process_songplays_data(df=df, cur=cur, bulk=bulk)
+# For each table, the function loading the prepared data into the database
+table_loaders = {
+    'songs': load_song_data,
+    'artists': load_artist_data,
+    'time': load_time_data,
+    'users': load_user_data,
+    'songplays': load_songplays_data
+}
+
+# Tables which must be written (and visible) before a table is loaded: songplays looks up songs and artists
+table_dependencies = {
+    'songplays': ['songs', 'artists']
+}
+
+# For each file processing function, the database-free function preparing the data (can run in a worker process)
+file_transforms = {
+    process_song_file: transform_song_file,
+    process_log_file: transform_log_file
+}
+
+# For each file processing function, the schema of the files and the database-free function preparing the rows \
+# (process_data_pipelined: the files are read and the rows transformed in threads of their own)
+file_row_transforms = {
+    process_song_file: (song_schema, transform_song_rows),
+    process_log_file: (log_schema, transform_log_rows)
+}
+
+
+def read_batch(batch, schema):
+    """
+    Read stage of process_data_pipelined
+    Args:
+        batch (list): paths of the files
+        schema (dict): declared schema of the files (see schemas.py)
+
+    Returns:
+        list, pd.DataFrame: the batch and the rows of its files
+    """
+    return batch, read_json_files(batch, schema=schema)
+
+
+def transform_batch(item, func, dims=None):
+    """
+    Transform stage of process_data_pipelined
+    The in-process state of the dimensions is read when the batch is transformed (dims.time_keys is replaced \
+    by dims.reload), and the batch is tagged with its generation (see fresh_batches).
+    Args:
+        item (tuple): (batch, rows of the files), output of read_batch
+        func: process function (process_song_file or process_log_file)
+        dims (DimensionCache): in-process state of the dimensions, shared with the load thread. Optional.
+
+    Returns:
+        list, tuple, int: the batch, (rows read, tables) as expected by load_batch, and the generation of dims \
+        (None without dims)
+    """
+    batch, df = item
+    # the generation first: if dims is reloaded in between, the batch is seen as stale
+    generation = dims.generation if dims is not None else None
+    _, transform_rows = file_row_transforms[func]
+    return batch, (df.shape[0], transform_rows(df, **transform_kwargs(func, dims))), generation
+
+
+def fresh_batches(items, dims=None):
+    """
+    Drop the tables of the batches transformed before the last reload of dims (a batch rolled back meanwhile): \
+    they were filtered with the state of the rolled back loads, e.g. without the time rows of its start_time. \
+    load_batch reads the files of these batches again.
+    Args:
+        items (iterable): (batch, transformed, generation), output of transform_batch
+        dims (DimensionCache): in-process state of the dimensions. Optional.
+
+    Returns:
+        generator: (batch, transformed), transformed being None for the stale batches
+    """
+    for batch, transformed, generation in items:
+        if dims is not None and generation != dims.generation:
+            with stage('pipeline.stale_batch', rows_in=transformed[0]) as m:
+                m.rows_dropped = transformed[0]
+            transformed = None
+        yield batch, transformed
+
+
+def transform_kwargs(func, dims=None):
+    """
+    Arguments of the transform of the files of func which use the in-process state of the dimensions: \
+    the log files are transformed with the start_time already loaded (dims.time_keys), not derived again
+    Args:
+        func: process function (process_song_file or process_log_file)
+        dims (DimensionCache): in-process state of the dimensions. Optional.
+
+    Returns:
+        dict: keyword arguments of the transform
+    """
+    if func is process_log_file and dims is not None and dims.time_keys is not None:
+        return {'time_keys': dims.time_keys}
+    return {}
+
+
+def drop_loaded_time_rows(tables, time_keys=None):
+    """
+    Drop the rows of the time table already loaded from tables transformed without time_keys \
+    (in worker processes, which do not share the in-process state of the parent)
+    Args:
+        tables (dict): {tablename: pd.DataFrame}, as returned by transform_log_file
+        time_keys (TimeKeySet): start_time already loaded. Optional.
+
+    Returns:
+        dict: tables, without the time rows already loaded
+    """
+    if time_keys is None or 'time' not in tables:
+        return tables
+    time_df = tables['time']
+    with stage('seen_filter', table='time', rows_in=time_df.shape[0]) as m:
+        is_seen = time_keys.contains(time_keys.to_keys(time_df['start_time']))
+        if is_seen.any():
+            m.bytes = estimate_csv_bytes(time_df.loc[is_seen])
+        m.rows_dropped = int(is_seen.sum())
+        m.rows_out = time_df.shape[0] - m.rows_dropped
+    return dict(tables, time=time_df.loc[~is_seen])
+
+
+def pipeline_stages(func, dims=None):
+    """
+    Read and transform stages of process_data_pipelined
+    Args:
+        func: process function (process_song_file or process_log_file)
+        dims (DimensionCache): in-process state of the dimensions, shared with the transform thread. Optional.
+
+    Returns:
+        list: list of (name, function) for pipeline.Pipeline
+    """
+    schema, _ = file_row_transforms[func]
+    return [('read', functools.partial(read_batch, schema=schema)),
+            ('transform', functools.partial(transform_batch, func=func, dims=dims))]
+
+
+def load_tables(tables, cur, bulk=False, dims=None):
+    """
+    Load the prepared data into the database, in the order of the tables dict
+    Args:
+        tables (dict): {tablename: pd.DataFrame}, as returned by transform_song_file or transform_log_file
+        cur (psycopg2.cursor): Cursor
+        bulk (bool): If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions (see dimensions.py). Optional.
+
+    Returns:
+        None
+    """
+    for tablename, data in tables.items():
+        table_loaders[tablename](data, cur=cur, bulk=bulk, dims=dims)
     return None
 
 
-def process_data(cur, conn, filepath, func, bulk=False):
+def iter_transformed(transform, batches, workers):
     """
-    Process (Update) the data for each of the files detected in filepath.
+    Run transform on each batch of files in a pool of worker processes, and yield the results in the order of \
+    the batches, so that the result of a parallel run is the same as the one of a sequential run.
+    At most 2 * workers batches are in flight, so that the memory stays bounded if the database is slower than \
+    the workers.
+    Args:
+        transform: transform_song_file or transform_log_file
+        batches (iterable): batches (lists of file paths)
+        workers (int): number of worker processes
+
+    Returns:
+        generator: yields (batch, (n_rows, tables))
+    """
+    max_in_flight = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for batch in batches:
+            pending.append((batch, executor.submit(transform, batch)))
+            if len(pending) >= max_in_flight:
+                done_batch, future = pending.pop(0)
+                yield done_batch, future.result()
+        for done_batch, future in pending:
+            yield done_batch, future.result()
+
+
+def load_batch(cur, batch, transformed, func, committer, bulk=False, dims=None, chunksize=None, fingerprints=None):
+    """
+    Load a batch of files, and record them in the load manifest in the same transaction
+    With the savepoints of the transaction policy, a batch which fails is rolled back to its savepoint and its \
+    files are loaded again one by one: only the files which still fail are skipped, the other files of the \
+    transaction are kept. The dimension caches are reloaded after a rollback.
+    Args:
+        cur (psycopg2.cursor): cursor
+        batch (list): paths of the files
+        transformed (tuple): (rows read, tables) if the batch was already transformed, else None
+        func: process function (process_song_file or process_log_file)
+        committer (transactions.Committer): transaction of the loads
+        bulk (bool): If true, will use copy from instead of insert
+        dims (DimensionCache): in-process state of the dimensions
+        chunksize (int): If provided, func streams the files by chunks of chunksize lines
+        fingerprints (dict): {path: fingerprint} of the files to record in the load manifest. If None, no record.
+
+    Returns:
+        int, list: number of rows read, and the paths of the files which failed
+    """
+    try:
+        with committer.savepoint(cur):
+            if transformed is None:
+                n_rows = func(cur, batch, bulk=bulk, dims=dims, chunksize=chunksize)
+            else:
+                n_rows, tables = transformed
+                load_tables(tables=tables, cur=cur, bulk=bulk, dims=dims)
+            if fingerprints is not None:
+                record_files(cur, [fingerprints[f] for f in batch])
+        return n_rows, []
+    except Exception as e:
+        if not committer.savepoints:
+            raise
+        print('Error: could not load {} file(s) from {}, rolled back: {}'.format(len(batch), batch[0], e))
+        # the partitions created by the batch were rolled back with it
+        songplays_partitions.forget()
+        if dims is not None:
+            dims.reload(cur)
+        if len(batch) == 1:
+            return 0, list(batch)
+        n_rows, failed = 0, []
+        for f in batch:
+            file_rows, file_failed = load_batch(cur, [f], None, func, committer, bulk=bulk, dims=dims,
+                                                chunksize=chunksize, fingerprints=fingerprints)
+            n_rows += file_rows
+            failed += file_failed
+        return n_rows, failed
+
+
+def iter_batches(files, batch_size):
+    """
+    Group the files into batches, as they are found
+    Args:
+        files (iterable): paths of the files (list or generator, e.g. utils.iter_files)
+        batch_size (int): number of files per batch
+
+    Returns:
+        generator: lists of at most batch_size paths
+    """
+    files = iter(files)
+    while True:
+        batch = list(itertools.islice(files, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def find_files_to_load(cur, conn, filepath, incremental=False, force_prefix=None, start_date=None, end_date=None,
+                       lazy=False):
+    """
+    Files to process in filepath, in the order of their paths
     Args:
         cur (psycopg2.cursor): cursor
         conn (psycopg2.connection): connection
         filepath (str): filepath of root folder for files
-        func: transformation func, either from log_file or song_file
-        bulk (bool): If true, will use copy from instead of insert
+        incremental (bool): If True, only the files which are new or changed according to the load manifest
+        force_prefix (str): with incremental, reload all the files under this path prefix
+        start_date (str/datetime.date): first day of the log files (included). Optional.
+        end_date (str/datetime.date): last day of the log files (included). Optional.
+        lazy (bool): If True (and not incremental), the files are found as they are iterated (utils.iter_files)
 
     Returns:
-        None
+        iterable, int, dict: the paths of the files, their number (None if lazy) and their fingerprints \
+        by path (empty without incremental)
     """
-    all_files = get_all_files(filepath)
+    if lazy and not incremental:
+        print('Discovering the files in {}'.format(filepath))
+        return iter_files(filepath, start_date=start_date, end_date=end_date), None, {}
+    all_files = get_all_files(filepath, start_date=start_date, end_date=end_date)
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
-
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile, bulk=bulk)
+    fingerprints = {}
+    if incremental:
+        fingerprints = {f['path']: f for f in select_files_to_load(cur, all_files, force_prefix=force_prefix)}
+        all_files = list(fingerprints.keys())
+        num_files = len(all_files)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
-    return None
+        print('{} new or changed files to load'.format(num_files))
+    return all_files, num_files, fingerprints
+
+
+def load_results(cur, results, func, committer, num_files=None, bulk=False, pool=None, max_pending=2,
+                 incremental=False, fingerprints=None, dims=None, chunksize=None):
+    """
+    Load the batches of files in the order they are produced, and commit them according to the committer
+    Args:
+        cur (psycopg2.cursor): cursor
+        results (iterable): (batch, transformed) pairs, transformed being None if load_batch reads the files, \
+        else (rows read, tables)
+        func: process function (process_song_file or process_log_file)
+        committer (transactions.Committer): commits of the loads
+        num_files (int): number of files, printed with the progress. None if unknown.
+        bulk (bool): If true, will use copy from instead of insert
+        pool (psycopg2.pool.ThreadedConnectionPool): If provided, write the tables concurrently with this pool
+        max_pending (int): with pool, maximum number of batches waiting to be written for each table
+        incremental (bool): If True, record the loaded files in the load manifest
+        fingerprints (dict): with incremental, fingerprints of the files by path
+        dims (DimensionCache): in-process state of the dimensions. Optional.
+        chunksize (int): If provided, func streams the files by chunks of chunksize lines
+
+    Returns:
+        dict: {'files': int, 'rows': int, 'seconds': float, 'commits': int, 'failed': list}, see process_data
+    """
+    writers = None
+    if pool is not None:
+        writers = TableWriters(pool=pool, loaders=table_loaders, bulk=bulk, dependencies=table_dependencies,
+                               max_pending=max_pending, load_kwargs={'dims': dims})
+
+    # iterate over batches of files and process
+    n_done, n_rows, failed = 0, 0, []
+    t_start = time.perf_counter()
+    try:
+        for batch, transformed in results:
+            if writers is None:
+                batch_rows, batch_failed = load_batch(cur, batch, transformed, func, committer, bulk=bulk, dims=dims,
+                                                      chunksize=chunksize,
+                                                      fingerprints=fingerprints if incremental else None)
+                failed += batch_failed
+                committer.done(len(batch))
+            else:
+                batch_rows, tables = transformed
+                writers.submit(tables)
+            n_rows += batch_rows
+            n_done += len(batch)
+            elapsed = max(time.perf_counter() - t_start, 1e-9)
+            print('{}/{} files processed. ({:.1f} files/s, {:.1f} rows/s)'.format(
+                n_done, num_files if num_files is not None else '?', n_done / elapsed, n_rows / elapsed))
+        if writers is None:
+            # files loaded since the last commit (per N files, per run)
+            committer.commit()
+    except Exception:
+        # the files of the transaction in progress are not loaded (nor recorded in the manifest)
+        committer.rollback()
+        songplays_partitions.forget()
+        raise
+    finally:
+        if writers is not None:
+            # wait for the writers: the tables must be complete when the load returns
+            writers.close(raise_errors=sys.exc_info()[0] is None)
+    if writers is not None:
+        if incremental:
+            record_files(cur, list(fingerprints.values()))
+        # the writers committed the tables: commit the loaded files (before_commit, e.g. the load generation)
+        committer.done(n_done)
+        committer.commit()
+        elapsed = max(time.perf_counter() - t_start, 1e-9)
+        print('{} files written. ({:.1f} files/s, {:.1f} rows/s)'.format(
+            n_done, n_done / elapsed, n_rows / elapsed))
+    if len(failed) > 0:
+        print('{} file(s) could not be loaded: {}'.format(len(failed), failed))
+    return {'files': n_done, 'rows': n_rows, 'seconds': time.perf_counter() - t_start,
+            'commits': committer.n_commits, 'failed': failed}
+
+
+def process_data(cur, conn, filepath, func, bulk=False, batch_size=1, workers=None, pool=None, max_pending=2,
+                 incremental=False, force_prefix=None, dims=None, chunksize=None, transactions=None,
+                 start_date=None, end_date=None, before_commit=None):
+    """
+    Process (Update) the data for each of the files detected in filepath.
+    - The files are processed by batches of batch_size files: the files of a batch are read and concatenated, \
+    then each table is updated once for the whole batch (one staging / upsert cycle per table in bulk mode)
+    - If workers is provided, the files are read and transformed in a pool of worker processes; \
+    the main process is the only one writing to the database, in the order of the batches.
+    - The files are processed in the order of their paths. With start_date / end_date, only the log files of \
+    these days are processed, without walking the directories of the other years and months.
+    - If pool is provided, the tables are written concurrently by one writer thread per table \
+    (see writers.TableWriters), each with its own connection from the pool; cur and conn are only used for the \
+    load manifest. songplays is written only after the songs and artists submitted before it.
+    - If incremental, only the files which are new or changed since they were recorded in the load manifest are \
+    processed (see manifest.select_files_to_load), and each file is recorded in the manifest once loaded. \
+    With pool, the files are recorded once all the writers are done.
+    - The loads are committed according to the transactions policy (see transactions.TransactionPolicy): \
+    per statement, per file, per N files or per run, with a savepoint per batch so that a bad file is skipped \
+    without losing the rest of the transaction. The time of each commit is measured (instrumentation stage 'commit'). \
+    before_commit runs in the transaction of each commit of loaded files: main passes \
+    analytics.bump_load_generation, which invalidates the cached analytics (and needs the load_generation table).
+    - Print the progress and the throughput (files/s and rows/s)
+    See process_data_pipelined to read and transform the next batches in threads while a batch is loaded.
+    Args:
+        cur (psycopg2.cursor): cursor
+        conn (psycopg2.connection): connection
+        filepath (str): filepath of root folder for files
+        func: transformation func, either from log_file or song_file
+        bulk (bool): If true, will use copy from instead of insert
+        batch_size (int): number of files processed together
+        workers (int): number of worker processes used to read and transform the files. If None, no worker.
+        pool (psycopg2.pool.ThreadedConnectionPool): If provided, write the tables concurrently with this pool
+        max_pending (int): with pool, maximum number of batches waiting to be written for each table
+        incremental (bool): If True, skip the files already loaded according to the load manifest
+        force_prefix (str): with incremental, reload all the files under this path prefix
+        dims (DimensionCache): in-process state of the dimensions, e.g. to resolve the songplays in memory
+        chunksize (int): If provided, func streams the files by chunks of chunksize lines (bounded memory). \
+        Only used when the files are processed in the main process (no workers, no pool).
+        transactions (TransactionPolicy): when to commit the loads. If None, commit after each batch, \
+        in the autocommit mode of conn. With pool, the writers commit each load on their own connection.
+        start_date (str/datetime.date): first day of the log files to process (included). Optional.
+        end_date (str/datetime.date): last day of the log files to process (included). Optional.
+        before_commit (callable): before_commit(conn), called before each commit of loaded files \
+        (see transactions.Committer). Optional.
+
+    Returns:
+        dict: number of files and rows processed, the elapsed time, the number of commits and the files which \
+        failed (skipped with savepoints): {'files': int, 'rows': int, 'seconds': float, 'commits': int, 'failed': list}
+    """
+    assert batch_size >= 1
+    if (workers is not None or pool is not None) and func not in file_transforms:
+        raise ValueError('No transform function registered for {}'.format(func))
+    all_files, num_files, fingerprints = find_files_to_load(cur, conn, filepath, incremental=incremental,
+                                                            force_prefix=force_prefix, start_date=start_date,
+                                                            end_date=end_date)
+    batches = iter_batches(all_files, batch_size=batch_size)
+    committer = Committer(conn, policy=transactions, before_commit=before_commit)
+
+    if workers is not None:
+        results = iter_transformed(transform=file_transforms[func], batches=batches, workers=workers)
+        if func is process_log_file and dims is not None:
+            # the workers cannot filter the start_time already loaded: filtered here, before the load
+            results = ((batch, (n, drop_loaded_time_rows(tables, dims.time_keys))) for batch, (n, tables) in results)
+    elif pool is not None:
+        results = ((batch, file_transforms[func](batch, **transform_kwargs(func, dims))) for batch in batches)
+    else:
+        results = ((batch, None) for batch in batches)
+    return load_results(cur, results, func, committer, num_files=num_files, bulk=bulk, pool=pool,
+                        max_pending=max_pending, incremental=incremental, fingerprints=fingerprints, dims=dims,
+                        chunksize=chunksize)
+
+
+def process_data_pipelined(cur, conn, filepath, func, bulk=False, batch_size=1, pool=None, max_pending=2,
+                           incremental=False, force_prefix=None, dims=None, transactions=None,
+                           start_date=None, end_date=None, before_commit=None):
+    """
+    Process the files detected in filepath like process_data, with the batches going through the stages discover \
+    (the source of the batches), read, transform and load, run by threads connected by queues of max_pending \
+    batches (see pipeline.Pipeline): the next batches are read and transformed while the current one is loaded. \
+    The utilization of each stage is printed at the end.
+    Without incremental, the files are discovered lazily by the discover stage (utils.iter_files): the first \
+    batches are loaded while the rest of the tree is walked.
+    Args:
+        cur (psycopg2.cursor): cursor
+        conn (psycopg2.connection): connection
+        filepath (str): filepath of root folder for files
+        func: transformation func, either from log_file or song_file
+        bulk (bool): If true, will use copy from instead of insert
+        batch_size (int): number of files processed together
+        pool (psycopg2.pool.ThreadedConnectionPool): If provided, write the tables concurrently with this pool
+        max_pending (int): maximum number of batches waiting between two stages (and, with pool, to be written \
+        for each table)
+        incremental (bool): If True, skip the files already loaded according to the load manifest
+        force_prefix (str): with incremental, reload all the files under this path prefix
+        dims (DimensionCache): in-process state of the dimensions, shared with the transform thread
+        transactions (TransactionPolicy): when to commit the loads, see process_data
+        start_date (str/datetime.date): first day of the log files to process (included). Optional.
+        end_date (str/datetime.date): last day of the log files to process (included). Optional.
+        before_commit (callable): called before each commit of loaded files, see process_data. Optional.
+
+    Returns:
+        dict: as process_data, with the stats of the stages (key 'pipeline', see pipeline.Pipeline.stats)
+    """
+    assert batch_size >= 1
+    if func not in file_row_transforms:
+        raise ValueError('No row transform function registered for {}'.format(func))
+    # the files are found by the discover stage of the pipeline, while the first batches are loaded
+    all_files, num_files, fingerprints = find_files_to_load(cur, conn, filepath, incremental=incremental,
+                                                            force_prefix=force_prefix, start_date=start_date,
+                                                            end_date=end_date, lazy=True)
+    batches = iter_batches(all_files, batch_size=batch_size)
+    committer = Committer(conn, policy=transactions, before_commit=before_commit)
+
+    pipeline = Pipeline(source=batches, stages=pipeline_stages(func, dims=dims), max_pending=max_pending,
+                        source_name='discover', sink_name='load')
+    try:
+        # the batches transformed before a rollback (dims.reload) are read again by the load
+        result = load_results(cur, fresh_batches(pipeline, dims=dims), func, committer, num_files=num_files,
+                              bulk=bulk, pool=pool, max_pending=max_pending, incremental=incremental,
+                              fingerprints=fingerprints, dims=dims)
+    finally:
+        # stop the read / transform threads (if the load failed, they may be waiting for room in their queue)
+        pipeline.close()
+        print(pipeline.report())
+    result['pipeline'] = pipeline.stats()
+    return result
 
 
 def main():
@@ -341,13 +1197,59 @@ def main():
         None
     """
     bulk = True
-    conn = connection_sparkifydb()
+    batch_size = 100
+    workers = None
+    # read and transform the next batches in threads while a batch is loaded (process_data_pipelined, without workers)
+    pipelined = True
+    concurrent_writers = False
+    # on-disk cache of the parsed json files, e.g. '../data/parsed_cache': a rebuild does not parse the files again
+    # (Feather files: needs pyarrow)
+    parsed_cache_dir = None
+    parsed_cache_max_size = '2GB'
+    # days of the log files to load (included), e.g. '2018-11-01'. None: all the files
+    start_date = None
+    end_date = None
+    incremental = True
+    # one transaction per batch of files, a bad file is rolled back and skipped (and retried at the next run)
+    transactions = TransactionPolicy.per_files(batch_size, savepoints=True)
+    # large (initial) load: drop the indexes not used by the load, rebuild them at the end
+    backfill = False
+    # run report: one JSON line per measured stage, and the totals in the Prometheus text format
+    report_dir = '../data/reports'
+    run_name = time.strftime('%Y%m%d-%H%M%S')
+    recorder.add_sink(JsonLinesSink('{}/run_{}.jsonl'.format(report_dir, run_name)))
+    if parsed_cache_dir is not None:
+        set_parsed_cache(ParsedCache(parsed_cache_dir, max_bytes=parsed_cache_max_size))
+    conn = connection_sparkifydb(autocommit=transactions.autocommit)
     cur = conn.cursor()
+    # song / artist lookup index loaded once, then maintained in memory during the run
+    dims = DimensionCache.from_db(cur)
+    # one connection per table writer
+    pool = connection_pool_sparkifydb(minconn=1, maxconn=len(table_loaders)) if concurrent_writers else None
 
-    process_data(cur, conn, filepath='../data/song_data', func=process_song_file, bulk=bulk)
-    process_data(cur, conn, filepath='../data/log_data', func=process_log_file, bulk=bulk)
+    if pipelined:
+        process = process_data_pipelined
+    else:
+        process = functools.partial(process_data, workers=workers)
+    with indexes.backfill(cur, conn) if backfill else contextlib.nullcontext():
+        # the load generation is bumped with each commit of loaded files: the cached analytics are invalidated
+        process(cur, conn, filepath='../data/song_data', func=process_song_file, bulk=bulk, batch_size=batch_size,
+                pool=pool, incremental=incremental, dims=dims, transactions=transactions,
+                before_commit=bump_load_generation)
+        process(cur, conn, filepath='../data/log_data', func=process_log_file, bulk=bulk, batch_size=batch_size,
+                pool=pool, incremental=incremental, dims=dims, transactions=transactions,
+                start_date=start_date, end_date=end_date, before_commit=bump_load_generation)
+    if not backfill:
+        # planner statistics of the loaded tables (the backfill analyzes them after the rebuild)
+        indexes.analyze(cur)
+        if not conn.autocommit:
+            conn.commit()
 
+    if pool is not None:
+        pool.closeall()
     conn.close()
+    write_prometheus('{}/sparkify_etl.prom'.format(report_dir))
+    print(recorder.summary())
     return None
 
 
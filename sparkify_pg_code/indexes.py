@@ -0,0 +1,169 @@
+import contextlib
+from psycopg2 import sql
+
+# Secondary indexes of the tables (the primary keys are created with the tables, see sql_queries.py)
+# - the lookups by primary key (e.g. artists.artist_id in the songplays artist_id resolution) need no other index
+# - essential indexes serve the lookups of the load itself: they are kept during a backfill
+# - the other indexes serve the analytics queries: they can be dropped before a large backfill and rebuilt after, \
+# which is faster than maintaining them row by row during the load
+
+
+class IndexSpec(object):
+    """
+    Declaration of a secondary index
+    Args:
+        name (str): name of the index
+        table (str): table
+        columns (list): indexed columns, in order
+        essential (bool): True if the index is used by the load (kept during a backfill)
+        purpose (str): queries served by the index
+    """
+
+    def __init__(self, name, table, columns, essential=False, purpose=''):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.essential = essential
+        self.purpose = purpose
+
+    def create_query(self):
+        return sql.SQL("CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns});").format(
+            name=sql.Identifier(self.name),
+            table=sql.Identifier(self.table),
+            columns=sql.SQL(', ').join([sql.Identifier(c) for c in self.columns]))
+
+    def drop_query(self):
+        return sql.SQL("DROP INDEX IF EXISTS {name};").format(name=sql.Identifier(self.name))
+
+    def __repr__(self):
+        return 'IndexSpec({}, {}({}))'.format(self.name, self.table, ', '.join(self.columns))
+
+
+secondary_indexes = [
+    IndexSpec('songs_title_duration_idx', 'songs', ['title', 'duration'], essential=True,
+              purpose='songplays song_id resolution: song_select, bulk_select_song_info, songplay_table_insert_select'),
+    IndexSpec('songplays_song_id_idx', 'songplays', ['song_id'],
+              purpose='analytics: plays per song (song_most_played.sql)'),
+    IndexSpec('songplays_artist_id_idx', 'songplays', ['artist_id'],
+              purpose='analytics: plays per artist'),
+    IndexSpec('songplays_user_id_idx', 'songplays', ['user_id'],
+              purpose='analytics: plays per user'),
+    IndexSpec('time_year_month_idx', 'time', ['year', 'month'],
+              purpose='analytics: filters of the time table on year / month')
+]
+
+# tables analyzed after a load
+analyzed_tables = ['songplays', 'users', 'users_history', 'songs', 'artists', 'time', 'song_plays_daily',
+                   'artist_plays_daily', 'user_plays_daily', 'level_plays_hourly']
+
+
+def _select(essential=None):
+    """
+    Args:
+        essential (bool): If None, all the indexes, else only the (non) essential ones
+
+    Returns:
+        list: list of IndexSpec
+    """
+    return [i for i in secondary_indexes if essential is None or i.essential == essential]
+
+
+def create_indexes(cur, essential=None, maintenance_work_mem=None):
+    """
+    Create the secondary indexes which do not exist
+    Args:
+        cur (psycopg2.cursor): cursor
+        essential (bool): If None, all the indexes, else only the (non) essential ones
+        maintenance_work_mem (str): If provided, memory used to build each index, e.g. '512MB' \
+        (faster builds of large indexes). Reset afterwards.
+
+    Returns:
+        list: names of the indexes
+    """
+    specs = _select(essential)
+    if maintenance_work_mem is not None:
+        cur.execute("SET maintenance_work_mem = %s;", (maintenance_work_mem,))
+    try:
+        for spec in specs:
+            cur.execute(spec.create_query())
+    finally:
+        if maintenance_work_mem is not None:
+            cur.execute("RESET maintenance_work_mem;")
+    return [spec.name for spec in specs]
+
+
+def drop_indexes(cur, essential=False):
+    """
+    Drop the secondary indexes, by default only the non-essential ones (not used by the load)
+    Args:
+        cur (psycopg2.cursor): cursor
+        essential (bool): If None, all the indexes, else only the (non) essential ones
+
+    Returns:
+        list: names of the indexes
+    """
+    specs = _select(essential)
+    for spec in specs:
+        cur.execute(spec.drop_query())
+    return [spec.name for spec in specs]
+
+
+def existing_indexes(cur):
+    """
+    Names of the secondary indexes which exist in the database
+    Args:
+        cur (psycopg2.cursor): cursor
+
+    Returns:
+        list: names of the declared indexes found in pg_indexes, in the current schema
+    """
+    cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND indexname = ANY(%s);",
+                ([spec.name for spec in secondary_indexes],))
+    return [r[0] for r in cur.fetchall()]
+
+
+def analyze(cur, tables=None):
+    """
+    Update the planner statistics of the tables (ANALYZE), once the load is finished
+    Args:
+        cur (psycopg2.cursor): cursor
+        tables (list): tables to analyze (default: analyzed_tables)
+
+    Returns:
+        None
+    """
+    for table in tables if tables is not None else analyzed_tables:
+        cur.execute(sql.SQL("ANALYZE {table};").format(table=sql.Identifier(table)))
+    return None
+
+
+@contextlib.contextmanager
+def backfill(cur, conn, maintenance_work_mem='256MB'):
+    """
+    Context of a large load: the non-essential indexes are dropped before the block, then rebuilt and the tables \
+    analyzed after it (also if the block fails, so that the analytics queries keep their indexes).
+    The essential indexes are created if missing, since the load itself uses them.
+    Args:
+        cur (psycopg2.cursor): cursor
+        conn (psycopg2.connection): connection, committed after the drops and after the rebuild
+        maintenance_work_mem (str): memory used to rebuild each index
+
+    Returns:
+        None
+    """
+    create_indexes(cur, essential=True)
+    dropped = drop_indexes(cur, essential=False)
+    conn.commit()
+    print('{} indexes dropped for the backfill: {}'.format(len(dropped), ', '.join(dropped)))
+    try:
+        yield
+    except Exception:
+        if not conn.autocommit:
+            # the failed transaction of the block must be ended before the rebuild
+            conn.rollback()
+        raise
+    finally:
+        create_indexes(cur, essential=False, maintenance_work_mem=maintenance_work_mem)
+        analyze(cur)
+        conn.commit()
+        print('{} indexes rebuilt, tables analyzed'.format(len(dropped)))
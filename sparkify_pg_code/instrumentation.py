@@ -0,0 +1,343 @@
+import contextlib
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+
+# Per-stage instrumentation of the ETL: wall time, rows in / out, rows dropped and bytes, per stage and table.
+# - The stages are measured with recorder.stage (context manager) or the instrumented decorator
+# - Each measure is aggregated in the recorder and sent to the sinks (callables taking the event dict), \
+# e.g. JsonLinesSink to write the events of a run as JSON lines
+# - write_prometheus writes the aggregated counters in the Prometheus text format (node_exporter textfile collector)
+# - If tracemalloc is tracing, the peak memory allocated by each stage is measured too (peak_bytes). \
+# The peaks of the stages run concurrently (writer threads) are mixed: use it with a sequential run.
+# The measures taken in worker processes (etl.process_data with workers) stay in the workers: \
+# only the stages run in the main process and in the writer threads are reported.
+
+metric_prefix = 'sparkify_etl'
+
+
+class Measure(object):
+    """
+    Measure of one execution of a stage, filled in by the measured code
+    Args:
+        stage (str): name of the stage, e.g. 'read_json', 'prepare_data', 'load', 'bulk_copy.copy'
+        table (str): table concerned, if any
+        rows_in (int): number of rows received by the stage
+    The block can also fill in details (dict of JSON values), sent with the event but not aggregated.
+    """
+
+    def __init__(self, stage, table=None, rows_in=None):
+        self.stage = stage
+        self.table = table
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.rows_dropped = None
+        self.bytes = None
+        self.seconds = None
+        self.peak_bytes = None
+        self.error = False
+        self.details = {}
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'table': self.table,
+            'seconds': self.seconds,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_dropped': self.rows_dropped,
+            'bytes': self.bytes,
+            'peak_bytes': self.peak_bytes,
+            'error': self.error,
+            'details': self.details
+        }
+
+
+class Recorder(object):
+    """
+    Thread-safe collector of the measures of a run
+    - stats: totals per (stage, table), and the maximum of the memory peaks
+    - sinks: callables called with each event (dict with the keys of Measure.to_dict, plus run_id and ts)
+    """
+    counters = ['calls', 'errors', 'seconds', 'rows_in', 'rows_out', 'rows_dropped', 'bytes']
+
+    def __init__(self):
+        self.run_id = uuid.uuid4().hex
+        self._stats = {}
+        self._sinks = []
+        self._lock = threading.Lock()
+        # stack of the stages being measured in the thread, to measure the memory peaks of nested stages
+        self._local = threading.local()
+
+    def add_sink(self, sink):
+        """
+        Args:
+            sink (callable): called with each event dict. Must be thread-safe.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._sinks.append(sink)
+        return None
+
+    def remove_sink(self, sink):
+        with self._lock:
+            self._sinks.remove(sink)
+        return None
+
+    def reset(self):
+        """
+        Start a new run: clear the stats (the sinks are kept)
+        """
+        with self._lock:
+            self.run_id = uuid.uuid4().hex
+            self._stats = {}
+        return None
+
+    @contextlib.contextmanager
+    def stage(self, stage, table=None, rows_in=None):
+        """
+        Measure the wall time of the block. The block can fill in the rows and bytes of the measure.
+        Examples:
+            with recorder.stage('prepare_data', rows_in=df.shape[0]) as m:
+                ...
+                m.rows_out = df2.shape[0]
+        Args:
+            stage (str): name of the stage
+            table (str): table concerned, if any
+            rows_in (int): number of rows received by the stage
+
+        Returns:
+            Measure
+        """
+        m = Measure(stage=stage, table=table, rows_in=rows_in)
+        frame = self._enter_memory() if tracemalloc.is_tracing() else None
+        t0 = time.perf_counter()
+        try:
+            yield m
+        except BaseException:
+            m.error = True
+            raise
+        finally:
+            m.seconds = time.perf_counter() - t0
+            if frame is not None:
+                m.peak_bytes = self._exit_memory(frame)
+            self.record(m)
+
+    def _enter_memory(self):
+        """
+        Start measuring the memory peak of a stage
+        The tracemalloc peak is reset for the new stage: the peak reached so far by the enclosing stage is saved \
+        in its frame, and the enclosing stage gets the max of the two when the stage ends.
+        Returns:
+            list: frame [memory allocated at the start, peak so far]
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        current, peak = tracemalloc.get_traced_memory()
+        if len(stack) > 0:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        frame = [current, current]
+        stack.append(frame)
+        return frame
+
+    def _exit_memory(self, frame):
+        """
+        Returns:
+            int: peak memory allocated during the stage, above the memory allocated at its start (bytes)
+        """
+        stack = self._local.stack
+        stack.remove(frame)
+        peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+        if len(stack) > 0:
+            stack[-1][1] = max(stack[-1][1], peak)
+        return peak - frame[0]
+
+    def record(self, m):
+        """
+        Aggregate a measure and send it to the sinks
+        Args:
+            m (Measure)
+
+        Returns:
+            None
+        """
+        event = m.to_dict()
+        with self._lock:
+            totals = self._stats.setdefault((m.stage, m.table), dict(dict.fromkeys(self.counters, 0), peak_bytes=0))
+            totals['calls'] += 1
+            totals['errors'] += int(m.error)
+            for k in ['seconds', 'rows_in', 'rows_out', 'rows_dropped', 'bytes']:
+                if event[k] is not None:
+                    totals[k] += event[k]
+            if m.peak_bytes is not None:
+                totals['peak_bytes'] = max(totals['peak_bytes'], m.peak_bytes)
+            event['run_id'] = self.run_id
+            sinks = list(self._sinks)
+        event['ts'] = datetime.datetime.now().isoformat()
+        for sink in sinks:
+            sink(event)
+        return None
+
+    def stats(self):
+        """
+        Returns:
+            list: one dict per (stage, table), with the keys stage, table and the counters, sorted by stage
+        """
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda kv: (kv[0][0], kv[0][1] or ''))
+            return [dict(stage=k[0], table=k[1], **v) for k, v in items]
+
+    def summary(self):
+        """
+        Returns:
+            str: one line per stage, for printing
+        """
+        lines = ['{:<20} {:<16} {:>7} {:>9} {:>10} {:>10} {:>9} {:>12} {:>12}'.format(
+            'stage', 'table', 'calls', 'seconds', 'rows_in', 'rows_out', 'dropped', 'bytes', 'peak_bytes')]
+        for s in self.stats():
+            lines.append('{:<20} {:<16} {:>7} {:>9.3f} {:>10} {:>10} {:>9} {:>12} {:>12}'.format(
+                s['stage'], s['table'] or '', s['calls'], s['seconds'], s['rows_in'], s['rows_out'],
+                s['rows_dropped'], s['bytes'], s['peak_bytes']))
+        return '\n'.join(lines)
+
+
+class JsonLinesSink(object):
+    """
+    Sink appending each event as a JSON line to a file
+    Args:
+        path (str): path of the file (created with its directory if needed)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        return None
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(stats, run_id=None):
+    """
+    Format the stats in the Prometheus text exposition format
+    Args:
+        stats (list): as returned by Recorder.stats
+        run_id (str): If provided, added as a label
+
+    Returns:
+        str
+    """
+    helps = {
+        'calls': 'Number of executions of the stage',
+        'errors': 'Number of executions of the stage which raised an error',
+        'seconds': 'Wall time spent in the stage',
+        'rows_in': 'Rows received by the stage',
+        'rows_out': 'Rows produced by the stage',
+        'rows_dropped': 'Rows dropped by the stage (null or duplicate primary key)',
+        'bytes': 'Bytes read or sent by the stage',
+        'peak_bytes': 'Maximum memory allocated by one execution of the stage (with tracemalloc)'
+    }
+    metrics = [(c, '{}_stage_{}_total'.format(metric_prefix, c), 'counter') for c in Recorder.counters]
+    metrics.append(('peak_bytes', '{}_stage_peak_bytes'.format(metric_prefix), 'gauge'))
+    lines = []
+    for counter, name, metric_type in metrics:
+        lines.append('# HELP {} {}'.format(name, helps[counter]))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for s in stats:
+            labels = [('stage', s['stage'])]
+            if s['table'] is not None:
+                labels.append(('table', s['table']))
+            if run_id is not None:
+                labels.append(('run_id', run_id))
+            labels_s = ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in labels)
+            lines.append('{}{{{}}} {}'.format(name, labels_s, repr(float(s[counter]))))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, recorder=None):
+    """
+    Write the stats of the recorder in the Prometheus text format
+    The file is written then renamed, so that a collector never reads a partial file.
+    Args:
+        path (str): path of the .prom file
+        recorder (Recorder): default: the module recorder
+
+    Returns:
+        None
+    """
+    if recorder is None:
+        recorder = get_recorder()
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text(recorder.stats(), run_id=recorder.run_id))
+    os.replace(tmp_path, path)
+    return None
+
+
+def _n_rows(obj):
+    """
+    Number of rows of a DataFrame (None for other objects)
+    """
+    shape = getattr(obj, 'shape', None)
+    if shape is None or len(shape) == 0:
+        return None
+    return shape[0]
+
+
+# recorder of the process, used by the instrumented functions of utils.py and etl.py
+recorder = Recorder()
+
+
+def get_recorder():
+    return recorder
+
+
+def stage(stage, table=None, rows_in=None):
+    """
+    Measure a block with the module recorder (see Recorder.stage)
+    """
+    return recorder.stage(stage=stage, table=table, rows_in=rows_in)
+
+
+def instrumented(stage, table=None):
+    """
+    Decorator measuring each call of the function with the module recorder
+    - rows_in: number of rows of the first argument, if it is a DataFrame
+    - rows_out: number of rows of the result, if it is a DataFrame
+    Args:
+        stage (str): name of the stage
+        table (str): table concerned, if any
+
+    Returns:
+        decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            data = args[0] if len(args) > 0 else next(iter(kwargs.values()), None)
+            with recorder.stage(stage=stage, table=table, rows_in=_n_rows(data)) as m:
+                result = func(*args, **kwargs)
+                m.rows_out = _n_rows(result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,101 @@
+import datetime
+import hashlib
+import os
+from psycopg2.extras import execute_values
+from sparkify_pg_code.sql_queries import load_manifest_select, load_manifest_upsert
+
+
+def file_fingerprint(filepath):
+    """
+    Describe a file for the load manifest
+    The content is read once: the sha256 hash and the number of rows (non empty lines) are computed in the same pass.
+    Args:
+        filepath (str): path of the file
+
+    Returns:
+        dict: with keys path (absolute), size, mtime, content_hash, n_rows
+    """
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    h = hashlib.sha256()
+    n_rows = 0
+    with open(filepath, 'rb') as f:
+        for line in f:
+            h.update(line)
+            if line.strip():
+                n_rows += 1
+    return {
+        'path': filepath,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'content_hash': h.hexdigest(),
+        'n_rows': n_rows
+    }
+
+
+def read_manifest(cur):
+    """
+    Read the load manifest
+    Args:
+        cur (psycopg2.cursor): cursor
+
+    Returns:
+        dict: {path: (size, mtime, content_hash)}
+    """
+    cur.execute(load_manifest_select)
+    return {r[0]: (r[1], r[2], r[3]) for r in cur.fetchall()}
+
+
+def record_files(cur, fingerprints):
+    """
+    Insert or update the files in the load manifest, with the current time as load time
+    Args:
+        cur (psycopg2.cursor): cursor
+        fingerprints (list): list of dict as returned by file_fingerprint
+
+    Returns:
+        None
+    """
+    if len(fingerprints) == 0:
+        return None
+    loaded_at = datetime.datetime.now()
+    rows = [(f['path'], f['size'], f['mtime'], f['content_hash'], f['n_rows'], loaded_at) for f in fingerprints]
+    execute_values(cur, load_manifest_upsert, rows)
+    return None
+
+
+def select_files_to_load(cur, all_files, force_prefix=None):
+    """
+    Compare the files with the load manifest and return the ones which need to be loaded:
+    - files not in the manifest
+    - files whose size or mtime changed, and whose content hash changed. If only the size or mtime changed, \
+    the manifest is updated and the file is not reloaded.
+    - files whose path starts with force_prefix, whatever the manifest says
+    Files with the same size and mtime as in the manifest are skipped without being read.
+    Args:
+        cur (psycopg2.cursor): cursor
+        all_files (list): list of paths
+        force_prefix (str): If provided, reload all the files under this path prefix
+
+    Returns:
+        list: list of fingerprints (see file_fingerprint) of the files to load, in the order of all_files
+    """
+    manifest = read_manifest(cur)
+    if force_prefix is not None:
+        force_prefix = os.path.abspath(force_prefix)
+    to_load, touched = [], []
+    for filepath in all_files:
+        filepath = os.path.abspath(filepath)
+        known = manifest.get(filepath)
+        forced = force_prefix is not None and filepath.startswith(force_prefix)
+        if known is not None and not forced:
+            stat = os.stat(filepath)
+            if known[0] == stat.st_size and known[1] == stat.st_mtime:
+                continue
+        fingerprint = file_fingerprint(filepath)
+        if known is not None and not forced and known[2] == fingerprint['content_hash']:
+            touched.append(fingerprint)
+            continue
+        to_load.append(fingerprint)
+    record_files(cur, touched)
+    return to_load
@@ -0,0 +1,373 @@
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import pandas as pd
+from sparkify_pg_code.instrumentation import stage
+
+try:
+    import pyarrow  # noqa: F401  (Feather and Parquet formats)
+except ImportError:
+    pyarrow = None
+
+# On-disk cache of the parsed input files: the typed DataFrame of each json file (see schemas.py), keyed by the \
+# sha256 of the content of the file and the schema, so that a rebuild of the database does not parse the json again.
+# - Enabled for the whole process with set_parsed_cache: utils.read_json_files then reads the files through it \
+# (process_song_file / process_log_file, the worker processes started by fork and the pipeline threads). \
+# The streaming mode (chunksize) is not cached.
+# - Format: Feather (default) or Parquet, which need pyarrow (pip install pyarrow). Pandas pickle files only if \
+# asked for explicitly (fmt='pickle'): reading a pickle runs code, only use it on a directory no one else can write.
+# - Size cap: once the files of the cache exceed max_bytes, the least recently used ones are deleted down to \
+# low_water * max_bytes, so that the next puts do not evict again. The entries are scanned once (by mtime, which \
+# a hit updates), then kept in an in-memory LRU index of their sizes: a put does not walk the directory.
+# - The errors of the cache (unreadable entry, frame which cannot be written) are recorded as errors of the \
+# instrumentation stages parsed_cache.read / parsed_cache.write, and the file is parsed without the cache
+# - A changed file has a new content hash: its old entry is never read again and is evicted in time
+# Run from the sparkify_pg_code directory:
+#   python parsed_cache.py warm --root ../data --cache ../data/parsed_cache --max-size 2GB
+#   python parsed_cache.py prune --cache ../data/parsed_cache --max-size 500MB
+#   python parsed_cache.py stats --cache ../data/parsed_cache
+
+# Bump when the layout of the cached frames changes: the old entries are not read anymore
+cache_version = 1
+
+_extensions = {'feather': '.feather', 'parquet': '.parquet', 'pickle': '.pkl'}
+
+
+def parse_size(size):
+    """
+    Args:
+        size (int/str): number of bytes, or a string such as '512MB' or '2GB'
+
+    Returns:
+        int: number of bytes
+    """
+    if isinstance(size, int):
+        return size
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', size.upper())
+    if match is None:
+        raise ValueError('Invalid size {}'.format(size))
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' '))
+
+
+def content_hash(filepath, block_size=1 << 20):
+    """
+    Args:
+        filepath (str): path of the file
+        block_size (int): bytes read at a time
+
+    Returns:
+        str: sha256 of the content of the file (hex)
+    """
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def schema_hash(schema):
+    """
+    Args:
+        schema (dict): {column: dtype}
+
+    Returns:
+        str: short hash of the columns and dtypes of the schema (and of the cache version)
+    """
+    text = json.dumps([cache_version, list(schema.items())])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+
+
+class ParsedCache(object):
+    """
+    Directory of parsed files, with a size cap and LRU eviction
+    Thread-safe. Several processes can share the directory: the files are written atomically, \
+    and each process evicts according to its own view of the size of the directory.
+    Args:
+        directory (str): directory of the cache, created if missing
+        max_bytes (int/str): size cap of the cache, e.g. '2GB'. None: no cap.
+        fmt (str): 'feather' (default), 'parquet' or 'pickle'. Feather and Parquet need pyarrow.
+        low_water (float): share of max_bytes the cache is evicted down to once over its cap
+    """
+
+    def __init__(self, directory, max_bytes=None, fmt=None, low_water=0.9):
+        if fmt is None:
+            fmt = 'feather'
+        assert 0 < low_water <= 1
+        if fmt not in _extensions:
+            raise ValueError('Unknown cache format {}'.format(fmt))
+        if fmt != 'pickle' and pyarrow is None:
+            raise ImportError('The {} format of the parsed cache needs pyarrow (pip install pyarrow)'.format(fmt))
+        self.directory = directory
+        self.max_bytes = parse_size(max_bytes) if max_bytes is not None else None
+        self.fmt = fmt
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        # {path: size} of the entries, least recently used first (None: not scanned yet), and their total size
+        self._index = None
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        Args:
+            key (str): key of an entry (see key)
+
+        Returns:
+            str: path of the file of the entry
+        """
+        return os.path.join(self.directory, key[:2], key + _extensions[self.fmt])
+
+    @staticmethod
+    def key(filepath, schema):
+        """
+        Args:
+            filepath (str): path of the source file
+            schema (dict): schema the file is parsed with
+
+        Returns:
+            str: key of the parsed file
+        """
+        return '{}-{}'.format(content_hash(filepath), schema_hash(schema))
+
+    def _write(self, df, path):
+        df = df.reset_index(drop=True)
+        if self.fmt == 'feather':
+            df.to_feather(path)
+        elif self.fmt == 'parquet':
+            df.to_parquet(path, index=False)
+        else:
+            df.to_pickle(path)
+
+    def _read(self, path):
+        if self.fmt == 'feather':
+            return pd.read_feather(path)
+        if self.fmt == 'parquet':
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def get(self, filepath, schema, parse):
+        """
+        Parsed file, from the cache if its content was parsed before, else parsed and added to the cache
+        Args:
+            filepath (str): path of the source file
+            schema (dict): schema of the file
+            parse (callable): parse(filepath, schema) -> pd.DataFrame, called on a miss
+
+        Returns:
+            pd.DataFrame
+        """
+        path = self.path(self.key(filepath, schema))
+        df = None
+        if os.path.exists(path):
+            try:
+                with stage('parsed_cache.read') as m:
+                    df = self._read(path)
+                    m.rows_out = df.shape[0]
+                    m.bytes = os.path.getsize(path)
+            except Exception:
+                # unreadable entry (e.g. deleted by an eviction meanwhile), recorded as an error of the stage: \
+                # parse the file again
+                df = None
+        if df is not None:
+            # least recently used: a hit makes the entry the most recent one (also for the next scan)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            with self._lock:
+                self.hits += 1
+                if self._index is not None and path in self._index:
+                    self._index.move_to_end(path)
+            return df
+        df = parse(filepath, schema)
+        with self._lock:
+            self.misses += 1
+        self.put(path, df)
+        return df
+
+    def put(self, path, df):
+        """
+        Write an entry (atomically), then evict the least recently used entries if the cache is over its cap
+        Args:
+            path (str): path of the entry
+            df (pd.DataFrame): parsed file
+
+        Returns:
+            bool: True if written. A frame which cannot be written in the format of the cache is not cached.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            with stage('parsed_cache.write', rows_in=df.shape[0]) as m:
+                self._write(df, tmp_path)
+                m.bytes = os.path.getsize(tmp_path)
+                os.replace(tmp_path, path)
+        except Exception:
+            # recorded as an error of the stage: the file is used without being cached
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        with self._lock:
+            index = self._load_index()
+            self._size += m.bytes - index.pop(path, 0)
+            index[path] = m.bytes
+            if self.max_bytes is not None and self._size > self.max_bytes:
+                self._evict(int(self.low_water * self.max_bytes))
+        return True
+
+    def entries(self):
+        """
+        Returns:
+            list: (mtime, size, path) of the entries of the cache, least recently used first
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(_extensions[self.fmt]):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def _load_index(self):
+        """
+        LRU index of the entries, scanned from the directory on first use (called with the lock)
+        Returns:
+            collections.OrderedDict: {path: size}, least recently used first
+        """
+        if self._index is None:
+            self._index = collections.OrderedDict((path, size) for _, size, path in self.entries())
+            self._size = sum(self._index.values())
+        return self._index
+
+    def size(self):
+        """
+        Returns:
+            int: total size of the entries, in bytes (scanned once, then maintained by put and evict)
+        """
+        with self._lock:
+            self._load_index()
+            return self._size
+
+    def _evict(self, max_bytes):
+        """
+        Delete the least recently used entries of the index until the cache holds at most max_bytes \
+        (called with the lock). An entry already deleted by another process is only removed from the index.
+        """
+        index = self._load_index()
+        n_deleted, bytes_deleted = 0, 0
+        with stage('parsed_cache.evict', rows_in=len(index)) as m:
+            while self._size > max_bytes and len(index) > 0:
+                path, size = index.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                n_deleted += 1
+                bytes_deleted += size
+            m.rows_dropped = n_deleted
+            m.bytes = bytes_deleted
+        return n_deleted, bytes_deleted
+
+    def evict(self, max_bytes):
+        """
+        Delete the least recently used entries until the cache holds at most max_bytes
+        Args:
+            max_bytes (int/str): size to reach
+
+        Returns:
+            int, int: number of entries and bytes deleted
+        """
+        max_bytes = parse_size(max_bytes)
+        with self._lock:
+            return self._evict(max_bytes)
+
+    def stats(self):
+        """
+        Returns:
+            dict: entries, bytes, max_bytes, format, and the hits and misses of this process
+        """
+        entries = self.entries()
+        return {'entries': len(entries), 'bytes': sum(size for _, size, _ in entries), 'max_bytes': self.max_bytes,
+                'format': self.fmt, 'hits': self.hits, 'misses': self.misses}
+
+
+# Cache used by utils.read_json_files (None: no cache)
+_parsed_cache = None
+
+
+def set_parsed_cache(cache):
+    """
+    Args:
+        cache (ParsedCache): cache used to read the json files from now on, None to disable it
+
+    Returns:
+        None
+    """
+    global _parsed_cache
+    _parsed_cache = cache
+    return None
+
+
+def get_parsed_cache():
+    """
+    Returns:
+        ParsedCache: cache used to read the json files, or None
+    """
+    return _parsed_cache
+
+
+def main():
+    """
+    Warm, prune or describe a parsed cache from the command line
+    Returns:
+        None
+    """
+    # imported here: utils reads the files through this module
+    from sparkify_pg_code.utils import get_all_files, parse_json_file
+    from sparkify_pg_code.schemas import song_schema, log_schema
+
+    parser = argparse.ArgumentParser(description='On-disk cache of the parsed json files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_warm = subparsers.add_parser('warm', help='parse the files which are not in the cache yet')
+    parser_warm.add_argument('--root', default='../data', help='directory containing song_data and log_data')
+    parser_prune = subparsers.add_parser('prune', help='evict the least recently used entries')
+    parser_stats = subparsers.add_parser('stats', help='size of the cache')
+    for p in (parser_warm, parser_prune, parser_stats):
+        p.add_argument('--cache', default='../data/parsed_cache', help='directory of the cache')
+        p.add_argument('--max-size', default=None, help='size cap, e.g. 2GB')
+        p.add_argument('--format', default=None, choices=sorted(_extensions),
+                       help='format of the entries (default: feather)')
+    args = parser.parse_args()
+
+    cache = ParsedCache(args.cache, max_bytes=args.max_size, fmt=args.format)
+    if args.command == 'warm':
+        t0 = time.perf_counter()
+        for name, schema in [('song_data', song_schema), ('log_data', log_schema)]:
+            for f in get_all_files(os.path.join(args.root, name)):
+                cache.get(f, schema=schema, parse=parse_json_file)
+        print('{} files parsed, {} already cached ({:.1f}s)'.format(
+            cache.misses, cache.hits, time.perf_counter() - t0))
+    elif args.command == 'prune':
+        if cache.max_bytes is None:
+            parser.error('prune needs --max-size')
+        n_deleted, bytes_deleted = cache.evict(cache.max_bytes)
+        print('{} entries evicted ({} bytes)'.format(n_deleted, bytes_deleted))
+    print(cache.stats())
+    return None
+
+
+if __name__ == "__main__":
+    main()
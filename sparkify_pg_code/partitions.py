@@ -0,0 +1,268 @@
+import argparse
+import gzip
+import os
+import re
+import threading
+import weakref
+import pandas as pd
+from psycopg2 import sql
+from sparkify_pg_code.instrumentation import stage
+from sparkify_pg_code.utils import connection_sparkifydb
+
+# Monthly range partitions of the songplays fact table (see sql_queries.songplay_table_create)
+# - the partitions are created by the loader the first time it sees a month (MonthlyPartitions.ensure): \
+# the partitions already ensured are kept in memory per connection, so the next batches of the month do not \
+# pay a catalog lookup (forget must be called when a transaction which may have created some is rolled back)
+# - utils.bulk_copy routes the rows of a batch to their partition (parameter partitions): \
+# each partition is staged and merged on its own, the parent table does not route the rows one by one
+# - the old months are detached, or archived to a csv file and dropped, instead of deleted row by row
+# The partitions are named <table>_yYYYYmMM, e.g. songplays_y2018m11. The partitions named otherwise \
+# (e.g. a DEFAULT partition) are listed, but never archived.
+# Run from the sparkify_pg_code directory:
+#   python partitions.py list
+#   python partitions.py archive --before 2018-11 --directory ../data/archive
+
+
+class MonthlyPartitions(object):
+    """
+    Monthly range partitions of a table partitioned by a timestamp column
+    Args:
+        table (str): partitioned table
+        column (str): partition key (TIMESTAMP)
+    """
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+        # {connection: names of the partitions known to exist}, seeded from pg_inherits
+        self._ensured = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def partition_name(self, month):
+        """
+        Args:
+            month (pd.Timestamp): any time of the month
+
+        Returns:
+            str: name of the partition of the month, e.g. songplays_y2018m11
+        """
+        return '{}_y{:04d}m{:02d}'.format(self.table, month.year, month.month)
+
+    def month_of(self, partition_name):
+        """
+        Inverse of partition_name
+        Args:
+            partition_name (str): name of a partition of the table
+
+        Returns:
+            pd.Timestamp: first day of the month of the partition. None if it is not a monthly partition \
+            (not named by partition_name).
+        """
+        match = re.match(r'^{}_y(\d{{4}})m(\d{{2}})$'.format(re.escape(self.table)), partition_name)
+        if match is None:
+            return None
+        return pd.Timestamp(year=int(match.group(1)), month=int(match.group(2)), day=1)
+
+    @staticmethod
+    def months(values):
+        """
+        Args:
+            values (pd.Series): timestamps
+
+        Returns:
+            list: first day (pd.Timestamp) of each distinct month of the values, sorted
+        """
+        values = pd.to_datetime(pd.Series(values)).dropna()
+        return sorted(set(values.dt.to_period('M').dt.to_timestamp()))
+
+    def create_query(self, month):
+        """
+        CREATE TABLE IF NOT EXISTS ... PARTITION OF query of the partition of the month
+        Args:
+            month (pd.Timestamp): first day of the month
+
+        Returns:
+            sql.Composed
+        """
+        lower = pd.Timestamp(year=month.year, month=month.month, day=1)
+        upper = lower + pd.DateOffset(months=1)
+        return sql.SQL("CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} "
+                       "FOR VALUES FROM ({lower}) TO ({upper});").format(
+            partition=sql.Identifier(self.partition_name(lower)),
+            table=sql.Identifier(self.table),
+            lower=sql.Literal(lower.strftime('%Y-%m-%d')),
+            upper=sql.Literal(upper.strftime('%Y-%m-%d')))
+
+    def _known(self, cur):
+        """
+        Names of the partitions known to exist, for the connection of the cursor (called with the lock)
+        """
+        conn = cur.connection
+        if conn not in self._ensured:
+            self._ensured[conn] = set(self.list(cur))
+        return self._ensured[conn]
+
+    def ensure(self, cur, values):
+        """
+        Create the missing partitions of the months of the values, in one round trip
+        The partitions already ensured on the connection (or attached when it first ensured a partition) \
+        are skipped without a query.
+        Args:
+            cur (psycopg2.cursor): cursor
+            values (pd.Series): timestamps to load
+
+        Returns:
+            list: names of the partitions of the months
+        """
+        months = self.months(values)
+        with self._lock:
+            known = self._known(cur) if len(months) > 0 else set()
+            missing = [month for month in months if self.partition_name(month) not in known]
+            if len(missing) > 0:
+                with stage('partitions.ensure', table=self.table, rows_in=len(missing)):
+                    cur.execute(sql.SQL(' ').join([self.create_query(month) for month in missing]))
+                known.update(self.partition_name(month) for month in missing)
+        return [self.partition_name(month) for month in months]
+
+    def forget(self):
+        """
+        Forget the partitions ensured, e.g. after a rollback (which also rolls back the partitions it created) \
+        or when partitions are detached: the next ensure of each connection reads them again from the catalog
+        Returns:
+            None
+        """
+        with self._lock:
+            self._ensured.clear()
+        return None
+
+    def route(self, df):
+        """
+        Split the rows by partition
+        Args:
+            df (pd.DataFrame): rows of the table, with the partition key column
+
+        Returns:
+            list: list of (partition name, pd.DataFrame), sorted by month. The rows with a null key are dropped \
+            (they are not in any partition, and the key is part of the primary key).
+        """
+        df = df[df[self.column].notnull()]
+        if df.shape[0] == 0:
+            return []
+        periods = pd.to_datetime(df[self.column]).dt.to_period('M')
+        return [(self.partition_name(period.to_timestamp()), part)
+                for period, part in df.groupby(periods, sort=True)]
+
+    def list(self, cur):
+        """
+        Partitions attached to the table, the one found through the search_path (not its namesakes in other schemas)
+        Args:
+            cur (psycopg2.cursor): cursor
+
+        Returns:
+            list: names of the partitions, sorted by name (by month for the monthly partitions)
+        """
+        cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname;""", (self.table,))
+        return [r[0] for r in cur.fetchall()]
+
+    def detach(self, cur, month, concurrently=False):
+        """
+        Detach the partition of the month: its rows leave the table (and its queries) but are kept in a table \
+        of their own, without deleting them row by row
+        Args:
+            cur (psycopg2.cursor): cursor
+            month (pd.Timestamp): any time of the month
+            concurrently (bool): DETACH ... CONCURRENTLY (PostgreSQL 14+), which does not block the queries \
+            of the table. Needs a connection in autocommit mode.
+
+        Returns:
+            str: name of the detached table
+        """
+        name = self.partition_name(month)
+        self.forget()
+        cur.execute(sql.SQL("ALTER TABLE {table} DETACH PARTITION {partition}{concurrently};").format(
+            table=sql.Identifier(self.table),
+            partition=sql.Identifier(name),
+            concurrently=sql.SQL(' CONCURRENTLY' if concurrently else '')))
+        return name
+
+    def archive(self, cur, month, directory):
+        """
+        Detach the partition of the month, export it to a gzipped csv file, then drop it
+        Args:
+            cur (psycopg2.cursor): cursor
+            month (pd.Timestamp): any time of the month
+            directory (str): directory of the archives
+
+        Returns:
+            str: path of the archive
+        """
+        name = self.detach(cur=cur, month=month)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '{}.csv.gz'.format(name))
+        with stage('partitions.archive', table=name) as m:
+            with gzip.open(path, 'wb') as f:
+                cur.copy_expert(sql.SQL("COPY {partition} TO STDOUT WITH CSV HEADER;").format(
+                    partition=sql.Identifier(name)), f)
+            m.rows_out = cur.rowcount
+            m.bytes = os.path.getsize(path)
+        cur.execute(sql.SQL("DROP TABLE {partition};").format(partition=sql.Identifier(name)))
+        return path
+
+    def archive_before(self, cur, before, directory):
+        """
+        Archive the monthly partitions of the months before a date (retention)
+        Args:
+            cur (psycopg2.cursor): cursor
+            before (pd.Timestamp): the months starting before this date are archived
+            directory (str): directory of the archives
+
+        Returns:
+            list: paths of the archives
+        """
+        before = pd.Timestamp(before)
+        months = [self.month_of(name) for name in self.list(cur)]
+        return [self.archive(cur=cur, month=month, directory=directory)
+                for month in months if month is not None and month < before]
+
+
+songplays_partitions = MonthlyPartitions(table='songplays', column='start_time')
+
+
+def main():
+    """
+    List or archive the partitions of songplays from the command line
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Partitions of the songplays table')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='list the partitions')
+    parser_archive = subparsers.add_parser('archive', help='archive and drop the old partitions')
+    parser_archive.add_argument('--before', required=True, help='archive the months before this date, e.g. 2018-11')
+    parser_archive.add_argument('--directory', default='../data/archive', help='directory of the archives')
+    args = parser.parse_args()
+
+    conn = connection_sparkifydb(autocommit=False)
+    cur = conn.cursor()
+    if args.command == 'list':
+        for name in songplays_partitions.list(cur):
+            print(name)
+    else:
+        before = pd.Timestamp(args.before)
+        for name in songplays_partitions.list(cur):
+            month = songplays_partitions.month_of(name)
+            if month is not None and month < before:
+                path = songplays_partitions.archive(cur=cur, month=month, directory=args.directory)
+                # one transaction per partition: a partition is only dropped from the database once archived
+                conn.commit()
+                print('archived', path)
+    conn.close()
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import struct
+import itertools
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+
+# Encoder of the PostgreSQL binary COPY format
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+# The values are encoded from the type of the column in the target table, not from the dtype of the DataFrame
+
+copy_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+copy_trailer = struct.pack('>h', -1)
+_null = struct.pack('>i', -1)
+
+# PostgreSQL epoch (2000-01-01) in microseconds since the unix epoch
+_pg_epoch_us = 946684800000000
+
+# fixed-width types: numpy big-endian format of the value
+_fixed_types = {
+    'smallint': '>i2',
+    'integer': '>i4',
+    'bigint': '>i8',
+    'real': '>f4',
+    'double precision': '>f8',
+    'boolean': '?',
+    'timestamp without time zone': '>i8'
+}
+
+# text types: utf-8 bytes of the value
+_text_types = {'character varying', 'character', 'text'}
+
+# integer types: bounds of the values
+_integer_types = {'smallint': np.int16, 'integer': np.int32, 'bigint': np.int64}
+
+# Cache of the column types of the tables: {(dsn of the connection, schema, tablename): list of types}. \
+# The schema is the one the name resolves to with the search_path, e.g. public or a test schema.
+# Cleared when the tables are dropped (create_tables.drop_tables), see clear_table_types
+_table_types = {}
+
+
+def clear_table_types():
+    """
+    Forget the column types of the tables, e.g. after the tables were dropped and created again
+    Returns:
+        None
+    """
+    _table_types.clear()
+    return None
+
+
+def get_table_types(cur, tablename, use_cache=True):
+    """
+    Types of the columns of a table, in the order of the columns
+    The table name is resolved with the search_path, so that it also works for temporary tables.
+    Args:
+        cur (psycopg2.cursor): cursor
+        tablename (str): name of the table
+        use_cache (bool): If True, the types are queried once per database, schema and table name \
+        (the schema of the table is still resolved at each call)
+
+    Returns:
+        list: e.g. ['timestamp without time zone', 'integer', 'character varying']
+    """
+    regclass = sql.Identifier(tablename).as_string(cur)
+    cur.execute("""
+    SELECT c.oid, n.nspname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = %s::regclass;""", (regclass,))
+    oid, schema = cur.fetchone()
+    key = (getattr(getattr(cur, 'connection', None), 'dsn', None), schema, tablename)
+    if use_cache and key in _table_types:
+        return _table_types[key]
+    query = """
+    SELECT format_type(a.atttypid, NULL)
+    FROM pg_attribute a
+    WHERE a.attrelid = %s AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attnum;
+    """
+    cur.execute(query, (oid,))
+    types = [r[0] for r in cur.fetchall()]
+    _table_types[key] = types
+    return types
+
+
+def _is_fixed(pgtype):
+    """
+    True if the type is encoded with a fixed width
+    """
+    return pgtype in _fixed_types
+
+
+def _check_integers(s, pgtype):
+    """
+    Check that the values fit the integer type of the column: the binary format would otherwise send them \
+    wrapped or truncated, where the server rejects them in the csv format
+    Args:
+        s (pd.Series): values, without the nulls
+        pgtype (str): integer type of the column
+
+    Returns:
+        None
+    Raises:
+        ValueError: a value is not an integer, or out of the range of the type
+    """
+    info = np.iinfo(_integer_types[pgtype])
+    if s.dtype == object:
+        s = pd.to_numeric(s, errors='raise')
+    if pd.api.types.is_bool_dtype(s.dtype) or s.shape[0] == 0:
+        return None
+    if pd.api.types.is_integer_dtype(s.dtype):
+        values = s.to_numpy(dtype=np.int64)
+        bad = (values < info.min) | (values > info.max)
+    else:
+        values = s.to_numpy(dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            bad = ~np.isfinite(values) | (values != np.floor(values)) | (values < info.min) | (values > info.max)
+    if bad.any():
+        raise ValueError('Value {} does not fit the {} column'.format(s.iloc[int(np.flatnonzero(bad)[0])], pgtype))
+    return None
+
+
+def _encode_fixed(s, pgtype):
+    """
+    Encode a column of a fixed-width type
+    Args:
+        s (pd.Series): values
+        pgtype (str): type of the column in the table
+
+    Returns:
+        list: one bytes object per row (length + value, or the null marker)
+    """
+    isnull = pd.isnull(s).values
+    fmt = _fixed_types[pgtype]
+    if pgtype == 'timestamp without time zone':
+        values = pd.to_datetime(s).values.astype('datetime64[us]').astype(np.int64) - _pg_epoch_us
+    elif pgtype == 'boolean':
+        values = s.fillna(False).astype(bool).values
+    else:
+        if pgtype in _integer_types:
+            _check_integers(s[~isnull], pgtype)
+        # nulls are replaced by 0 (they are sent as null below), then converted to a native numpy type
+        if isnull.any():
+            s = s.where(~isnull, 0)
+        values = s.to_numpy(dtype=np.dtype(fmt).newbyteorder('='))
+    size = np.dtype(fmt).itemsize
+    rows = np.empty(s.shape[0], dtype=[('len', '>i4'), ('val', fmt)])
+    rows['len'] = size
+    rows['val'] = values
+    buf = rows.tobytes()
+    width = 4 + size
+    pieces = [buf[i:i + width] for i in range(0, len(buf), width)]
+    if isnull.any():
+        for i in np.flatnonzero(isnull):
+            pieces[i] = _null
+    return pieces
+
+
+def _encode_text(s):
+    """
+    Encode a column of a text type (varchar, char, text) as utf-8
+    Args:
+        s (pd.Series): values
+
+    Returns:
+        list: one bytes object per row (length + value, or the null marker)
+    """
+    pieces = []
+    pack = struct.Struct('>i').pack
+    for v in s.astype(object).values:
+        if v is None or (isinstance(v, float) and np.isnan(v)) or v is pd.NA:
+            pieces.append(_null)
+        else:
+            b = str(v).encode('utf-8')
+            pieces.append(pack(len(b)) + b)
+    return pieces
+
+
+def encode_rows(df, types):
+    """
+    Encode the rows of the DataFrame in the binary COPY format (without header nor trailer)
+    Args:
+        df (pd.DataFrame): data, with the columns in the order of the table
+        types (list): types of the columns of the table (see get_table_types)
+
+    Returns:
+        bytes
+    """
+    if df.shape[1] != len(types):
+        raise ValueError('{} columns in the data, {} in the table'.format(df.shape[1], len(types)))
+    if df.shape[0] == 0:
+        return b''
+    columns = []
+    for i, pgtype in enumerate(types):
+        s = df.iloc[:, i]
+        if _is_fixed(pgtype):
+            columns.append(_encode_fixed(s, pgtype))
+        elif pgtype in _text_types:
+            columns.append(_encode_text(s))
+        else:
+            raise ValueError('Type {} is not supported by the binary COPY encoder'.format(pgtype))
+    row_header = itertools.repeat(struct.pack('>h', len(types)), df.shape[0])
+    return b''.join(itertools.chain.from_iterable(zip(row_header, *columns)))
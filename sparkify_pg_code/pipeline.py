@@ -0,0 +1,259 @@
+import queue
+import threading
+import time
+from sparkify_pg_code.instrumentation import stage
+
+# Pipelined execution: the items go through a chain of stages, each run by a thread of its own and connected to \
+# the next one by a bounded queue, so that the stages overlap (e.g. the next files are parsed while the database \
+# copies the current batch). The last stage is the consumer iterating over the pipeline, in the calling thread.
+# - Order: one thread per stage and FIFO queues, so the items come out in the order of the source
+# - Backpressure: a stage blocks while its output queue is full (max_pending items), so the memory stays bounded \
+# if the consumer is the slowest stage
+# - Errors: an exception raised by the source or a stage is passed down the queues and raised by the iteration \
+# as a StageError naming the stage (chained to the original exception, recorded as an error of the \
+# instrumentation stage pipeline.<name>); close stops all the threads, also if the consumer stops early
+# - Utilization: for each stage, the time spent working, waiting for its input (starved) and waiting for room \
+# in its output queue (blocked). The stage with the highest utilization is the bottleneck.
+# The threads share the GIL: the overlap comes from the stages which release it (database round trips, file reads).
+
+# Sentinel marking the end of the items in a queue
+_END = object()
+# Timeout of the blocking queue operations, to check whether the pipeline is stopped
+_POLL_SECONDS = 0.1
+
+
+class StageError(Exception):
+    """
+    Exception raised by a stage of a Pipeline, re-raised by the iteration (the original one is its __cause__)
+    Args:
+        stage (str): name of the stage
+        error (Exception): exception raised by the stage
+    """
+
+    def __init__(self, stage, error):
+        super().__init__('Error in the pipeline stage {}: {}'.format(stage, error))
+        self.stage = stage
+        self.error = error
+
+
+class _Failure(object):
+    """
+    Exception raised by a stage, passed down the queues to the consumer
+    """
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+
+
+class StageStats(object):
+    """
+    Time spent by a stage of a Pipeline
+    Args:
+        name (str): name of the stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def to_dict(self, wall):
+        return {
+            'items': self.items,
+            'busy': self.busy,
+            'starved': self.starved,
+            'blocked': self.blocked,
+            'utilization': self.busy / wall if wall > 0 else 0.0
+        }
+
+
+class Pipeline(object):
+    """
+    Run the items of source through stages run by threads connected by bounded queues
+    Iterating over the pipeline yields the output of the last stage; the work done by the loop body is measured \
+    as the consumer stage (sink_name).
+    Args:
+        source (iterable): items, iterated in a thread of its own
+        stages (list): list of (name, function) applied in order, each function takes the output of the previous one
+        max_pending (int): capacity of each queue
+        source_name (str): name of the source stage in the stats
+        sink_name (str): name of the consumer stage in the stats
+    Examples:
+        with Pipeline(source=batches, stages=[('read', read), ('transform', transform)]) as pipeline:
+            for item in pipeline:
+                load(item)
+        print(pipeline.report())
+    """
+
+    def __init__(self, source, stages, max_pending=2, source_name='source', sink_name='sink'):
+        assert max_pending >= 1
+        self.source = source
+        self.stages = stages
+        self.max_pending = max_pending
+        self.source_name = source_name
+        self.sink_name = sink_name
+        self._stop = threading.Event()
+        self._queues = [queue.Queue(maxsize=max_pending) for _ in range(len(stages) + 1)]
+        self._stats = [StageStats(source_name)] + [StageStats(name) for name, _ in stages] + [StageStats(sink_name)]
+        self._threads = []
+        self._t_start = None
+        self._t_end = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _put(self, q, item, stats):
+        """
+        Put the item in the queue, waiting for room unless the pipeline is stopped
+        Returns:
+            bool: False if the pipeline was stopped
+        """
+        t0 = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    q.put(item, timeout=_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stats.blocked += time.perf_counter() - t0
+
+    def _get(self, q, stats):
+        """
+        Get the next item of the queue, waiting for it unless the pipeline is stopped
+        Returns:
+            object: item, or _END if the pipeline was stopped
+        """
+        t0 = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    return q.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+            return _END
+        finally:
+            stats.starved += time.perf_counter() - t0
+
+    def _run_source(self):
+        stats, out = self._stats[0], self._queues[0]
+        try:
+            items = iter(self.source)
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    stats.busy += time.perf_counter() - t0
+                stats.items += 1
+                if not self._put(out, item, stats):
+                    return
+        except Exception as e:
+            self._put(out, _Failure(self.source_name, e), stats)
+            return
+        self._put(out, _END, stats)
+
+    def _run_stage(self, i):
+        name, func = self.stages[i]
+        stats, inp, out = self._stats[i + 1], self._queues[i], self._queues[i + 1]
+        while True:
+            item = self._get(inp, stats)
+            if item is _END or isinstance(item, _Failure):
+                # end of the items, or error upstream: pass it down and stop
+                self._put(out, item, stats)
+                return
+            t0 = time.perf_counter()
+            try:
+                result = func(item)
+            except Exception as e:
+                self._put(out, _Failure(name, e), stats)
+                return
+            finally:
+                stats.busy += time.perf_counter() - t0
+            stats.items += 1
+            if not self._put(out, result, stats):
+                return
+
+    def start(self):
+        """
+        Start the threads of the source and the stages (done by the iteration if not called before)
+        """
+        if self._t_start is not None:
+            return None
+        self._t_start = time.perf_counter()
+        threads = [threading.Thread(target=self._run_source, name='pipeline-' + self.source_name, daemon=True)]
+        for i, (name, _) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_stage, args=(i,), name='pipeline-' + name, daemon=True))
+        for thread in threads:
+            thread.start()
+        self._threads = threads
+        return None
+
+    def __iter__(self):
+        self.start()
+        stats, inp = self._stats[-1], self._queues[-1]
+        while True:
+            item = self._get(inp, stats)
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                with stage('pipeline.' + item.stage):
+                    raise StageError(item.stage, item.error) from item.error
+            stats.items += 1
+            # the time until the next item is requested is the work of the consumer
+            t0 = time.perf_counter()
+            try:
+                yield item
+            finally:
+                stats.busy += time.perf_counter() - t0
+
+    def close(self):
+        """
+        Stop the threads and wait for them. The items not consumed yet are dropped.
+        Returns:
+            None
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        if self._t_start is not None and self._t_end is None:
+            self._t_end = time.perf_counter()
+        return None
+
+    def stats(self):
+        """
+        Returns:
+            dict: {stage name: {'items', 'busy', 'starved', 'blocked', 'utilization'}}, in the order of the stages. \
+            Times in seconds, utilization = busy / elapsed time of the pipeline.
+        """
+        if self._t_start is None:
+            wall = 0.0
+        else:
+            wall = (self._t_end if self._t_end is not None else time.perf_counter()) - self._t_start
+        return {s.name: s.to_dict(wall) for s in self._stats}
+
+    def report(self):
+        """
+        Returns:
+            str: one line per stage, and the bottleneck (stage with the highest utilization)
+        """
+        stats = self.stats()
+        lines = ['{:<12} {:>8} {:>10} {:>10} {:>10} {:>6}'.format(
+            'stage', 'items', 'busy(s)', 'starved(s)', 'blocked(s)', 'util')]
+        for name, s in stats.items():
+            lines.append('{:<12} {:>8d} {:>10.2f} {:>10.2f} {:>10.2f} {:>5.0f}%'.format(
+                name, s['items'], s['busy'], s['starved'], s['blocked'], 100 * s['utilization']))
+        bottleneck = max(stats, key=lambda name: stats[name]['utilization'])
+        lines.append('bottleneck: {}'.format(bottleneck))
+        return '\n'.join(lines)
@@ -0,0 +1,130 @@
+from psycopg2 import sql
+from sparkify_pg_code.sql_queries import songplays_rollup_ctes, rollup_tables, top_songs_select, \
+    top_artists_select, top_users_select
+from sparkify_pg_code.instrumentation import stage
+
+# Rollups of the songplays: plays per song / artist / user per day, and per level per hour (see sql_queries.py)
+# They are maintained by the statement which inserts the songplays: the insert returns the rows actually inserted \
+# (ON CONFLICT DO NOTHING skips the rows already loaded), and the CTEs add them to the rollups, e.g.
+#   WITH inserted AS (INSERT INTO songplays ... ON CONFLICT DO NOTHING RETURNING start_time, user_id, ...),
+#   song_plays AS (INSERT INTO song_plays_daily SELECT ... FROM inserted GROUP BY ... ON CONFLICT DO UPDATE ...),
+#   ...
+#   SELECT COUNT(*) FROM inserted;
+# so the rollups are updated in the same transaction as the songplays, and are rolled back with them.
+# The rollups count each inserted row once: the merge of the songplays must not update rows (merge policy \
+# do_nothing), and archiving a partition of songplays (partitions.py) does not change them.
+
+
+class Rollups(object):
+    """
+    Rollups maintained from the rows inserted into a table
+    Args:
+        columns (list): columns of the inserted rows used by the CTEs
+        ctes (str): data-modifying CTEs reading the rows from a CTE named inserted
+        tables (list): rollup tables
+        source (str): table of the rows
+    """
+
+    def __init__(self, columns, ctes, tables, source):
+        self.columns = columns
+        self.ctes = ctes
+        self.tables = tables
+        self.source = source
+
+    def _statement(self, rows_query):
+        """
+        Args:
+            rows_query (sql.Composable): query giving the rows (the CTE inserted)
+
+        Returns:
+            sql.Composed: statement updating the rollups, which returns the number of rows
+        """
+        return sql.SQL("WITH inserted AS ({rows_query}), {ctes} SELECT COUNT(*) FROM inserted;").format(
+            rows_query=rows_query, ctes=sql.SQL(self.ctes))
+
+    def wrap(self, insert_query):
+        """
+        Statement which runs the insert and adds the inserted rows to the rollups
+        Args:
+            insert_query (str/sql.Composable): INSERT statement into the source table, without RETURNING. \
+            A str may end with a semicolon (the queries of sql_queries.py, which may contain the VALUES %s \
+            placeholder of execute_values), a sql.Composable must not (see utils.MergePolicy.merge_query).
+
+        Returns:
+            sql.Composed: statement, which returns the number of rows inserted
+        """
+        if isinstance(insert_query, str):
+            insert_query = sql.SQL(insert_query.strip().rstrip(';'))
+        return self._statement(sql.SQL("{insert_query} RETURNING {columns}").format(
+            insert_query=insert_query,
+            columns=sql.SQL(', ').join([sql.Identifier(c) for c in self.columns])))
+
+    def rebuild(self, cur):
+        """
+        Recompute the rollups from the whole source table, e.g. after they were added to an existing database
+        Args:
+            cur (psycopg2.cursor): cursor
+
+        Returns:
+            int: number of rows of the source table
+        """
+        with stage('rollups.rebuild', table=self.source) as m:
+            cur.execute(sql.SQL("TRUNCATE {tables};").format(
+                tables=sql.SQL(', ').join([sql.Identifier(t) for t in self.tables])))
+            cur.execute(self._statement(sql.SQL("SELECT {columns} FROM {source}").format(
+                columns=sql.SQL(', ').join([sql.Identifier(c) for c in self.columns]),
+                source=sql.Identifier(self.source))))
+            m.rows_in = cur.fetchone()[0]
+        return m.rows_in
+
+
+songplays_rollups = Rollups(columns=['start_time', 'user_id', 'level', 'song_id', 'artist_id'],
+                            ctes=songplays_rollup_ctes, tables=rollup_tables, source='songplays')
+
+
+def top_songs(cur, first_day, last_day, n=10):
+    """
+    Most played songs between two days, read from the rollup song_plays_daily
+    Args:
+        cur (psycopg2.cursor): cursor
+        first_day (str/datetime.date): first day (included)
+        last_day (str/datetime.date): last day (excluded)
+        n (int): number of songs
+
+    Returns:
+        list: list of (artist name, song title, number of plays)
+    """
+    cur.execute(top_songs_select, (first_day, last_day, n))
+    return cur.fetchall()
+
+
+def top_artists(cur, first_day, last_day, n=10):
+    """
+    Most played artists between two days, read from the rollup artist_plays_daily
+    Args:
+        cur (psycopg2.cursor): cursor
+        first_day (str/datetime.date): first day (included)
+        last_day (str/datetime.date): last day (excluded)
+        n (int): number of artists
+
+    Returns:
+        list: list of (artist name, number of plays)
+    """
+    cur.execute(top_artists_select, (first_day, last_day, n))
+    return cur.fetchall()
+
+
+def top_users(cur, first_day, last_day, n=10):
+    """
+    Users with the most plays between two days, read from the rollup user_plays_daily
+    Args:
+        cur (psycopg2.cursor): cursor
+        first_day (str/datetime.date): first day (included)
+        last_day (str/datetime.date): last day (excluded)
+        n (int): number of users
+
+    Returns:
+        list: list of (user_id, first name, last name, number of plays)
+    """
+    cur.execute(top_users_select, (first_day, last_day, n))
+    return cur.fetchall()
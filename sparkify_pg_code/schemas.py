@@ -0,0 +1,92 @@
+import pandas as pd
+
+# Declared schemas of the raw input files: {column: dtype}
+# - Only the columns listed are kept (projection), the other attributes of the json are dropped when reading
+# - Numeric columns get a fixed type. Nullable integers (Int64) are used where the source can be empty ("" or null)
+# - Low-cardinality strings are stored as categoricals: one python string per distinct value instead of per row
+
+# song_data/*.json: one song per line
+song_schema = {
+    'song_id': 'object',
+    'title': 'object',
+    'artist_id': 'object',
+    'year': 'Int32',
+    'duration': 'float64',
+    'artist_name': 'object',
+    'artist_location': 'object',
+    'artist_latitude': 'float64',
+    'artist_longitude': 'float64'
+}
+
+# log_data/YYYY/MM/YYYY-MM-DD-events.json: one event per line
+# auth, method, status, itemInSession and registration are not used by the tables and are not read
+log_schema = {
+    'ts': 'int64',
+    'userId': 'Int64',
+    'firstName': 'object',
+    'lastName': 'object',
+    'gender': 'category',
+    'level': 'category',
+    'page': 'category',
+    'sessionId': 'Int32',
+    'location': 'category',
+    'userAgent': 'category',
+    'song': 'object',
+    'artist': 'object',
+    'length': 'float64'
+}
+
+
+def _cast(s, dtype):
+    """
+    Cast a raw column to the declared dtype
+    - Numeric: values which are not numbers (e.g. empty strings) become null
+    - Nullable integers (Int64, Int32) keep the nulls, the other integers must not have any
+    Args:
+        s (pd.Series): raw column
+        dtype (str): declared dtype
+
+    Returns:
+        pd.Series
+    """
+    if dtype in ('object', 'category'):
+        # categories are built from the distinct strings; nulls stay nulls
+        return s.astype(dtype)
+    return pd.to_numeric(s, errors='coerce').astype(dtype)
+
+
+def apply_schema(df, schema):
+    """
+    Project the raw rows on the columns of the schema, in the order of the schema, and cast them to their dtype
+    Columns of the schema missing from df are created empty (null, with a nullable integer type if needed).
+    Args:
+        df (pd.DataFrame): raw rows as read from the json (read with dtype=False)
+        schema (dict): {column: dtype}, e.g. song_schema or log_schema
+
+    Returns:
+        pd.DataFrame
+    """
+    columns = {}
+    for col, dtype in schema.items():
+        if col in df.columns:
+            columns[col] = _cast(df[col], dtype)
+        else:
+            if dtype.startswith('int'):
+                # a missing column is null: use the nullable integer type
+                dtype = dtype.capitalize()
+            columns[col] = _cast(pd.Series([None] * df.shape[0], index=df.index, dtype=object), dtype)
+    return pd.DataFrame(columns, index=df.index)
+
+
+def memory_per_row(df):
+    """
+    Memory used by the DataFrame, per row, including the python objects (strings)
+    Args:
+        df (pd.DataFrame)
+
+    Returns:
+        float: bytes per row
+    """
+    if df.shape[0] == 0:
+        return 0.0
+    return df.memory_usage(deep=True, index=False).sum() / df.shape[0]
@@ -2,11 +2,18 @@
 
 # DROP TABLES
 
-songplay_table_drop = "DROP TABLE IF EXISTS  songplays"
+songplay_table_drop = "DROP TABLE IF EXISTS  songplays"  # and its partitions
 user_table_drop = "DROP TABLE IF EXISTS  users"
+user_history_table_drop = "DROP TABLE IF EXISTS users_history"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS  TIME"
+load_manifest_table_drop = "DROP TABLE IF EXISTS load_manifest"
+load_generation_table_drop = "DROP TABLE IF EXISTS load_generation"
+song_plays_daily_drop = "DROP TABLE IF EXISTS song_plays_daily"
+artist_plays_daily_drop = "DROP TABLE IF EXISTS artist_plays_daily"
+user_plays_daily_drop = "DROP TABLE IF EXISTS user_plays_daily"
+level_plays_hourly_drop = "DROP TABLE IF EXISTS level_plays_hourly"
 
 # CREATE TABLES
 
@@ -22,9 +29,10 @@ CREATE TABLE songplays
         location VARCHAR,
         user_agent VARCHAR,
         PRIMARY KEY (start_time, user_id)
-);
+) PARTITION BY RANGE (start_time);
 
 """)
+# songplays is partitioned by month of start_time: the partitions are created by the loader (see partitions.py)
 
 user_table_create = ("""
 CREATE TABLE users (
@@ -37,6 +45,18 @@ CREATE TABLE users (
 );
 """)
 
+# history of the level of the users (slowly changing dimension, type 2): one row per level change, \
+# valid from valid_from until valid_to (NULL for the current level)
+user_history_table_create = ("""
+CREATE TABLE users_history (
+    user_id INTEGER,
+    level VARCHAR(32),
+    valid_from TIMESTAMP,
+    valid_to TIMESTAMP,
+    PRIMARY KEY (user_id, valid_from)
+);
+""")
+
 song_table_create = ("""
 CREATE TABLE songs (
     song_id VARCHAR(64),
@@ -73,6 +93,67 @@ CREATE TABLE time (
     
 """)
 
+load_manifest_table_create = ("""
+CREATE TABLE load_manifest (
+    path VARCHAR,
+    size BIGINT,
+    mtime DOUBLE PRECISION,
+    content_hash CHAR(64),
+    n_rows INTEGER,
+    loaded_at TIMESTAMP,
+    PRIMARY KEY (path)
+);
+""")
+
+# generation of the loaded data: bumped by the ETL with each commit of loaded files (see analytics.py)
+load_generation_table_create = ("""
+CREATE TABLE load_generation (
+    id SMALLINT CHECK (id = 1),
+    generation BIGINT NOT NULL,
+    updated_at TIMESTAMP,
+    PRIMARY KEY (id)
+);
+""")
+
+# ROLLUPS: number of plays of the songplays, maintained by the loads (see rollups.py)
+
+song_plays_daily_create = ("""
+CREATE TABLE song_plays_daily (
+    day DATE,
+    song_id VARCHAR(64),
+    artist_id VARCHAR(64),
+    n_plays BIGINT NOT NULL,
+    PRIMARY KEY (day, song_id)
+);
+""")
+
+artist_plays_daily_create = ("""
+CREATE TABLE artist_plays_daily (
+    day DATE,
+    artist_id VARCHAR(64),
+    n_plays BIGINT NOT NULL,
+    PRIMARY KEY (day, artist_id)
+);
+""")
+
+user_plays_daily_create = ("""
+CREATE TABLE user_plays_daily (
+    day DATE,
+    user_id INTEGER,
+    n_plays BIGINT NOT NULL,
+    PRIMARY KEY (day, user_id)
+);
+""")
+
+level_plays_hourly_create = ("""
+CREATE TABLE level_plays_hourly (
+    hour TIMESTAMP,
+    level VARCHAR(32),
+    n_plays BIGINT NOT NULL,
+    PRIMARY KEY (hour, level)
+);
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -112,6 +193,225 @@ ON CONFLICT (start_time)
     DO NOTHING ;
 """)
 
+# INSERT RECORDS BY PAGES
+# Same semantics as the queries above, for psycopg2.extras.execute_values: VALUES %s is replaced by a page of rows
+
+songplay_table_insert_values = ("""
+INSERT INTO
+    songplays(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+VALUES %s
+ON CONFLICT (start_time, user_id) DO NOTHING;
+""")
+
+user_table_insert_values = ("""
+INSERT INTO users(user_id, first_name, last_name, gender, level)
+VALUES %s
+ON CONFLICT (user_id)
+DO UPDATE
+SET level = excluded.level ;
+""")
+
+song_table_insert_values = ("""
+INSERT INTO songs (song_id, title, artist_id, year, duration)
+VALUES %s
+ON CONFLICT (song_id)
+    DO NOTHING;
+""")
+
+artist_table_insert_values = ("""
+INSERT INTO artists (artist_id, name, location, latitude, longitude)
+VALUES %s
+ON CONFLICT (artist_id)
+    DO NOTHING ;
+""")
+
+time_table_insert_values = ("""
+INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+VALUES %s
+ON CONFLICT (start_time)
+    DO NOTHING ;
+""")
+
+user_history_insert_values = ("""
+INSERT INTO users_history (user_id, level, valid_from)
+VALUES %s
+ON CONFLICT (user_id, valid_from)
+    DO NOTHING ;
+""")
+
+# Recompute the history of some users (parameter user_ids, list) after level changes were inserted, \
+# in any order: drop the rows which do not change the level, then close each row at the next one
+user_history_merge = ("""
+DELETE FROM users_history h
+USING (
+    SELECT user_id, valid_from, level, LAG(level) OVER (PARTITION BY user_id ORDER BY valid_from) AS previous_level
+    FROM users_history
+    WHERE user_id = ANY(%(user_ids)s)
+) p
+WHERE h.user_id = p.user_id AND h.valid_from = p.valid_from AND h.level = p.previous_level;
+UPDATE users_history h
+SET valid_to = n.next_from
+FROM (
+    SELECT user_id, valid_from, LEAD(valid_from) OVER (PARTITION BY user_id ORDER BY valid_from) AS next_from
+    FROM users_history
+    WHERE user_id = ANY(%(user_ids)s)
+) n
+WHERE h.user_id = n.user_id AND h.valid_from = n.valid_from AND h.valid_to IS DISTINCT FROM n.next_from;
+""")
+
+# songplays with the song_id and artist_id found for each row of the page, like song_select (first match)
+songplay_table_insert_select = ("""
+INSERT INTO
+    songplays(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT v.start_time, v.user_id, v.level, sa.song_id, sa.artist_id, v.session_id, v.location, v.user_agent
+FROM (VALUES %s) AS v (start_time, user_id, level, session_id, location, user_agent, song, length, artist)
+LEFT JOIN LATERAL (
+    SELECT songs.song_id, artists.artist_id
+    FROM songs
+    JOIN artists USING (artist_id)
+    WHERE
+    songs.title = v.song AND
+    songs.duration = v.length AND
+    artists.name = v.artist
+    LIMIT 1
+) sa ON TRUE
+ON CONFLICT (start_time, user_id) DO NOTHING;
+""")
+
+# types of the columns of the VALUES of songplay_table_insert_select (a page of nulls would be typed as text)
+songplay_select_template = (
+    "(%s::TIMESTAMP, %s::INTEGER, %s::VARCHAR, %s::INTEGER, %s::VARCHAR, %s::VARCHAR, %s::VARCHAR, "
+    "%s::DOUBLE PRECISION, %s::VARCHAR)"
+)
+
+load_manifest_upsert = ("""
+INSERT INTO load_manifest (path, size, mtime, content_hash, n_rows, loaded_at)
+VALUES %s
+ON CONFLICT (path)
+DO UPDATE
+SET size = excluded.size, mtime = excluded.mtime, content_hash = excluded.content_hash,
+    n_rows = excluded.n_rows, loaded_at = excluded.loaded_at;
+""")
+
+# Bump the load generation and notify the listeners (the notification is delivered when the transaction commits)
+load_generation_bump = ("""
+WITH bumped AS (
+    INSERT INTO load_generation (id, generation, updated_at)
+    VALUES (1, 1, now())
+    ON CONFLICT (id)
+    DO UPDATE SET generation = load_generation.generation + 1, updated_at = excluded.updated_at
+    RETURNING generation
+)
+SELECT generation, pg_notify('load_generation', generation::TEXT) FROM bumped;
+""")
+
+# ROLLUP DELTAS
+# Data-modifying CTEs which add the plays of the rows of a CTE named inserted (start_time, user_id, level, song_id, \
+# artist_id) to the rollups. Each CTE groups the rows by key, so a key is updated once per statement.
+
+songplays_rollup_ctes = ("""
+song_plays AS (
+    INSERT INTO song_plays_daily (day, song_id, artist_id, n_plays)
+    SELECT start_time::DATE, song_id, MIN(artist_id), COUNT(*)
+    FROM inserted
+    WHERE song_id IS NOT NULL
+    GROUP BY start_time::DATE, song_id
+    ON CONFLICT (day, song_id)
+    DO UPDATE SET n_plays = song_plays_daily.n_plays + excluded.n_plays
+),
+artist_plays AS (
+    INSERT INTO artist_plays_daily (day, artist_id, n_plays)
+    SELECT start_time::DATE, artist_id, COUNT(*)
+    FROM inserted
+    WHERE artist_id IS NOT NULL
+    GROUP BY start_time::DATE, artist_id
+    ON CONFLICT (day, artist_id)
+    DO UPDATE SET n_plays = artist_plays_daily.n_plays + excluded.n_plays
+),
+user_plays AS (
+    INSERT INTO user_plays_daily (day, user_id, n_plays)
+    SELECT start_time::DATE, user_id, COUNT(*)
+    FROM inserted
+    GROUP BY start_time::DATE, user_id
+    ON CONFLICT (day, user_id)
+    DO UPDATE SET n_plays = user_plays_daily.n_plays + excluded.n_plays
+),
+level_plays AS (
+    INSERT INTO level_plays_hourly (hour, level, n_plays)
+    SELECT date_trunc('hour', start_time), level, COUNT(*)
+    FROM inserted
+    WHERE level IS NOT NULL
+    GROUP BY date_trunc('hour', start_time), level
+    ON CONFLICT (hour, level)
+    DO UPDATE SET n_plays = level_plays_hourly.n_plays + excluded.n_plays
+)
+""")
+
+rollup_tables = ['song_plays_daily', 'artist_plays_daily', 'user_plays_daily', 'level_plays_hourly']
+
+# TOP N FROM THE ROLLUPS
+# Parameters: first day (included), last day (excluded), number of rows
+
+top_songs_select = ("""
+SELECT a.name, s.title, SUM(r.n_plays) AS n_played
+FROM song_plays_daily r
+LEFT JOIN songs s USING (song_id)
+LEFT JOIN artists a ON a.artist_id = r.artist_id
+WHERE r.day >= %s AND r.day < %s
+GROUP BY a.name, s.title
+ORDER BY n_played DESC
+LIMIT %s;
+""")
+
+top_artists_select = ("""
+SELECT a.name, SUM(r.n_plays) AS n_played
+FROM artist_plays_daily r
+LEFT JOIN artists a USING (artist_id)
+WHERE r.day >= %s AND r.day < %s
+GROUP BY a.name
+ORDER BY n_played DESC
+LIMIT %s;
+""")
+
+top_users_select = ("""
+SELECT r.user_id, u.first_name, u.last_name, SUM(r.n_plays) AS n_played
+FROM user_plays_daily r
+LEFT JOIN users u USING (user_id)
+WHERE r.day >= %s AND r.day < %s
+GROUP BY r.user_id, u.first_name, u.last_name
+ORDER BY n_played DESC
+LIMIT %s;
+""")
+
+# ANALYTICS FROM THE ROLLUPS (see analytics.py)
+
+# plays, active days, first and last day of play of the most active users, with their current level
+# Parameters: first day (included), last day (excluded), number of users
+user_activity_select = ("""
+SELECT r.user_id, u.first_name, u.last_name, u.level, SUM(r.n_plays) AS n_played, COUNT(*) AS active_days,
+    MIN(r.day) AS first_day, MAX(r.day) AS last_day
+FROM user_plays_daily r
+LEFT JOIN users u USING (user_id)
+WHERE r.day >= %s AND r.day < %s
+GROUP BY r.user_id, u.first_name, u.last_name, u.level
+ORDER BY n_played DESC
+LIMIT %s;
+""")
+
+# plays per level and period, and share of each level in the period
+# Parameters: date_trunc unit of the periods ('hour', 'day', 'week' or 'month'), first day (included), \
+# last day (excluded)
+level_mix_select = ("""
+SELECT period, level, n_played, n_played::DOUBLE PRECISION / SUM(n_played) OVER (PARTITION BY period) AS share
+FROM (
+    SELECT date_trunc(%s, r.hour) AS period, r.level, SUM(r.n_plays) AS n_played
+    FROM level_plays_hourly r
+    WHERE r.hour >= %s AND r.hour < %s
+    GROUP BY 1, 2
+) p
+ORDER BY period, level;
+""")
+
 # FIND SONGS
 
 song_select = ("""
@@ -124,8 +424,32 @@ SELECT songs.song_id, artists.artist_id
                     artists.name=(%s);
 """)
 
+# LOAD MANIFEST
+
+load_manifest_select = ("""
+SELECT path, size, mtime, content_hash FROM load_manifest;
+""")
+
+# LOAD GENERATION
+
+load_generation_select = ("""
+SELECT COALESCE(MAX(generation), 0) FROM load_generation;
+""")
+
+# USERS SNAPSHOT: current level of the users, and since when it is known (see dimensions.LatestValues)
+
+user_snapshot_select = ("""
+SELECT u.user_id, u.level, h.valid_from
+FROM users u
+LEFT JOIN users_history h ON h.user_id = u.user_id AND h.valid_to IS NULL;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create,
-                        time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [songplay_table_create, user_table_create, user_history_table_create, song_table_create,
+                        artist_table_create, time_table_create, load_manifest_table_create,
+                        load_generation_table_create, song_plays_daily_create, artist_plays_daily_create,
+                        user_plays_daily_create, level_plays_hourly_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, user_history_table_drop, song_table_drop, artist_table_drop,
+                      time_table_drop, load_manifest_table_drop, load_generation_table_drop, song_plays_daily_drop,
+                      artist_plays_daily_drop, user_plays_daily_drop, level_plays_hourly_drop]
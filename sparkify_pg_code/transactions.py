@@ -0,0 +1,152 @@
+import contextlib
+from sparkify_pg_code.instrumentation import stage
+
+# Transaction granularity of the loads of etl.process_data
+# - statement: autocommit, each statement is committed on its own (one fsync per statement)
+# - file / N files: the files are loaded in a transaction, committed every N files
+# - run: a single transaction for the whole run
+# With savepoints, each batch of files is loaded under a savepoint: if it fails, only this batch is rolled back \
+# (and retried file by file), the other files of the transaction are kept.
+
+
+class TransactionPolicy(object):
+    """
+    When the loads are committed
+    - TransactionPolicy.per_statement(): autocommit
+    - TransactionPolicy.per_file(savepoints): commit after each file
+    - TransactionPolicy.per_files(n, savepoints): commit every n files. The files are committed by whole batches \
+    of process_data: n should be a multiple of batch_size.
+    - TransactionPolicy.per_run(savepoints): commit once, at the end of the run
+    Args:
+        files_per_commit (int): number of files per transaction. 0: autocommit, None: one transaction per run
+        savepoints (bool): If True, load each batch of files under a savepoint and skip the files which fail
+    """
+
+    def __init__(self, files_per_commit=1, savepoints=False):
+        if files_per_commit is not None and files_per_commit < 0:
+            raise ValueError('files_per_commit must be positive, 0 (autocommit) or None (one transaction per run)')
+        self.files_per_commit = files_per_commit
+        self.savepoints = savepoints and files_per_commit != 0
+
+    @classmethod
+    def per_statement(cls):
+        return cls(files_per_commit=0)
+
+    @classmethod
+    def per_file(cls, savepoints=False):
+        return cls(files_per_commit=1, savepoints=savepoints)
+
+    @classmethod
+    def per_files(cls, n, savepoints=False):
+        return cls(files_per_commit=n, savepoints=savepoints)
+
+    @classmethod
+    def per_run(cls, savepoints=False):
+        return cls(files_per_commit=None, savepoints=savepoints)
+
+    @property
+    def autocommit(self):
+        return self.files_per_commit == 0
+
+    def __repr__(self):
+        return 'TransactionPolicy(files_per_commit={}, savepoints={})'.format(self.files_per_commit, self.savepoints)
+
+
+class Committer(object):
+    """
+    Apply a TransactionPolicy to a connection: count the files loaded since the last commit, commit when the policy \
+    says so, and wrap the loads into savepoints. The time of each commit is measured (stage 'commit').
+    The connection is switched to the autocommit mode of the policy when the Committer is created: \
+    an open transaction is committed first.
+    Args:
+        conn (psycopg2.connection): connection
+        policy (TransactionPolicy): If None, commit after each call of done (the behaviour of process_data \
+        without policy) and leave the autocommit mode of the connection as it is
+        before_commit (callable): before_commit(conn), run in the transaction before each commit of loaded files \
+        (in autocommit, once the files are loaded), e.g. analytics.bump_load_generation. Optional.
+    """
+
+    def __init__(self, conn, policy=None, before_commit=None):
+        self.conn = conn
+        self.policy = policy
+        self.before_commit = before_commit
+        self.pending = 0
+        self.n_commits = 0
+        self._n_savepoints = 0
+        if policy is not None and conn.autocommit != policy.autocommit:
+            if not conn.autocommit:
+                conn.commit()
+            conn.autocommit = policy.autocommit
+
+    @property
+    def savepoints(self):
+        return self.policy is not None and self.policy.savepoints
+
+    @contextlib.contextmanager
+    def savepoint(self, cur):
+        """
+        Run the block under a savepoint (if the policy uses savepoints): if the block raises, the changes of the \
+        block are rolled back and the exception is raised again; the rest of the transaction is kept.
+        Args:
+            cur (psycopg2.cursor): cursor of the connection
+
+        Returns:
+            None
+        """
+        if not self.savepoints:
+            yield
+            return
+        self._n_savepoints += 1
+        name = 'load_{}'.format(self._n_savepoints)
+        cur.execute('SAVEPOINT {};'.format(name))
+        try:
+            yield
+        except Exception:
+            cur.execute('ROLLBACK TO SAVEPOINT {name}; RELEASE SAVEPOINT {name};'.format(name=name))
+            raise
+        cur.execute('RELEASE SAVEPOINT {};'.format(name))
+
+    def done(self, n_files):
+        """
+        Files loaded: commit if the policy says so
+        Args:
+            n_files (int): number of files loaded since the last call
+
+        Returns:
+            bool: True if committed
+        """
+        self.pending += n_files
+        if self.policy is None:
+            return self.commit()
+        if self.policy.autocommit:
+            return self.commit()
+        if self.policy.files_per_commit is not None and self.pending >= self.policy.files_per_commit:
+            return self.commit()
+        return False
+
+    def commit(self):
+        """
+        Commit the transaction (no-op in autocommit)
+        Returns:
+            bool: True if committed
+        """
+        if self.pending > 0 and self.before_commit is not None:
+            self.before_commit(self.conn)
+        self.pending = 0
+        if self.conn.autocommit:
+            return False
+        with stage('commit'):
+            self.conn.commit()
+        self.n_commits += 1
+        return True
+
+    def rollback(self):
+        """
+        Roll back the transaction (no-op in autocommit)
+        Returns:
+            None
+        """
+        self.pending = 0
+        if not self.conn.autocommit:
+            self.conn.rollback()
+        return None
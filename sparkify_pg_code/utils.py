@@ -1,42 +1,266 @@
-import glob
 import os
+import re
 import bleach
 import pandas as pd
 import psycopg2
 from psycopg2 import sql
-import sys
-import pathlib
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
+import contextlib
+import functools
+import io
+import itertools
 import datetime
+import uuid
+from sparkify_pg_code.schemas import apply_schema
+from sparkify_pg_code.pgbinary import encode_rows, get_table_types, copy_header, copy_trailer
+from sparkify_pg_code.instrumentation import stage
+from sparkify_pg_code.parsed_cache import get_parsed_cache
 
-def connection_sparkifydb():
+
+sparkifydb_dsn = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def connection_sparkifydb(autocommit=True):
     """
     Connect to the Sparkifydb using username and password provided by Udacity
+    Args:
+        autocommit (bool): If True (default), each statement is committed on its own. \
+        If False, the statements run in a transaction until conn.commit() (see transactions.TransactionPolicy)
     Returns:
         psycopg2.connection
     """
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    conn.autocommit = True
+    conn = psycopg2.connect(sparkifydb_dsn)
+    conn.autocommit = autocommit
     return conn
 
 
-def get_all_files(filepath):
+def connection_pool_sparkifydb(minconn=1, maxconn=5):
+    """
+    Create a thread-safe pool of connections to the Sparkifydb
+    Connections taken from the pool with pooled_connection are in autocommit mode, like connection_sparkifydb
+    Args:
+        minconn (int): number of connections opened at creation
+        maxconn (int): maximum number of connections
+
+    Returns:
+        psycopg2.pool.ThreadedConnectionPool
+    """
+    return ThreadedConnectionPool(minconn, maxconn, sparkifydb_dsn)
+
+
+@contextlib.contextmanager
+def pooled_connection(pool):
+    """
+    Borrow a connection from the pool (in autocommit mode) and give it back at the end of the with block
+    Args:
+        pool (psycopg2.pool.ThreadedConnectionPool): pool of connections
+
+    Returns:
+        psycopg2.connection
+    """
+    conn = pool.getconn()
+    try:
+        conn.autocommit = True
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def _to_date(value):
+    """
+    Args:
+        value (str/datetime.date): date, e.g. '2018-11-05'. None is kept.
+
+    Returns:
+        datetime.date
+    """
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value)
+
+
+def _date_prefix(name, pattern):
+    """
+    Args:
+        name (str): name of a file or directory
+        pattern (re.Pattern): pattern of the date at the start of the name
+
+    Returns:
+        tuple: the integers of the date parts (e.g. (2018, 11)), or None if the name is not a date
+    """
+    match = pattern.match(name)
+    return None if match is None else tuple(int(g) for g in match.groups())
+
+
+# Date layout of the log files: log_data/YYYY/MM/YYYY-MM-DD-events.json
+_year_dir = re.compile(r'^(\d{4})$')
+_month_dir = re.compile(r'^(\d{2})$')
+_day_file = re.compile(r'^(\d{4})-(\d{2})-(\d{2})')
+
+
+def iter_files(filepath, extension='.json', start_date=None, end_date=None):
+    """
+    Yield the files of the directory tree, one directory at a time (os.scandir), as they are found
+    - The entries of each directory are sorted by name, so the order is the same from one run to another \
+    (depth-first, in the order of the names)
+    - With start_date / end_date, the tree is pruned with the date layout of the log files \
+    (YYYY/MM/YYYY-MM-DD-*.json): the directories of the years and months out of the range are not walked, and the \
+    files whose name starts with a date out of the range are skipped. The files and directories whose name is not \
+    a date (e.g. song_data) are not filtered.
+    - Like get_all_files before, hidden files are skipped, the symbolic links to directories are not followed and \
+    the directories which cannot be read are skipped
+    Args:
+        filepath (str): path to explore
+        extension (str): extension of the files
+        start_date (str/datetime.date): first day of the files (included), e.g. '2018-11-01'
+        end_date (str/datetime.date): last day of the files (included)
+
+    Returns:
+        generator: absolute paths of the files
+    """
+    start_date, end_date = _to_date(start_date), _to_date(end_date)
+    lower = (start_date.year, start_date.month, start_date.day) if start_date is not None else None
+    upper = (end_date.year, end_date.month, end_date.day) if end_date is not None else None
+
+    def in_range(parts):
+        # parts: (year,), (year, month) or (year, month, day), compared with the same parts of the bounds
+        return ((lower is None or parts >= lower[:len(parts)]) and
+                (upper is None or parts <= upper[:len(parts)]))
+
+    def walk(path, dir_date):
+        # dir_date: () outside of the year directories, (year,) in a year, (year, month) in a month
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                parts = None
+                if len(dir_date) < 2:
+                    parts = _date_prefix(entry.name, _year_dir if len(dir_date) == 0 else _month_dir)
+                if parts is None:
+                    yield from walk(entry.path, dir_date)
+                elif in_range(dir_date + parts):
+                    yield from walk(entry.path, dir_date + parts)
+            elif entry.name.endswith(extension) and entry.is_file():
+                parts = _date_prefix(entry.name, _day_file)
+                if parts is not None and not in_range(parts):
+                    continue
+                yield entry.path
+
+    yield from walk(os.path.abspath(filepath), ())
+
+
+def get_all_files(filepath, start_date=None, end_date=None):
     """
-    List all of the json files inside of the directory
+    List all of the json files inside of the directory (see iter_files)
     Args:
         filepath: path to explore
+        start_date (str/datetime.date): first day of the log files (included). Optional.
+        end_date (str/datetime.date): last day of the log files (included). Optional.
 
     Returns:
-        list: list of path of files to open
+        list: list of path of files to open, in a deterministic order
     Examples:
         ['/Users/paulogier/80-PythonProjects/Udacity_Sparkify_Postgres/data/song_data/A/A/TRAAABD128F429CF47.json']
     """
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, '*.json'))
-        for f in files:
-            all_files.append(os.path.abspath(f))
-    return all_files
+    return list(iter_files(filepath, start_date=start_date, end_date=end_date))
+
+
+def read_json_files(filepath, schema=None):
+    """
+    Read one or several line-delimited json files into a single DataFrame
+    Args:
+        filepath (str/list): path of the file to read, or list of paths
+        schema (dict): If provided, {column: dtype} (see schemas.py): the rows are projected on these columns \
+        and cast to their declared dtypes, instead of letting pandas infer the types. \
+        If a parsed cache is set (parsed_cache.set_parsed_cache), the typed rows of the files are read from it.
+
+    Returns:
+        pd.DataFrame: rows of all the files, in the order of the files, with a fresh RangeIndex
+    """
+    if isinstance(filepath, str):
+        filepath = [filepath]
+    cache = get_parsed_cache()
+    if cache is not None and schema is not None:
+        # typed frames of the files, parsed once per content (see parsed_cache.py)
+        frames = [cache.get(f, schema=schema, parse=parse_json_file) for f in filepath]
+    else:
+        frames = [_read_json(f, schema=schema) for f in filepath]
+    if len(frames) == 0:
+        df = pd.DataFrame()
+    elif len(frames) == 1:
+        df = frames[0]
+    else:
+        df = pd.concat(frames, axis=0, ignore_index=True, sort=False)
+    if schema is not None:
+        # the schema is applied after the concatenation, so that the categoricals share the same categories
+        df = apply_schema(df, schema)
+    return df
+
+
+def _read_json(filepath_or_buffer, schema=None):
+    """
+    Read a line-delimited json. With a schema, keep only the columns of the schema and do not infer the types \
+    (apply_schema must be called on the result)
+    """
+    with stage('read_json') as m:
+        df = pd.read_json(filepath_or_buffer, lines=True, dtype=schema is None, convert_dates=schema is None)
+        if schema is not None:
+            df = df[[c for c in schema if c in df.columns]]
+        m.rows_out = df.shape[0]
+        if isinstance(filepath_or_buffer, str) and os.path.isfile(filepath_or_buffer):
+            m.bytes = os.path.getsize(filepath_or_buffer)
+    return df
+
+
+def parse_json_file(filepath, schema):
+    """
+    Typed rows of a json file, as stored in the parsed cache
+    """
+    return apply_schema(_read_json(filepath, schema=schema), schema)
+
+
+def iter_json_chunks(filepath, chunksize=10000, contains=None, schema=None):
+    """
+    Read one or several line-delimited json files by chunks of lines, so that the memory used depends on the \
+    chunk size and not on the size of the files
+    - If contains is provided, the lines which do not contain this string are dropped before being parsed \
+    (cheap pre-filter: the rows kept must still be filtered on the parsed value)
+    Args:
+        filepath (str/list): path of the file to read, or list of paths
+        chunksize (int): number of lines read per chunk
+        contains (str): If provided, only parse the lines containing this string
+        schema (dict): If provided, {column: dtype}: project and cast each chunk (see read_json_files)
+
+    Returns:
+        generator: yields (int, pd.DataFrame): number of rows read for the chunk, and the rows kept. \
+        The DataFrame may be empty if all the rows were filtered out.
+    """
+    assert chunksize > 0
+    if isinstance(filepath, str):
+        filepath = [filepath]
+    for f in filepath:
+        with open(f, 'r', encoding='utf-8') as fp:
+            while True:
+                lines = list(itertools.islice(fp, chunksize))
+                if len(lines) == 0:
+                    break
+                lines = [line for line in lines if line.strip()]
+                n_read = len(lines)
+                if contains is not None:
+                    lines = [line for line in lines if contains in line]
+                if len(lines) == 0:
+                    df = pd.DataFrame()
+                else:
+                    df = _read_json(io.StringIO(''.join(lines)), schema=schema)
+                if schema is not None:
+                    df = apply_schema(df, schema)
+                yield n_read, df
 
 
 def order_cols(df, usecols):
@@ -76,6 +300,55 @@ def sanitize_inputs(i):
         return i
 
 
+# Characters that bleach.clean can modify: the markup characters, and the control characters it strips or replaces.
+# A string without any of them is returned unchanged by bleach.clean.
+_unsafe_chars = '[<>&\x00-\x08\x0b-\x1f]'
+
+
+@functools.lru_cache(maxsize=100000)
+def _sanitize_cached(i):
+    """
+    bleach.clean with a bounded memo cache, for the values which repeat (user agents, locations, ...)
+    """
+    return bleach.clean(i)
+
+
+def sanitize_column(s):
+    """
+    Column-wise equivalent of sanitize_inputs: returns the same values as s.map(sanitize_inputs)
+    - Strings which cannot contain markup (no <, > or &, no control character) are detected with a vectorized \
+    check and are not passed to bleach
+    - The other strings are cleaned once per distinct value, through a bounded memo cache
+    - For a categorical column, only the categories are cleaned
+    Args:
+        s (pd.Series): column to be cleaned
+
+    Returns:
+        pd.Series
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        categories = pd.Series(s.cat.categories, dtype=object)
+        cleaned = sanitize_column(categories)
+        if cleaned is categories:
+            return s
+        if cleaned.is_unique:
+            return s.cat.rename_categories(list(cleaned))
+        # two categories are cleaned into the same value
+        return sanitize_column(s.astype(object))
+    if s.dtype != object:
+        return s
+    try:
+        to_clean = s.str.contains(_unsafe_chars, regex=True, na=False)
+    except AttributeError:
+        # no string in the column
+        return s
+    if not to_clean.any():
+        return s
+    s = s.copy()
+    s[to_clean] = s[to_clean].map(_sanitize_cached)
+    return s
+
+
 def primary_key_check(df, key):
     """
     Remove from the dataframe all rows where the primary key is null
@@ -94,129 +367,472 @@ def primary_key_check(df, key):
     return df.dropna(axis=0, subset=key_cols).drop_duplicates(subset=key_cols)
 
 
-def prepare_data(df, usecols=None, pkey=None):
+def prepare_data(df, usecols=None, pkey=None, table=None):
     """
     - If usecols is provided: select, rename and order the columns
     - If key is provided: drop rows where the primary key has a null value (in case of composite key, any key that contains a null will be dropped)
-    - Sanitize the inputs with bleach
+    - Sanitize the inputs with bleach (see sanitize_column)
     Args:
         df (pd.DataFrame): data to be loaded
         usecols (pd.Series): ordered dict containing as value the list of output cols needed, as index their name \
         in the source data
+        pkey (str/list): primary key. If provided, the rows with a null or duplicate key are dropped.
+        table (str): name of the table the data is prepared for, only used to label the measures (instrumentation)
 
     Returns:
         pd.DataFrame
     """
     assert isinstance(df, pd.DataFrame)
-    if not usecols is None:
-        df2 = order_cols(df=df, usecols=usecols).copy()
-    else:
-        df2 = df.copy()
-    if not pkey is None:
-        df2 = primary_key_check(df=df2, key=pkey)
+    with stage('prepare_data', table=table, rows_in=df.shape[0]) as m:
+        if not usecols is None:
+            df2 = order_cols(df=df, usecols=usecols).copy()
+        else:
+            df2 = df.copy()
+        if not pkey is None:
+            n_before = df2.shape[0]
+            df2 = primary_key_check(df=df2, key=pkey)
+            m.rows_dropped = n_before - df2.shape[0]
 
-    df2 = df2.applymap(lambda v: sanitize_inputs(v))  # sanitize clean inputs with bleach
+        for c in df2.columns:
+            df2[c] = sanitize_column(df2[c])  # sanitize clean inputs with bleach, column by column
+        m.rows_out = df2.shape[0]
     return df2
 
-def bulk_copy(df, cur, tablename, pkey=None, filename=None, upsert=False):
+def estimate_csv_bytes(df, sample_rows=100):
     """
-    Bulk import into PostgreSql
-    - Write the data as a csv file into the csvpath directory. (without the index)\
-    If no primary key is provided:
-        - execute  a COPY FROM query
-        - delete the file
-    Else:
-        - Create a temporary empty temp_tablename with same structure as tablename
-        - COPY FROM the input data to a temp_tablename
-        - INSERT / ON CONFLICT DO NOTHING between temp_tablename and tablename
-        - DROP temp_tablename
+    Estimate the size of a DataFrame serialized as csv (the format sent by bulk_copy), from its first rows
     Args:
-        df (pd.DataFrame): Data to import. All the columns must be in the same order. Index will not be copied.
+        df (pd.DataFrame): data
+        sample_rows (int): number of rows serialized
+
+    Returns:
+        int: estimated number of bytes
+    """
+    if df.shape[0] == 0:
+        return 0
+    sample = df.iloc[:sample_rows]
+    n_bytes = len(sample.to_csv(index=False, header=False).encode('utf-8'))
+    return int(n_bytes * df.shape[0] / sample.shape[0])
+
+
+class DataFrameCopyStream(object):
+    """
+    Read-only file-like object serializing a DataFrame as a '|' delimited csv (with header), chunk by chunk
+    - Used as the file argument of cursor.copy_expert, which pulls the payload with read(size)
+    - Only one chunk of rows is serialized and held in memory at a time
+    Args:
+        df (pd.DataFrame): Data to stream. Index will not be serialized.
+        chunksize (int): number of rows serialized at a time
+        sep (str): csv delimiter
+    """
+
+    def __init__(self, df, chunksize=10000, sep='|'):
+        assert isinstance(df, pd.DataFrame)
+        assert chunksize > 0
+        self.df = df
+        self.chunksize = chunksize
+        self.sep = sep
+        self.bytes_read = 0
+        # An empty DataFrame still yields one (empty) chunk so that the header is written
+        self._starts = iter(range(0, max(df.shape[0], 1), chunksize))
+        self._header = True
+        self._ended = False
+        self._buffer = b''
+        self._pos = 0
+
+    def _serialize(self, chunk, header):
+        """
+        Args:
+            chunk (pd.DataFrame): rows to serialize
+            header (bool): True for the first chunk
+
+        Returns:
+            bytes
+        """
+        return chunk.to_csv(sep=self.sep, index=False, header=header).encode('utf-8')
+
+    def _trailer(self):
+        """
+        Returns:
+            bytes: sent after the last chunk
+        """
+        return b''
+
+    def _serialize_next_chunk(self):
+        """
+        Serialize the next chunk of rows (or the trailer) into the buffer
+        Returns:
+            bool: False if there is no more rows to serialize
+        """
+        start = next(self._starts, None)
+        if start is None:
+            if self._ended:
+                return False
+            self._ended = True
+            payload = self._trailer()
+            if len(payload) == 0:
+                return False
+        else:
+            chunk = self.df.iloc[start:start + self.chunksize]
+            payload = self._serialize(chunk, header=self._header)
+            self._header = False
+        self._buffer = self._buffer[self._pos:] + payload
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        """
+        Args:
+            size (int): maximum number of bytes to return. If negative, return everything left.
+
+        Returns:
+            bytes: empty when the stream is exhausted
+        """
+        while size < 0 or len(self._buffer) - self._pos < size:
+            if not self._serialize_next_chunk():
+                break
+        if size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(self._pos + size, len(self._buffer))
+        data = self._buffer[self._pos:end]
+        self._pos = end
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        """
+        Read up to the next newline (copy_expert only needs read, provided for file-like completeness)
+        """
+        while self._buffer.find(b'\n', self._pos) < 0:
+            if not self._serialize_next_chunk():
+                break
+        newline = self._buffer.find(b'\n', self._pos)
+        end = len(self._buffer) if newline < 0 else newline + 1
+        if 0 <= size < end - self._pos:
+            end = self._pos + size
+        data = self._buffer[self._pos:end]
+        self._pos = end
+        self.bytes_read += len(data)
+        return data
+
+
+class DataFrameBinaryCopyStream(DataFrameCopyStream):
+    """
+    Same as DataFrameCopyStream, in the PostgreSQL binary COPY format (see pgbinary.py)
+    The values are encoded from the types of the columns of the target table: no number or timestamp is \
+    formatted as text, and the delimiters or line breaks inside the strings do not need any escaping.
+    Args:
+        df (pd.DataFrame): Data to stream, with the columns in the order of the table. Index will not be serialized.
+        types (list): types of the columns of the table (see pgbinary.get_table_types)
+        chunksize (int): number of rows serialized at a time
+    """
+
+    def __init__(self, df, types, chunksize=10000):
+        super(DataFrameBinaryCopyStream, self).__init__(df=df, chunksize=chunksize)
+        self.types = types
+
+    def _serialize(self, chunk, header):
+        payload = encode_rows(chunk, self.types)
+        return copy_header + payload if header else payload
+
+    def _trailer(self):
+        return copy_trailer
+
+
+def _copy_from_df(df, cur, tablename, stream=True, filename=None, chunksize=10000, fmt='csv'):
+    """
+    COPY the data of df into tablename
+    - If stream, the rows are serialized in memory by chunks and piped directly into COPY FROM STDIN
+    - Else, the data is written as a csv file into the ../data/csv_sync directory (relative to the working \
+    directory), copied, and the file is deleted
+    - With fmt='binary', the rows are streamed in the binary COPY format, encoded from the types of the columns of \
+    tablename
+    Args:
+        df (pd.DataFrame): Data to import. All the columns must be in the same order as in the table.
         cur (psycopg2.cursor): cursor object
-        tablename (str): table name to import
-        filename (str): name of the file. If none, will use timestamp of the time when the function is called
-        pkey(str/list): primary key or list. If provided, will allow upsert.
+        tablename (str): table name to import into
+        stream (bool): If True, do not write any file
+        filename (str): name of the file (only used if stream is False). \
+        If none, will use timestamp of the time when the function is called
+        chunksize (int): number of rows serialized at a time when streaming
+        fmt (str): 'csv' or 'binary' (binary is always streamed)
 
     Returns:
-        None
+        int: number of bytes sent
     """
-    if filename is None:
-        filename = tablename + '_' + datetime.datetime.now().strftime("%Y-%b-%d-%H-%M-%S") + '.csv'
-    # csvdir = os.path.dirname(sys.path[0]) + '/data/csv_sync'  # csvdir (str): path of directory for csv import
-    csvdir = os.path.abspath('../data/csv_sync')
-    filepath = csvdir + '/' + filename
-    df.to_csv(path_or_buf=filepath, encoding='utf-8', sep='|', index=False)
+    if fmt == 'binary':
+        query_copy = sql.SQL("""
+        COPY {tablename} FROM STDIN WITH (FORMAT binary)
+        """).format(tablename=sql.Identifier(tablename))
+        types = get_table_types(cur, tablename)
+        f = DataFrameBinaryCopyStream(df=df, types=types, chunksize=chunksize)
+        cur.copy_expert(query_copy, f)
+        return f.bytes_read
+    if fmt != 'csv':
+        raise ValueError('Unknown COPY format: {}'.format(fmt))
     # Preventing SQL injections thanks to https://github.com/psycopg/psycopg2/issues/529
-
-    if pkey is None:
-        query = sql.SQL("""
-            COPY {tablename} FROM STDIN WITH CSV HEADER ENCODING 'UTF-8' DELIMITER '|'
-            """).format(tablename=sql.Identifier(tablename))
-        with open(filepath, 'r') as f:
-            cur.copy_expert(query, f)
+    query_copy = sql.SQL("""
+    COPY {tablename} FROM STDIN WITH CSV HEADER ENCODING 'UTF-8' DELIMITER '|'
+    """).format(tablename=sql.Identifier(tablename))
+    if stream:
+        f = DataFrameCopyStream(df=df, chunksize=chunksize)
+        cur.copy_expert(query_copy, f)
+        n_bytes = f.bytes_read
     else:
-        # COPIED FROM https://www.postgresql.org/message-id/464F7A31.6020501@autoledgers.com.au
-        # Preventing SQL injections thanks to https://realpython.com/prevent-python-sql-injection/
-        temp_tablename = 'temp_' + tablename
-        query_create = sql.SQL("""
-        CREATE TABLE IF NOT EXISTS {temp_tablename} AS SELECT * FROM {tablename} WHERE 1=0;
-        TRUNCATE TABLE {temp_tablename};""").format(
-            temp_tablename = sql.Identifier(temp_tablename),
-            tablename=sql.Identifier(tablename)
-        )
-        cur.execute(query_create)
-        query_delete = sql.SQL("""DELETE FROM {temp_tablename};""").format(temp_tablename=sql.Identifier(temp_tablename))
-        cur.execute(query_delete)
+        if filename is None:
+            # microseconds and a random suffix so that two loads of the same table do not share a file
+            filename = '{}_{}_{}.csv'.format(tablename, datetime.datetime.now().strftime("%Y-%b-%d-%H-%M-%S-%f"),
+                                             uuid.uuid4().hex[:8])
+        # csvdir = os.path.dirname(sys.path[0]) + '/data/csv_sync'  # csvdir (str): path of directory for csv import
+        csvdir = os.path.abspath('../data/csv_sync')
+        filepath = csvdir + '/' + filename
+        df.to_csv(path_or_buf=filepath, encoding='utf-8', sep='|', index=False)
+        try:
+            n_bytes = os.path.getsize(filepath)
+            with open(filepath, 'r') as f:
+                cur.copy_expert(query_copy, f)
+        finally:
+            os.remove(filepath)
+    return n_bytes
 
-        query_copy = sql.SQL("""
-        COPY {temp_tablename} FROM STDIN WITH 
-        DELIMITER AS '|' ENCODING 'UTF-8' CSV HEADER;
-        """).format(temp_tablename = sql.Identifier('temp_' + tablename))
-        with open(filepath, 'r') as f:
-            cur.copy_expert(query_copy, f)
-        if isinstance(pkey, str):
-            pkey_s = sql.Identifier(pkey)
+
+class MergePolicy(object):
+    """
+    What bulk_copy does when a staged row has the same primary key as a row of the table
+    - MergePolicy.do_nothing(): keep the row of the table (INSERT ... ON CONFLICT DO NOTHING)
+    - MergePolicy.update(columns): overwrite the columns with the staged values (ON CONFLICT DO UPDATE SET ...). \
+    If columns is None, all the columns but the primary key are updated.
+    - MergePolicy.latest_wins(version, columns): like update, but only if the staged row is at least as recent \
+    as the row of the table according to the version column. Among staged rows with the same key, the most \
+    recent one is kept.
+    The policies give to the bulk path the same semantics as the INSERT ... ON CONFLICT queries of sql_queries.py.
+    Args:
+        action (str): 'nothing' or 'update'
+        columns (list): columns updated on conflict (None: all the columns but the primary key)
+        version (str): version column (latest_wins)
+    """
+
+    def __init__(self, action='nothing', columns=None, version=None):
+        if action not in ('nothing', 'update'):
+            raise ValueError('Unknown merge action {}'.format(action))
+        self.action = action
+        self.columns = columns
+        self.version = version
+
+    @classmethod
+    def do_nothing(cls):
+        return cls(action='nothing')
+
+    @classmethod
+    def update(cls, columns=None):
+        return cls(action='update', columns=columns)
+
+    @classmethod
+    def latest_wins(cls, version, columns=None):
+        return cls(action='update', columns=columns, version=version)
+
+    def update_columns(self, all_columns, key_cols):
+        """
+        Args:
+            all_columns (list): columns of the staged data
+            key_cols (list): primary key columns
+
+        Returns:
+            list: columns overwritten on conflict
+        """
+        if self.action == 'nothing':
+            return []
+        if self.columns is None:
+            columns = [c for c in all_columns if c not in key_cols]
+        else:
+            columns = list(self.columns)
+        if self.version is not None and self.version not in columns:
+            columns.append(self.version)
+        return columns
+
+    def merge_query(self, tablename, temp_tablename, key_cols, all_columns):
+        """
+        INSERT ... SELECT query from the staging table into the table
+        The query has no terminating semicolon, so that it can be used in a CTE (see rollups.Rollups.wrap).
+        Args:
+            tablename (str): target table
+            temp_tablename (str): staging table
+            key_cols (list): primary key columns
+            all_columns (list): columns of the staged data
+
+        Returns:
+            sql.Composed
+        """
+        pkey_s = sql.SQL(', ').join([sql.Identifier(c) for c in key_cols])
+        if self.version is None:
+            order_by = sql.SQL('')
         else:
-            pkey_s = sql.SQL(', ').join([sql.Identifier(c) for c in pkey])
-        query_upsert = sql.SQL("""
+            order_by = sql.SQL('ORDER BY {pkey_s}, {version} DESC NULLS LAST').format(
+                pkey_s=pkey_s, version=sql.Identifier(self.version))
+        columns = self.update_columns(all_columns=all_columns, key_cols=key_cols)
+        if len(columns) == 0:
+            on_conflict = sql.SQL('DO NOTHING')
+        else:
+            on_conflict = sql.SQL('DO UPDATE SET {assignments}').format(
+                assignments=sql.SQL(', ').join([
+                    sql.SQL('{c} = EXCLUDED.{c}').format(c=sql.Identifier(c)) for c in columns]))
+            if self.version is not None:
+                on_conflict = sql.SQL(
+                    '{on_conflict} WHERE {tablename}.{version} IS NULL OR {tablename}.{version} <= EXCLUDED.{version}'
+                ).format(on_conflict=on_conflict, tablename=sql.Identifier(tablename),
+                         version=sql.Identifier(self.version))
+        return sql.SQL("""
         INSERT INTO {tablename}
             (
                 SELECT DISTINCT ON ({pkey_s}) *
                 FROM {temp_tablename}
                 WHERE ({pkey_s}) is not null
+                {order_by}
             )
         ON CONFLICT ({pkey_s})
-        DO NOTHING;
+        {on_conflict}
         """).format(tablename=sql.Identifier(tablename),
                     temp_tablename=sql.Identifier(temp_tablename),
-                    pkey_s=pkey_s)
-        # cur.execute(query_upsert, {'temp_tablename': 'temp_' + tablename, 'tablename': tablename, 'primary_key': _format_pkey(pkey)})
-        cur.execute(query_upsert)
-        query_drop = sql.SQL("""DROP TABLE {temp_tablename};""").format(temp_tablename=sql.Identifier(temp_tablename))
-        cur.execute(query_drop)
-    os.remove(filepath)
-    return None
+                    pkey_s=pkey_s,
+                    order_by=order_by,
+                    on_conflict=on_conflict)
+
+
+def staging_table(cur, tablename):
+    """
+    Empty staging table for tablename, local to the database session
+    The staging table is a TEMP table (not WAL-logged, visible only to this connection, so the concurrent writers \
+    do not share it), created the first time it is used in the session and then reused: \
+    the following calls only TRUNCATE it, there is no CREATE / DROP per load.
+    It has the columns of tablename, without its constraints (rows with a null key are filtered by the merge). \
+    When the tables are recreated in the session, create_tables.drop_tables drops it with the other temp tables.
+    Args:
+        cur (psycopg2.cursor): cursor
+        tablename (str): table to stage
+
+    Returns:
+        str: name of the staging table (temp_tablename)
+    """
+    temp_tablename = 'temp_' + tablename
+    # one round trip: IF NOT EXISTS is a catalog lookup once the table exists
+    cur.execute(sql.SQL("""
+    CREATE TEMP TABLE IF NOT EXISTS {temp_tablename} AS SELECT * FROM {tablename} WITH NO DATA;
+    TRUNCATE TABLE {temp_tablename};""").format(
+        temp_tablename=sql.Identifier(temp_tablename),
+        tablename=sql.Identifier(tablename)
+    ))
+    return temp_tablename
+
 
-def _format_pkey(pkey):
+def bulk_copy(df, cur, tablename, pkey=None, filename=None, upsert=False, stream=True, chunksize=10000, fmt='csv',
+              partitions=None, rollups=None):
     """
-    Format the primary key to be inserted into an SQL query
+    Bulk import into PostgreSql
+    - Serialize the data as csv (without the index): streamed in memory (default), \
+    or written as a csv file into the csvpath directory if stream is False
+    - Or, with fmt='binary', stream the data in the PostgreSQL binary COPY format, \
+    encoded from the types of the columns of the table
+    If no primary key is provided:
+        - execute  a COPY FROM query
+    Else:
+        - Empty the session staging table temp_tablename (see staging_table)
+        - COPY FROM the input data to temp_tablename
+        - INSERT / ON CONFLICT between temp_tablename and tablename, according to the merge policy (upsert)
+    With partitions, the missing partitions of the rows are created, and the rows of each partition are copied \
+    (and merged) directly into the partition instead of tablename.
     Args:
-        pkey (str/list):
+        df (pd.DataFrame): Data to import. All the columns must be in the same order. Index will not be copied.
+        cur (psycopg2.cursor): cursor object
+        tablename (str): table name to import
+        filename (str): name of the file if stream is False. If none, will use timestamp of the time when the \
+        function is called
+        pkey(str/list): primary key or list. If provided, will allow upsert.
+        upsert (bool/MergePolicy): what to do with the rows whose key is already in the table (only with pkey): \
+        False: nothing, True: update all the other columns, or a MergePolicy
+        stream (bool): If True (default), pipe the rows directly into COPY without writing a file
+        chunksize (int): number of rows serialized at a time when streaming
+        fmt (str): COPY format, 'csv' (default) or 'binary'
+        partitions (partitions.MonthlyPartitions): If provided, tablename is partitioned: route the rows \
+        to the partitions
+        rollups (rollups.Rollups): If provided (with pkey), the rows inserted by the merge are added to the rollups \
+        by the merge statement
 
     Returns:
-        str: pkey: column name or list of column names separated by commar
+        None
     """
-    if isinstance(pkey, str):
-        pkey_s = pkey
+    if df.shape[0] == 0:
+        # nothing to load: skip the staging round trip
+        return None
+    if partitions is not None:
+        partitions.ensure(cur=cur, values=df[partitions.column])
+        for partition_name, part in partitions.route(df):
+            bulk_copy(df=part, cur=cur, tablename=partition_name, pkey=pkey, filename=filename, upsert=upsert,
+                      stream=stream, chunksize=chunksize, fmt=fmt, rollups=rollups)
+        return None
+    if pkey is None:
+        with stage('bulk_copy.copy', table=tablename, rows_in=df.shape[0]) as m:
+            m.bytes = _copy_from_df(df=df, cur=cur, tablename=tablename, stream=stream, filename=filename,
+                                    chunksize=chunksize, fmt=fmt)
     else:
-        pkey_s = ', '.join(pkey)
-    return pkey_s
+        # COPIED FROM https://www.postgresql.org/message-id/464F7A31.6020501@autoledgers.com.au
+        # Preventing SQL injections thanks to https://realpython.com/prevent-python-sql-injection/
+        if isinstance(upsert, MergePolicy):
+            policy = upsert
+        elif upsert:
+            policy = MergePolicy.update()
+        else:
+            policy = MergePolicy.do_nothing()
+        key_cols = [pkey] if isinstance(pkey, str) else list(pkey)
+        with stage('bulk_copy.staging', table=tablename):
+            temp_tablename = staging_table(cur=cur, tablename=tablename)
+        with stage('bulk_copy.copy', table=tablename, rows_in=df.shape[0]) as m:
+            m.bytes = _copy_from_df(df=df, cur=cur, tablename=temp_tablename, stream=stream, filename=filename,
+                                    chunksize=chunksize, fmt=fmt)
+        with stage('bulk_copy.merge', table=tablename, rows_in=df.shape[0]) as m:
+            query = policy.merge_query(tablename=tablename, temp_tablename=temp_tablename, key_cols=key_cols,
+                                       all_columns=list(df.columns))
+            if rollups is None:
+                cur.execute(query)
+                # rows inserted or updated in the table
+                m.rows_out = cur.rowcount
+            else:
+                cur.execute(rollups.wrap(query))
+                m.rows_out = cur.fetchone()[0]
+    return None
+
+def df_to_rows(df):
+    """
+    Rows of the DataFrame as tuples of python values, with None for the nulls (NaN, NaT, NA)
+    Args:
+        df (pd.DataFrame)
 
+    Returns:
+        list: list of tuples
+    """
+    values = df.astype(object)
+    values = values.where(values.notnull(), None)
+    return list(values.itertuples(index=False, name=None))
 
-def copy_from(cur, filepath, tablename, usecols, key):
-    df = pd.read_json(filepath, lines=True)
-    df = prepare_data(df=df, usecols=usecols, pkey=key)
-    bulk_copy(df=df, cur=cur, tablename=tablename)
-    pass
 
+def insert_values(df, cur, query, template=None, page_size=1000, table=None):
+    """
+    Execute a multi-row statement for each page of rows of df (psycopg2.extras.execute_values)
+    One round trip per page instead of one per row, and the ON CONFLICT clause of the query applies as with \
+    single-row inserts. With DO UPDATE, a page must not contain the same key twice (see prepare_data).
+    Args:
+        df (pd.DataFrame): rows, with the columns in the order of the query
+        cur (psycopg2.cursor): cursor
+        query (str): query containing a single VALUES %s placeholder, e.g. sql_queries.song_table_insert_values
+        template (str): template of a row, e.g. '(%s, %s::INTEGER)'. Default: all the columns as they are.
+        page_size (int): number of rows per statement
+        table (str): name of the table, only used to label the measures (instrumentation)
 
+    Returns:
+        None
+    """
+    if df.shape[0] == 0:
+        return None
+    with stage('insert_values', table=table, rows_in=df.shape[0]):
+        execute_values(cur, query, df_to_rows(df), template=template, page_size=page_size)
+    return None
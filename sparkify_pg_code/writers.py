@@ -0,0 +1,184 @@
+import queue
+import threading
+from sparkify_pg_code.utils import pooled_connection
+
+# Sentinel put in a table queue to stop its writer thread
+_STOP = object()
+
+
+class TableWriters(object):
+    """
+    Write the prepared tables concurrently, one writer thread per table
+    - Each writer thread borrows its own connection from the pool (autocommit), \
+    so that the independent tables (e.g. time, users, artists) are loaded in parallel
+    - The batches of a table are written in the order they are submitted
+    - Dependencies: a batch of a table is written only once all the batches previously submitted for the tables \
+    it depends on are written (and committed). E.g. {'songplays': ['songs', 'artists']}
+    - Backpressure: each table has a bounded queue of max_pending batches. submit blocks while the queue of a \
+    table is full, so that a slow table does not make the memory grow without limit
+    - If a writer fails, the other writers stop writing and the error is raised by submit or close
+    Args:
+        pool (psycopg2.pool.ThreadedConnectionPool): pool with at least as many connections as tables
+        loaders (dict): {tablename: function(data, cur, bulk)} loading one batch of the table
+        bulk (bool): If true, will use copy from instead of insert
+        dependencies (dict): {tablename: list of tablenames which must be written before}
+        max_pending (int): maximum number of batches waiting in the queue of each table
+        load_kwargs (dict): additional keyword arguments passed to the loaders
+    Examples:
+        with TableWriters(pool=pool, loaders=table_loaders, dependencies=table_dependencies) as writers:
+            writers.submit(tables)
+    """
+
+    def __init__(self, pool, loaders, bulk=False, dependencies=None, max_pending=2, load_kwargs=None):
+        assert max_pending >= 1
+        self.pool = pool
+        self.loaders = loaders
+        self.bulk = bulk
+        self.dependencies = dependencies if dependencies is not None else {}
+        self.max_pending = max_pending
+        self.load_kwargs = load_kwargs if load_kwargs is not None else {}
+        self._queues = {}
+        self._threads = {}
+        self._submitted = {}
+        self._done = {}
+        self._errors = []
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(raise_errors=exc_type is None)
+        return False
+
+    def _start_writer(self, tablename):
+        """
+        Create the queue and start the writer thread of a table
+        """
+        self._queues[tablename] = queue.Queue(maxsize=self.max_pending)
+        self._submitted.setdefault(tablename, 0)
+        self._done.setdefault(tablename, 0)
+        thread = threading.Thread(target=self._run_writer, args=(tablename,), name='writer-' + tablename,
+                                  daemon=True)
+        self._threads[tablename] = thread
+        thread.start()
+
+    def _wait_dependencies(self, requirements):
+        """
+        Block until the tables we depend on have written the number of batches required
+        Args:
+            requirements (dict): {tablename: number of batches which must be done}
+
+        Returns:
+            bool: False if another writer failed in the meantime
+        """
+        with self._condition:
+            while not self._errors:
+                if all(self._done.get(t, 0) >= n for t, n in requirements.items()):
+                    return True
+                self._condition.wait()
+            return False
+
+    def _fail(self, tablename, e):
+        """
+        Record the error of a writer and wake up the writers waiting for a dependency
+        """
+        with self._condition:
+            self._errors.append((tablename, e))
+            self._condition.notify_all()
+
+    def _run_writer(self, tablename):
+        """
+        Target of the writer thread of a table: write the batches of its queue until the stop sentinel
+        After a failure (including when no connection can be borrowed from the pool), the queue is still drained \
+        so that submit does not block forever
+        """
+        q = self._queues[tablename]
+        try:
+            with pooled_connection(self.pool) as conn:
+                cur = conn.cursor()
+                while True:
+                    item = q.get()
+                    try:
+                        if item is _STOP:
+                            return
+                        requirements, data = item
+                        if self._errors or not self._wait_dependencies(requirements):
+                            continue
+                        try:
+                            self.loaders[tablename](data, cur=cur, bulk=self.bulk, **self.load_kwargs)
+                            conn.commit()
+                        except Exception as e:
+                            self._fail(tablename, e)
+                            continue
+                        with self._condition:
+                            self._done[tablename] += 1
+                            self._condition.notify_all()
+                    finally:
+                        q.task_done()
+        except Exception as e:
+            self._fail(tablename, e)
+            while True:
+                item = q.get()
+                q.task_done()
+                if item is _STOP:
+                    return
+
+    def _raise_errors(self):
+        """
+        Raise the first error recorded by a writer, if any
+        """
+        if self._errors:
+            tablename, e = self._errors[0]
+            raise RuntimeError('Writer of table {} failed: {}'.format(tablename, e)) from e
+
+    def submit(self, tables):
+        """
+        Queue one batch of prepared tables. Blocks while the queue of one of the tables is full.
+        The tables are queued in the order of the dict, the dependencies only depend on the order of submission.
+        Args:
+            tables (dict): {tablename: pd.DataFrame}
+
+        Returns:
+            None
+        """
+        self._raise_errors()
+        for tablename, data in tables.items():
+            if tablename not in self._queues:
+                self._start_writer(tablename)
+            with self._condition:
+                # the batches of the dependencies submitted so far (including this batch) must be written first
+                requirements = {t: self._submitted.get(t, 0) for t in self.dependencies.get(tablename, [])}
+                self._submitted[tablename] += 1
+            self._queues[tablename].put((requirements, data))
+        self._raise_errors()
+        return None
+
+    def join(self):
+        """
+        Wait until all the submitted batches are written
+        Returns:
+            None
+        """
+        for q in self._queues.values():
+            q.join()
+        self._raise_errors()
+        return None
+
+    def close(self, raise_errors=True):
+        """
+        Wait until all the submitted batches are written, stop the writer threads
+        Args:
+            raise_errors (bool): If True, raise the first error of the writers
+
+        Returns:
+            None
+        """
+        for q in self._queues.values():
+            q.put(_STOP)
+        for thread in self._threads.values():
+            thread.join()
+        self._queues, self._threads = {}, {}
+        if raise_errors:
+            self._raise_errors()
+        return None
@@ -9,4 +9,4 @@ CREATE TABLE songplays
         location text,
         user_agent text,
         PRIMARY KEY (start_time, user_id)
-);
\ No newline at end of file
+) PARTITION BY RANGE (start_time);
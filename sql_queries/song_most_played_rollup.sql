@@ -0,0 +1,10 @@
+-- This query shows the top 10 most played songs in 2019, from the daily rollup instead of the songplays
+-- (see sparkify_pg_code/rollups.py: one row per song and day)
+SELECT a.name, s.title, SUM(r.n_plays) AS n_played
+FROM song_plays_daily r
+LEFT JOIN songs s USING (song_id)
+LEFT JOIN artists a ON a.artist_id = r.artist_id
+WHERE r.day >= '2019-01-01' AND r.day < '2020-01-01'
+GROUP BY a.name, s.title
+ORDER BY n_played DESC
+LIMIT 10;
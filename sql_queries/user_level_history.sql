@@ -0,0 +1,7 @@
+-- This query shows the level of each user on 2018-11-15, from the history of the levels
+-- (see sparkify_pg_code/etl.py load_user_data: one row per level change, valid_to is NULL for the current level)
+SELECT h.user_id, u.first_name, u.last_name, h.level
+FROM users_history h
+LEFT JOIN users u USING (user_id)
+WHERE h.valid_from <= '2018-11-15' AND (h.valid_to IS NULL OR h.valid_to > '2018-11-15')
+ORDER BY h.user_id;
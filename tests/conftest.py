@@ -0,0 +1,23 @@
+import pytest
+
+from sparkify_pg_code.utils import connection_sparkifydb
+from sparkify_pg_code.sql_queries import create_table_queries
+
+
+@pytest.fixture
+def sparkify_schema():
+    """
+    Tables of sparkifydb created in a schema of their own (sparkify_test, first in the search_path), \
+    dropped after the test: the tables of the public schema are not touched
+    Returns:
+        psycopg2.cursor, psycopg2.connection
+    """
+    conn = connection_sparkifydb()
+    cur = conn.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS sparkify_test CASCADE; CREATE SCHEMA sparkify_test;")
+    cur.execute("SET search_path TO sparkify_test;")
+    for query in create_table_queries:
+        cur.execute(query)
+    yield cur, conn
+    cur.execute("DISCARD TEMP; DROP SCHEMA sparkify_test CASCADE;")
+    conn.close()
@@ -0,0 +1,87 @@
+import pytest
+
+from sparkify_pg_code.analytics import QueryCache, Analytics
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Notify(object):
+
+    def __init__(self, channel, payload):
+        self.channel = channel
+        self.payload = payload
+
+
+class FakeConnection(object):
+    """
+    Connection answering the load generation and counting the analytics queries, without database
+    """
+
+    def __init__(self):
+        self.autocommit = True
+        self.notifies = []
+        self.generation = 1
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def poll(self):
+        pass
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+
+    def execute(self, query, params=None):
+        if 'load_generation' in query:
+            self.result = [(self.conn.generation,)]
+        elif params is not None:
+            self.conn.queries.append(params)
+            self.result = [('foo', len(self.conn.queries))]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+def test_query_cache():
+    clock = Clock()
+    cache = QueryCache(max_entries=2, ttl=10, clock=clock)
+    cache.put(('a',), 1, 'A')
+    cache.put(('b',), 1, 'B')
+    assert cache.get(('a',), 1) == (True, 'A')
+    # least recently used evicted
+    cache.put(('c',), 1, 'C')
+    assert cache.get(('b',), 1) == (False, None)
+    # other generation, expired
+    assert cache.get(('a',), 2) == (False, None)
+    clock.now = 11
+    assert cache.get(('c',), 1) == (False, None)
+    assert cache.stats() == {'entries': 0, 'hits': 1, 'misses': 3, 'evictions': 1}
+
+
+def test_analytics_generation():
+    conn = FakeConnection()
+    analytics = Analytics(conn=conn)
+    assert analytics.top_songs('2018-11-01', '2018-12-01') == [('foo', 1)]
+    assert analytics.top_songs('2018-11-01', '2018-12-01') == [('foo', 1)]
+    assert analytics.top_songs('2018-11-01', '2018-12-01', n=5) == [('foo', 2)]
+    # a load notifies a new generation: the results are computed again
+    conn.notifies.append(Notify('load_generation', '2'))
+    assert analytics.top_songs('2018-11-01', '2018-12-01') == [('foo', 3)]
+    assert len(conn.queries) == 3
+    with pytest.raises(ValueError):
+        analytics.level_mix('2018-11-01', '2018-12-01', unit='year')
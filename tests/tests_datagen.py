@@ -0,0 +1,33 @@
+import glob
+import os
+
+from sparkify_pg_code.datagen import generate, generate_songs
+from sparkify_pg_code.etl import transform_song_file, transform_log_file
+
+
+def test_generate_songs():
+    songs = generate_songs(n_songs=1000, seed=1)
+    assert songs['song_id'].is_unique
+    assert songs['artist_id'].nunique() <= 250
+    assert (songs['duration'] > 0).all()
+
+
+def test_generate(tmp_path):
+    written = generate(root=str(tmp_path), n_songs=200, n_events=3000, n_users=50, days=3, songs_per_file=10)
+    song_files = glob.glob(os.path.join(str(tmp_path), 'song_data', '*', '*', '*', '*.json'))
+    log_files = sorted(glob.glob(os.path.join(str(tmp_path), 'log_data', '2018', '11', '*-events.json')))
+    assert written == {'song_files': 20, 'log_files': 3}
+    assert len(song_files) == 20 and len(log_files) == 3
+
+    # the generated files go through the etl transforms
+    n_rows, tables = transform_song_file(song_files)
+    assert n_rows == 200
+    assert tables['songs'].shape[0] == 200
+    n_rows, tables = transform_log_file(log_files)
+    assert n_rows == 3000
+    songplays = tables['songplays']
+    assert 0.7 * n_rows < songplays.shape[0] < 0.9 * n_rows
+    assert tables['users']['user_id'].nunique() <= 50
+    # skewed popularity: the most played song is played much more than the average song
+    plays = songplays['song'].value_counts()
+    assert plays.iloc[0] > 5 * plays.mean()
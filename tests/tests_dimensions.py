@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sparkify_pg_code.dimensions import SongLookup, TimeKeySet, BloomFilter, SeenKeys, LatestValues, DimensionCache
+from sparkify_pg_code.etl import transform_user_data, user_latest_state, user_level_changes, merge_policies
+from sparkify_pg_code.sql_queries import user_table_insert, user_table_insert_values
+
+
+def test_song_lookup():
+    lookup = SongLookup()
+    songs = pd.DataFrame(data=[['S1', 'foo', 'A1', 2000, 120.5],
+                               ['S2', 'bar', 'A2', 2001, 200.0]],
+                         columns=['song_id', 'title', 'artist_id', 'year', 'duration'])
+    artists = pd.DataFrame(data=[['A1', 'Foo Fighters'], ['A2', 'Bar Band']], columns=['artist_id', 'name'])
+    lookup.add_songs(songs)
+    lookup.add_artists(artists)
+    song_info = pd.DataFrame(data=[['foo', 120.5, 'Foo Fighters'],
+                                   ['foo', 120.5, 'Bar Band'],
+                                   ['unknown', 1.0, 'nobody'],
+                                   ['bar', 200.0, 'Bar Band']],
+                             columns=['song', 'length', 'artist'], index=[10, 11, 12, 13])
+    res = lookup.resolve(song_info)
+    assert list(res.index) == [10, 11, 12, 13]
+    assert list(res['song_id']) == ['S1', None, None, 'S2']
+    assert list(res['artist_id']) == ['A1', None, None, 'A2']
+
+    # Rows added later are visible, and the first row of a song_id wins
+    lookup.add_songs(pd.DataFrame(data=[['S1', 'other', 'A1', 2000, 1.0], ['S3', 'baz', 'A1', 2002, 3.0]],
+                                  columns=['song_id', 'title', 'artist_id', 'year', 'duration']))
+    res = lookup.resolve(pd.DataFrame(data=[['baz', 3.0, 'Foo Fighters'], ['other', 1.0, 'Foo Fighters']],
+                                      columns=['song', 'length', 'artist']))
+    assert list(res['song_id']) == ['S3', None]
+
+
+def test_time_key_set():
+    keys = TimeKeySet(keys=[1541105830796, 1541106106796], min_recent=4)
+    start_time = pd.Series(pd.to_datetime([1541105830796, 1541107053796], unit='ms'))
+    assert list(keys.contains(TimeKeySet.to_keys(start_time))) == [True, False]
+    # Adding batches merges them into the sorted set without losing any key
+    for i in range(0, 100, 3):
+        keys.add(np.arange(i, i + 3))
+    assert len(keys) == 2 + 102
+    assert keys.contains(np.arange(0, 102)).all()
+    assert not keys.contains(np.array([-1, 102])).any()
+    assert keys.nbytes == TimeKeySet.estimate_nbytes(len(keys))
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, fp_rate=1e-4)
+    keys = np.random.RandomState(0).randint(-2 ** 62, 2 ** 62, size=2000, dtype=np.int64)
+    bloom.add(keys[:1000])
+    # no false negatives, few false positives
+    assert bloom.contains(keys[:1000]).all()
+    assert bloom.contains(keys[1000:]).sum() <= 5
+
+
+def test_seen_keys():
+    seen = SeenKeys(key_cols=['song_id'], max_bytes=80)
+    df = pd.DataFrame({'song_id': ['S{}'.format(i) for i in range(20)], 'title': 'foo'})
+    seen.add(seen.keys(df.iloc[:5]))
+    assert seen.mode == 'exact'
+    assert list(seen.contains(seen.keys(df.iloc[3:7]))) == [True, True, False, False]
+    # above max_bytes, the keys move to a Bloom filter
+    seen.add(seen.keys(df.iloc[5:15]))
+    assert seen.mode == 'bloom'
+    assert seen.contains(seen.keys(df.iloc[:15])).all()
+    # the filter stays within max_bytes, with the false positive rate it allows
+    assert seen.nbytes <= 80
+    assert seen._bloom.fp_rate > seen.fp_rate
+
+
+class RecordingCursor(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.params = []
+
+    def execute(self, query, params=None):
+        self.params.append(params)
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_seen_keys_confirm():
+    seen = SeenKeys(key_cols=['song_id'], table='songs')
+    df = pd.DataFrame({'song_id': ['S1', 'S2', 'S2']})
+    # S2 was a false positive of the Bloom filter: it is not in the table
+    cur = RecordingCursor(rows=[('S1',)])
+    assert list(seen.confirm(cur, df)) == [True, False, False]
+    assert cur.params == [(['S1', 'S2'],)]
+
+
+def test_latest_values():
+    latest = LatestValues(key_col='user_id', value_cols=['level'])
+    latest.add(latest.keys(pd.DataFrame({'user_id': [1, 2], 'level': ['free', 'paid']})))
+    df = pd.DataFrame({'user_id': [1, 2, 3], 'level': ['free', 'free', 'free']})
+    assert list(latest.contains(latest.keys(df))) == [True, False, False]
+    latest.add(latest.keys(df))
+    # a level which changes back is sent again
+    assert list(latest.contains(latest.keys(pd.DataFrame({'user_id': [2], 'level': ['paid']})))) == [False]
+
+
+# the snapshot is updated without setting incompatible dtypes in place (an error in a future pandas)
+@pytest.mark.filterwarnings('error:In a future version:DeprecationWarning', 'error::FutureWarning')
+def test_latest_values_order():
+    latest = LatestValues(key_col='user_id', value_cols=['level'], order_col='ts')
+    latest.add(latest.keys(pd.DataFrame({'user_id': [1, 2], 'level': ['paid', 'free'], 'ts': [10, None]})))
+    df = pd.DataFrame({'user_id': [1, 1, 2], 'level': ['free', 'free', 'paid'], 'ts': [5, 20, 1]})
+    # an older row is dropped, a newer change is kept, a row is newer than an unknown order
+    assert list(latest.contains(latest.keys(df))) == [True, False, False]
+    latest.add(latest.keys(df))
+    assert latest.last(1) == (('free',), 20)
+    assert latest.last(2) == (('paid',), 1)
+
+
+def test_user_level_changes():
+    logs = pd.DataFrame({'userId': [7, 7, 7, 7, 8], 'firstName': 'Foo', 'lastName': 'Bar', 'gender': 'F',
+                         'level': ['free', 'paid', 'paid', 'free', 'paid'], 'ts': [4000, 1000, 2000, 3000, 5000]})
+    user_df = transform_user_data(logs)
+    # the latest state is the one of the last ts, not of the first row
+    assert user_latest_state(user_df).set_index('user_id')['level'].to_dict() == {7: 'free', 8: 'paid'}
+    snapshot = LatestValues(key_col='user_id', value_cols=['level'], order_col='ts')
+    snapshot.add(snapshot.keys(pd.DataFrame({'user_id': [7], 'level': ['paid'], 'ts': [pd.Timestamp(0)]})))
+    changes = user_level_changes(user_df, dims=DimensionCache(seen_keys={'users': snapshot}))
+    assert changes[['user_id', 'level']].values.tolist() == [[7, 'free'], [8, 'paid']]
+    assert changes['valid_from'].tolist() == [pd.to_datetime(3000, unit='ms'), pd.to_datetime(5000, unit='ms')]
+
+
+def test_users_merge_level_only():
+    # bulk and row modes update the same columns of the users already loaded: the level only
+    all_columns = ['user_id', 'first_name', 'last_name', 'gender', 'level']
+    assert merge_policies['users'].update_columns(all_columns=all_columns, key_cols=['user_id']) == ['level']
+    for query in [user_table_insert, user_table_insert_values]:
+        assert query.split('SET')[1].split(';')[0].split() == ['level', '=', 'excluded.level']
@@ -0,0 +1,30 @@
+import pytest
+
+from sparkify_pg_code.indexes import secondary_indexes, _select, create_indexes, existing_indexes, backfill
+
+
+def test_select_indexes():
+    essential = [i.name for i in _select(essential=True)]
+    others = [i.name for i in _select(essential=False)]
+    assert essential == ['songs_title_duration_idx']
+    assert 'songplays_song_id_idx' in others and 'time_year_month_idx' in others
+    assert len(_select()) == len(secondary_indexes) == len(essential) + len(others)
+    # the names are unique (CREATE INDEX IF NOT EXISTS only checks the name)
+    assert len(set(i.name for i in secondary_indexes)) == len(secondary_indexes)
+
+
+def test_backfill_rebuilds_indexes(sparkify_schema):
+    cur, conn = sparkify_schema
+    all_names = sorted(i.name for i in secondary_indexes)
+    essential = sorted(i.name for i in _select(essential=True))
+    create_indexes(cur)
+    assert sorted(existing_indexes(cur)) == all_names
+    with backfill(cur, conn):
+        # only the indexes used by the load are kept during the backfill
+        assert sorted(existing_indexes(cur)) == essential
+    assert sorted(existing_indexes(cur)) == all_names
+    # also rebuilt when the load fails
+    with pytest.raises(RuntimeError):
+        with backfill(cur, conn):
+            raise RuntimeError('load failed')
+    assert sorted(existing_indexes(cur)) == all_names
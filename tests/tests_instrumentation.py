@@ -0,0 +1,43 @@
+import json
+import pandas as pd
+import pytest
+
+from sparkify_pg_code.instrumentation import Recorder, JsonLinesSink, prometheus_text, write_prometheus, recorder
+from sparkify_pg_code.utils import prepare_data
+
+
+def test_recorder(tmp_path):
+    rec = Recorder()
+    events = []
+    rec.add_sink(events.append)
+    rec.add_sink(JsonLinesSink(str(tmp_path / 'run.jsonl')))
+    for i in range(2):
+        with rec.stage('load', table='songs', rows_in=10) as m:
+            m.rows_out = 8
+            m.bytes = 100
+    with pytest.raises(KeyError):
+        with rec.stage('load', table='songs', rows_in=5):
+            raise KeyError('foo')
+    stats = rec.stats()
+    assert len(stats) == 1
+    assert stats[0]['calls'] == 3 and stats[0]['errors'] == 1
+    assert stats[0]['rows_in'] == 25 and stats[0]['rows_out'] == 16 and stats[0]['bytes'] == 200
+    assert len(events) == 3 and events[2]['error']
+    lines = (tmp_path / 'run.jsonl').read_text().splitlines()
+    assert [json.loads(line)['rows_in'] for line in lines] == [10, 10, 5]
+
+    text = prometheus_text(stats)
+    assert '# TYPE sparkify_etl_stage_rows_in_total counter' in text
+    assert 'sparkify_etl_stage_rows_in_total{stage="load",table="songs"} 25.0' in text
+    write_prometheus(str(tmp_path / 'etl.prom'), recorder=rec)
+    assert (tmp_path / 'etl.prom').read_text().count('\n') == len(text.splitlines())
+
+
+def test_prepare_data_stage():
+    recorder.reset()
+    df = pd.DataFrame({'id': [1, 1, None, 2], 'foo': ['a', 'b', 'c', 'd']})
+    prepare_data(df=df, pkey='id')
+    stats = [s for s in recorder.stats() if s['stage'] == 'prepare_data']
+    assert stats[0]['rows_in'] == 4
+    assert stats[0]['rows_out'] == 2
+    assert stats[0]['rows_dropped'] == 2
@@ -0,0 +1,80 @@
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+from sparkify_pg_code.parsed_cache import ParsedCache, set_parsed_cache, parse_size
+from sparkify_pg_code.schemas import log_schema
+from sparkify_pg_code.utils import read_json_files
+
+log_files = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'data', 'log_data', '*', '*', '*.json')))
+
+formats = ['feather', 'parquet', 'pickle']
+
+
+def make_cache(directory, fmt, **kwargs):
+    if fmt != 'pickle':
+        pytest.importorskip('pyarrow')
+    return ParsedCache(directory, fmt=fmt, **kwargs)
+
+
+def test_parse_size():
+    assert parse_size(100) == 100
+    assert parse_size('2KB') == 2048
+    assert parse_size('1.5 GB') == int(1.5 * 1024 ** 3)
+
+
+def test_default_format_needs_pyarrow(tmp_path):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        # no silent fallback to pickle
+        with pytest.raises(ImportError):
+            ParsedCache(str(tmp_path / 'cache'))
+    else:
+        assert ParsedCache(str(tmp_path / 'cache')).fmt == 'feather'
+
+
+@pytest.mark.parametrize('fmt', formats)
+def test_read_through_cache(tmp_path, fmt):
+    expected = read_json_files(log_files, schema=log_schema)
+    cache = make_cache(str(tmp_path / 'cache'), fmt)
+    set_parsed_cache(cache)
+    try:
+        first = read_json_files(log_files, schema=log_schema)
+        second = read_json_files(log_files, schema=log_schema)
+    finally:
+        set_parsed_cache(None)
+    assert (cache.misses, cache.hits) == (len(log_files), len(log_files))
+    pd.testing.assert_frame_equal(first, expected)
+    pd.testing.assert_frame_equal(second, expected)
+    assert cache.stats()['entries'] == len(log_files)
+
+
+@pytest.mark.parametrize('fmt', formats)
+def test_evict(tmp_path, fmt):
+    cache = make_cache(str(tmp_path / 'cache'), fmt)
+    for i in range(3):
+        cache.put(cache.path('{:02d}-key'.format(i)), pd.DataFrame({'a': range(1000)}))
+        # distinct mtimes: the first entry is the least recently used
+        os.utime(cache.path('{:02d}-key'.format(i)), (i, i))
+    size = cache.size()
+    n_deleted, bytes_deleted = cache.evict(size - 1)
+    assert n_deleted == 1
+    assert not os.path.exists(cache.path('00-key'))
+    assert cache.size() == size - bytes_deleted
+
+
+@pytest.mark.parametrize('fmt', formats)
+def test_evict_to_low_water(tmp_path, fmt):
+    cache = make_cache(str(tmp_path / 'cache'), fmt, low_water=0.5)
+    cache.put(cache.path('00-key'), pd.DataFrame({'a': range(1000)}))
+    entry_bytes = cache.size()
+    cache.max_bytes = 3 * entry_bytes
+    for i in range(1, 4):
+        cache.put(cache.path('{:02d}-key'.format(i)), pd.DataFrame({'a': range(1000)}))
+    # over the cap at the 4th entry: evicted down to half the cap, the least recently put first
+    assert cache.size() <= 1.5 * entry_bytes
+    assert [os.path.exists(cache.path('{:02d}-key'.format(i))) for i in range(4)] == [False, False, False, True]
+    assert cache.size() == sum(size for _, size, _ in cache.entries())
@@ -0,0 +1,71 @@
+import pandas as pd
+
+from sparkify_pg_code.partitions import MonthlyPartitions
+
+
+def test_partition_names():
+    partitions = MonthlyPartitions(table='songplays', column='start_time')
+    month = pd.Timestamp('2018-11-30 23:59:59')
+    assert partitions.partition_name(month) == 'songplays_y2018m11'
+    assert partitions.month_of('songplays_y2018m11') == pd.Timestamp('2018-11-01')
+    # not monthly partitions
+    assert partitions.month_of('songplays_default') is None
+    assert partitions.month_of('songplays_y2018m11_old') is None
+    values = pd.Series(pd.to_datetime(['2018-12-01', '2018-11-05', None, '2018-11-30']))
+    assert partitions.months(values) == [pd.Timestamp('2018-11-01'), pd.Timestamp('2018-12-01')]
+
+
+def test_route():
+    partitions = MonthlyPartitions(table='songplays', column='start_time')
+    df = pd.DataFrame({'start_time': pd.to_datetime(['2018-12-01', '2018-11-05', None, '2018-11-30']),
+                       'user_id': [1, 2, 3, 4]})
+    routed = partitions.route(df)
+    assert [name for name, _ in routed] == ['songplays_y2018m11', 'songplays_y2018m12']
+    assert routed[0][1]['user_id'].tolist() == [2, 4]
+    assert routed[1][1]['user_id'].tolist() == [1]
+    assert partitions.route(df.iloc[2:3]) == []
+
+
+class RecordingConnection(object):
+    pass
+
+
+class RecordingCursor(object):
+    """
+    Cursor recording the statements, with the partitions already attached
+    """
+
+    def __init__(self, attached):
+        self.connection = RecordingConnection()
+        self.statements = []
+        self.attached = attached
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def fetchall(self):
+        return [(name,) for name in self.attached]
+
+
+def test_ensure_skips_known_partitions():
+    partitions = MonthlyPartitions(table='songplays', column='start_time')
+    cur = RecordingCursor(attached=['songplays_y2018m11'])
+    values = pd.Series(pd.to_datetime(['2018-11-05', '2018-12-01']))
+    assert partitions.ensure(cur, values) == ['songplays_y2018m11', 'songplays_y2018m12']
+    # one lookup of the attached partitions, one creation of the missing month
+    assert len(cur.statements) == 2
+    assert partitions.ensure(cur, values) == ['songplays_y2018m11', 'songplays_y2018m12']
+    assert len(cur.statements) == 2
+    cur.attached = ['songplays_y2018m11', 'songplays_y2018m12']
+    partitions.forget()
+    partitions.ensure(cur, values)
+    assert len(cur.statements) == 3
+
+
+def test_archive_skips_other_partitions(tmp_path):
+    partitions = MonthlyPartitions(table='songplays', column='start_time')
+    archived = []
+    partitions.archive = lambda cur, month, directory: archived.append(month)
+    cur = RecordingCursor(attached=['songplays_default', 'songplays_y2018m10', 'songplays_y2018m11'])
+    partitions.archive_before(cur, before='2018-11', directory=str(tmp_path))
+    assert archived == [pd.Timestamp('2018-10-01')]
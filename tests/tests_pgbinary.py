@@ -0,0 +1,83 @@
+import datetime
+import struct
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sparkify_pg_code.pgbinary import encode_rows, copy_header, copy_trailer, get_table_types
+from sparkify_pg_code.utils import DataFrameBinaryCopyStream
+
+types = ['timestamp without time zone', 'integer', 'character varying', 'double precision']
+
+
+def decode(payload):
+    # Minimal decoder of the binary COPY format, for the types used in this test
+    assert payload.startswith(copy_header) and payload.endswith(copy_trailer)
+    pos, rows = len(copy_header), []
+    while True:
+        (n_fields,) = struct.unpack_from('>h', payload, pos)
+        pos += 2
+        if n_fields == -1:
+            return rows
+        row = []
+        for pgtype in types[:n_fields]:
+            (length,) = struct.unpack_from('>i', payload, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            raw = payload[pos:pos + length]
+            pos += length
+            if pgtype.startswith('timestamp'):
+                (us,) = struct.unpack('>q', raw)
+                row.append(datetime.datetime(2000, 1, 1) + datetime.timedelta(microseconds=us))
+            elif pgtype == 'integer':
+                row.append(struct.unpack('>i', raw)[0])
+            elif pgtype == 'double precision':
+                row.append(struct.unpack('>d', raw)[0])
+            else:
+                row.append(raw.decode('utf-8'))
+        rows.append(row)
+
+
+def test_binary_copy_stream():
+    df = pd.DataFrame({
+        'start_time': pd.to_datetime([1541105830796, 1541106106796, 1541107053796], unit='ms'),
+        'user_id': pd.array([39, None, 8], dtype='Int64'),
+        'user_agent': ['Mozilla|5.0\nwith a line break', None, 'é'],
+        'length': [218.93179, np.nan, 1.0]
+    })
+    stream = DataFrameBinaryCopyStream(df=df, types=types, chunksize=2)
+    payload = b''
+    while True:
+        part = stream.read(7)
+        if not part:
+            break
+        payload += part
+    assert decode(payload) == [
+        [datetime.datetime(2018, 11, 1, 20, 57, 10, 796000), 39, 'Mozilla|5.0\nwith a line break', 218.93179],
+        [datetime.datetime(2018, 11, 1, 21, 1, 46, 796000), None, None, None],
+        [datetime.datetime(2018, 11, 1, 21, 17, 33, 796000), 8, 'é', 1.0]
+    ]
+    assert encode_rows(df.iloc[0:0], types) == b''
+
+
+def test_encode_integer_range():
+    # out of range and non-integer values are rejected instead of being wrapped or truncated
+    with pytest.raises(ValueError):
+        encode_rows(pd.DataFrame({'a': pd.array([2 ** 40], dtype='Int64')}), ['integer'])
+    with pytest.raises(ValueError):
+        encode_rows(pd.DataFrame({'a': [1.7]}), ['integer'])
+    payload = encode_rows(pd.DataFrame({'a': [1.0, np.nan], 'b': [2 ** 40, 0]}), ['integer', 'bigint'])
+    assert struct.unpack_from('>i', payload, 6)[0] == 1
+
+
+def test_table_types_per_schema(sparkify_schema):
+    cur, conn = sparkify_schema
+    types = get_table_types(cur, 'artists')
+    # a temporary table of the same name hides the one of the schema: its types are not the cached ones
+    cur.execute("CREATE TEMP TABLE artists (artist_id INTEGER);")
+    assert get_table_types(cur, 'artists') == ['integer']
+    cur.execute("DROP TABLE pg_temp.artists;")
+    assert get_table_types(cur, 'artists') == types
@@ -0,0 +1,85 @@
+import glob
+import os
+import time
+
+import pytest
+
+from sparkify_pg_code.pipeline import Pipeline, StageError
+from sparkify_pg_code.instrumentation import recorder
+from sparkify_pg_code.dimensions import DimensionCache, TimeKeySet
+from sparkify_pg_code.etl import transform_batch, fresh_batches, process_log_file
+from sparkify_pg_code.schemas import log_schema
+from sparkify_pg_code.utils import read_json_files
+
+log_files = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'data', 'log_data', '*', '*', '*.json')))
+
+
+def test_pipeline_order_and_stats():
+    def slow_double(x):
+        time.sleep(0.001)
+        return 2 * x
+
+    with Pipeline(source=range(50), stages=[('double', slow_double), ('inc', lambda x: x + 1)],
+                  max_pending=2, source_name='discover', sink_name='load') as pipeline:
+        out = list(pipeline)
+    assert out == [2 * x + 1 for x in range(50)]
+    stats = pipeline.stats()
+    assert list(stats) == ['discover', 'double', 'inc', 'load']
+    assert all(s['items'] == 50 for s in stats.values())
+    assert 0 <= stats['double']['utilization'] <= 1
+    assert 'bottleneck' in pipeline.report()
+
+
+def test_pipeline_error():
+    def fail_on_3(x):
+        if x == 3:
+            raise ValueError('bad item')
+        return x
+
+    recorder.reset()
+    out = []
+    with pytest.raises(StageError, match='stage check: bad item') as excinfo:
+        with Pipeline(source=range(10), stages=[('check', fail_on_3)]) as pipeline:
+            for x in pipeline:
+                out.append(x)
+    assert out == [0, 1, 2]
+    assert isinstance(excinfo.value.__cause__, ValueError)
+    assert [s['errors'] for s in recorder.stats() if s['stage'] == 'pipeline.check'] == [1]
+
+
+def test_pipeline_consumer_stops():
+    # the stages are blocked on their full queues: close stops them
+    pipeline = Pipeline(source=range(1000), stages=[('identity', lambda x: x)], max_pending=1)
+    with pytest.raises(RuntimeError):
+        with pipeline:
+            for x in pipeline:
+                raise RuntimeError('load failed')
+    assert all(not t.is_alive() for t in pipeline._threads)
+
+
+class EmptyTablesCursor(object):
+    """
+    Cursor of a database whose dimension tables are empty (the loads were rolled back)
+    """
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return []
+
+
+def test_pipeline_batches_after_rollback():
+    dims = DimensionCache(time_keys=TimeKeySet())
+    df = read_json_files(log_files[:1], schema=log_schema)
+    # the first batch is transformed and loaded, the same start_time are in the next batch, transformed meanwhile
+    first = transform_batch((log_files[:1], df), func=process_log_file, dims=dims)
+    n_time = first[1][1]['time'].shape[0]
+    dims.time_keys.add(dims.time_keys.to_keys(first[1][1]['time']['start_time']))
+    queued = transform_batch((log_files[:1], df), func=process_log_file, dims=dims)
+    assert queued[1][1]['time'].shape[0] == 0
+    # the first batch is rolled back: the queued batch is read again, the next ones keep their time rows
+    dims.reload(EmptyTablesCursor())
+    later = transform_batch((log_files[:1], df), func=process_log_file, dims=dims)
+    assert list(fresh_batches([queued, later], dims=dims)) == [(log_files[:1], None), (log_files[:1], later[1])]
+    assert later[1][1]['time'].shape[0] == n_time > 0
@@ -0,0 +1,53 @@
+import datetime
+
+import pandas as pd
+
+from sparkify_pg_code.rollups import songplays_rollups
+from sparkify_pg_code.partitions import songplays_partitions
+from sparkify_pg_code.sql_queries import create_table_queries, drop_table_queries, songplay_table_insert_values
+from sparkify_pg_code.utils import bulk_copy, insert_values, MergePolicy
+
+
+def test_rollup_tables():
+    # each rollup is created and dropped with the tables, and maintained by a CTE reading the inserted rows
+    for table in songplays_rollups.tables:
+        assert any('CREATE TABLE {} '.format(table) in q for q in create_table_queries)
+        assert any(q.endswith(' ' + table) for q in drop_table_queries)
+        assert 'INSERT INTO {} '.format(table) in songplays_rollups.ctes
+    assert songplays_rollups.ctes.count('FROM inserted') == len(songplays_rollups.tables)
+
+
+def songplays(rows):
+    df = pd.DataFrame(data=rows, columns=['start_time', 'user_id', 'level', 'song_id', 'artist_id'])
+    df['start_time'] = pd.to_datetime(df['start_time'])
+    df['session_id'], df['location'], df['user_agent'] = 1, 'Paris', 'Mozilla'
+    return df
+
+
+def test_rollups_two_loads(sparkify_schema):
+    cur, conn = sparkify_schema
+    first = [('2018-11-01 10:00', 1, 'free', 'S1', 'A1'),
+             ('2018-11-01 11:00', 2, 'paid', 'S1', 'A1'),
+             ('2018-11-02 10:00', 1, 'free', 'S2', 'A2')]
+    second = first[1:] + [('2018-12-01 10:00', 2, 'paid', 'S1', 'A1')]
+    for rows in (first, second):
+        bulk_copy(df=songplays(rows), cur=cur, tablename='songplays', pkey=['start_time', 'user_id'],
+                  upsert=MergePolicy.do_nothing(), partitions=songplays_partitions, rollups=songplays_rollups)
+    # row mode: one new row, one already loaded
+    third = songplays([('2018-12-01 12:00', 1, 'paid', 'S2', 'A2'), first[0]])
+    songplays_partitions.ensure(cur=cur, values=third['start_time'])
+    insert_values(df=third, cur=cur, query=songplays_rollups.wrap(songplay_table_insert_values), table='songplays')
+
+    # the rows already loaded are not counted again
+    expected_songs = [(datetime.date(2018, 11, 1), 'S1', 2), (datetime.date(2018, 11, 2), 'S2', 1),
+                      (datetime.date(2018, 12, 1), 'S1', 1), (datetime.date(2018, 12, 1), 'S2', 1)]
+    cur.execute("SELECT day, song_id, n_plays FROM song_plays_daily ORDER BY day, song_id;")
+    assert cur.fetchall() == expected_songs
+    cur.execute("SELECT user_id, SUM(n_plays) FROM user_plays_daily GROUP BY user_id ORDER BY user_id;")
+    assert cur.fetchall() == [(1, 3), (2, 2)]
+    cur.execute("SELECT level, SUM(n_plays) FROM level_plays_hourly GROUP BY level ORDER BY level;")
+    assert cur.fetchall() == [('free', 2), ('paid', 3)]
+    # a rebuild from the songplays gives the same counts
+    assert songplays_rollups.rebuild(cur) == 5
+    cur.execute("SELECT day, song_id, n_plays FROM song_plays_daily ORDER BY day, song_id;")
+    assert cur.fetchall() == expected_songs
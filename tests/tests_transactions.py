@@ -0,0 +1,80 @@
+import pytest
+
+from sparkify_pg_code.transactions import TransactionPolicy, Committer
+
+
+class RecordingConnection(object):
+    """
+    Connection recording the commits, without database
+    """
+
+    def __init__(self):
+        self.autocommit = True
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class RecordingCursor(object):
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+
+def test_committer_per_files():
+    conn = RecordingConnection()
+    committer = Committer(conn, policy=TransactionPolicy.per_files(4))
+    assert not conn.autocommit
+    committed = [committer.done(2) for _ in range(5)]
+    assert committed == [False, True, False, True, False]
+    committer.commit()
+    assert conn.commits == 3 and committer.n_commits == 3
+
+
+def test_committer_autocommit():
+    conn = RecordingConnection()
+    committer = Committer(conn, policy=TransactionPolicy.per_statement())
+    assert conn.autocommit
+    assert not committer.done(10)
+    assert not committer.commit()
+    assert conn.commits == 0
+    # no savepoints in autocommit
+    assert not TransactionPolicy(files_per_commit=0, savepoints=True).savepoints
+
+
+def test_committer_savepoint():
+    conn = RecordingConnection()
+    cur = RecordingCursor()
+    committer = Committer(conn, policy=TransactionPolicy.per_run(savepoints=True))
+    with committer.savepoint(cur):
+        pass
+    with pytest.raises(ValueError):
+        with committer.savepoint(cur):
+            raise ValueError('bad file')
+    assert cur.statements == ['SAVEPOINT load_1;', 'RELEASE SAVEPOINT load_1;', 'SAVEPOINT load_2;',
+                              'ROLLBACK TO SAVEPOINT load_2; RELEASE SAVEPOINT load_2;']
+    assert not committer.done(100)
+    assert conn.commits == 0
+
+
+def test_committer_before_commit():
+    conn = RecordingConnection()
+    bumps = []
+    committer = Committer(conn, policy=TransactionPolicy.per_files(4), before_commit=lambda c: bumps.append(c.commits))
+    committer.done(2)
+    committer.done(2)
+    # nothing loaded since the last commit: no bump
+    committer.commit()
+    assert bumps == [0] and conn.commits == 2
+    # in autocommit, once per batch of files
+    committer = Committer(conn, policy=TransactionPolicy.per_statement(), before_commit=lambda c: bumps.append(-1))
+    committer.done(1)
+    committer.done(0)
+    assert bumps == [0, -1]
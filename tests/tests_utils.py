@@ -1,8 +1,12 @@
+import os
+
 import pandas as pd
 import psycopg2
 import pytest
 
-from sparkify_pg_code.utils import connection_sparkifydb, sanitize_inputs, primary_key_check, bulk_copy
+from sparkify_pg_code.utils import connection_sparkifydb, sanitize_inputs, primary_key_check, bulk_copy, \
+    DataFrameCopyStream, sanitize_column, MergePolicy, df_to_rows, iter_files, get_all_files
+from sparkify_pg_code.schemas import apply_schema, song_schema, log_schema
 
 
 def test_conn():
@@ -21,6 +25,39 @@ def test_sanitize_inputs():
     print(sanitize_inputs(a))
 
 
+def test_sanitize_column():
+    values = ['foo', None, 1, 1.0, "an <script>evil()</script> example", 'a & b', 'tab\tand\r\nnewline',
+              'ctrl\x01char', 'Mozilla/5.0 (Windows NT 6.1; WOW64)', 'an <script>evil()</script> example']
+    s = pd.Series(values, dtype=object)
+    # Same output as sanitize_inputs, value by value
+    assert sanitize_column(s).tolist() == [sanitize_inputs(v) for v in values]
+    # Non object columns are not modified
+    n = pd.Series([1, 2, 3])
+    assert sanitize_column(n).equals(n)
+    # Categorical columns: only the categories are cleaned
+    c = sanitize_column(pd.Series(values[4:], dtype='category'))
+    assert c.astype(object).tolist() == [sanitize_inputs(v) for v in values[4:]]
+
+
+def test_apply_schema():
+    raw = pd.DataFrame({'ts': [1541105830796, 1541106106796], 'userId': ['39', ''], 'level': ['free', 'free'],
+                        'method': ['GET', 'PUT']})
+    df = apply_schema(raw, {'userId': 'Int64', 'ts': 'int64', 'level': 'category', 'sessionId': 'int32'})
+    # projection and order of the schema, missing columns are null
+    assert list(df.columns) == ['userId', 'ts', 'level', 'sessionId']
+    assert df['userId'].tolist()[0] == 39 and df['userId'].isnull().tolist() == [False, True]
+    assert str(df['level'].dtype) == 'category'
+    assert df['sessionId'].isnull().all()
+
+
+def test_apply_schema_nulls():
+    # a null or empty value in a present integer column does not fail the file
+    raw = pd.DataFrame({'sessionId': [3, None, ''], 'year': [2000, None, 0]})
+    df = apply_schema(raw, {'sessionId': log_schema['sessionId'], 'year': song_schema['year']})
+    assert df['sessionId'].isnull().tolist() == [False, True, True]
+    assert df['sessionId'].tolist()[0] == 3 and df['year'].tolist()[2] == 0
+
+
 def test_primary_key_check():
     data = [['foo', 'bar'],
             ['foo2', None]
@@ -31,6 +68,33 @@ def test_primary_key_check():
     assert primary_key_check(df=df, key=['foo', 'bar']).shape[0] == 1
 
 
+def test_dataframe_copy_stream():
+    df = pd.DataFrame(data=[[i, 'foo{}'.format(i), None] for i in range(25)], columns=['id', 'foo', 'bar'])
+    expected = df.to_csv(sep='|', index=False).encode('utf-8')
+    # Small chunks and small reads must give back exactly the same payload as a single to_csv
+    stream = DataFrameCopyStream(df=df, chunksize=7)
+    parts = []
+    while True:
+        part = stream.read(10)
+        if not part:
+            break
+        assert len(part) <= 10
+        parts.append(part)
+    assert b''.join(parts) == expected
+    assert stream.bytes_read == len(expected)
+    # An empty DataFrame still sends the header
+    assert DataFrameCopyStream(df=df.iloc[0:0]).read() == b'id|foo|bar\n'
+
+
+def test_df_to_rows():
+    df = pd.DataFrame({'id': pd.array([1, None], dtype='Int64'), 'x': [1.5, float('nan')],
+                       'c': pd.Categorical(['a', None]), 't': pd.to_datetime([0, None], unit='ms')})
+    rows = df_to_rows(df)
+    assert rows[1] == (None, None, None, None)
+    assert rows[0][:3] == (1, 1.5, 'a')
+    # python values, which psycopg2 can adapt (no numpy scalars)
+    assert type(rows[0][0]) is int and type(rows[0][1]) is float
+
 def test_bulk_copy():
     data = [[1, 'foo', 'bar'],
             [2, 'foo2', None]
@@ -71,3 +135,72 @@ def test_bulk_copy():
 
     cur.execute('DROP TABLE test_foo')
     conn.close()
+
+
+def test_merge_policy_columns():
+    all_columns = ['id', 'foo', 'bar', 'version']
+    assert MergePolicy.do_nothing().update_columns(all_columns=all_columns, key_cols=['id']) == []
+    assert MergePolicy.update().update_columns(all_columns=all_columns, key_cols=['id']) == ['foo', 'bar', 'version']
+    assert MergePolicy.update(columns=['bar']).update_columns(all_columns=all_columns, key_cols=['id']) == ['bar']
+    # the version column is always updated with the row that wins
+    assert MergePolicy.latest_wins(version='version', columns=['bar']).update_columns(
+        all_columns=all_columns, key_cols=['id']) == ['bar', 'version']
+    with pytest.raises(ValueError):
+        MergePolicy(action='replace')
+
+
+def test_bulk_copy_merge_policies():
+    df = pd.DataFrame(data=[[1, 'foo', 10], [2, 'foo2', 10]], columns=['id', 'foo', 'version'])
+    conn = connection_sparkifydb()
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS test_merge')
+    cur.execute("""
+    CREATE TABLE test_merge (
+    id INTEGER,
+    foo VARCHAR(10),
+    version INTEGER,
+    PRIMARY KEY (id))
+    """)
+    bulk_copy(df=df, tablename='test_merge', cur=cur, pkey='id')
+
+    # do nothing (default): the rows of the table are kept
+    df_new = pd.DataFrame(data=[[1, 'bar', 5], [2, 'bar2', 20]], columns=['id', 'foo', 'version'])
+    bulk_copy(df=df_new, tablename='test_merge', cur=cur, pkey='id')
+    df2 = pd.read_sql('SELECT * FROM test_merge ORDER BY id', con=conn)
+    assert df2['foo'].tolist() == ['foo', 'foo2']
+
+    # latest wins: only the row 2 has a more recent version
+    bulk_copy(df=df_new, tablename='test_merge', cur=cur, pkey='id', upsert=MergePolicy.latest_wins(version='version'))
+    df2 = pd.read_sql('SELECT * FROM test_merge ORDER BY id', con=conn)
+    assert df2['foo'].tolist() == ['foo', 'bar2']
+    assert df2['version'].tolist() == [10, 20]
+
+    # update: all the rows are overwritten
+    bulk_copy(df=df_new, tablename='test_merge', cur=cur, pkey='id', upsert=True)
+    df2 = pd.read_sql('SELECT * FROM test_merge ORDER BY id', con=conn)
+    assert df2['foo'].tolist() == ['bar', 'bar2']
+
+    cur.execute('DROP TABLE test_merge')
+    conn.close()
+
+
+def test_iter_files(tmp_path):
+    for name in ['log_data/2018/10/2018-10-31-events.json', 'log_data/2018/11/2018-11-02-events.json',
+                 'log_data/2018/11/2018-11-01-events.json', 'log_data/2018/11/notes.txt',
+                 'log_data/2018/12/2018-12-01-events.json', 'log_data/2019/01/2019-01-01-events.json',
+                 'song_data/B/TRB.json', 'song_data/A/TRA.json', 'song_data/A/.hidden.json']:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('{}')
+
+    def names(files):
+        return [os.path.relpath(f, str(tmp_path)).replace(os.sep, '/') for f in files]
+
+    # sorted, whatever the order of the file system
+    assert names(iter_files(str(tmp_path / 'song_data'))) == ['song_data/A/TRA.json', 'song_data/B/TRB.json']
+    assert len(get_all_files(str(tmp_path / 'log_data'))) == 5
+    assert names(iter_files(str(tmp_path / 'log_data'), start_date='2018-11-02', end_date='2018-12-31')) == [
+        'log_data/2018/11/2018-11-02-events.json', 'log_data/2018/12/2018-12-01-events.json']
+    assert names(iter_files(str(tmp_path / 'log_data'), start_date='2019-01-01')) == [
+        'log_data/2019/01/2019-01-01-events.json']
+    assert list(iter_files(str(tmp_path / 'missing'))) == []